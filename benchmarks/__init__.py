@@ -0,0 +1,11 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : __init__.py
+# Date   : 2017-09-11 10-00
+# Version: 0.0.1
+# Description: offline benchmarks of mycache, run with `python -m benchmarks.run`.
+
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
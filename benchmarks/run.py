@@ -0,0 +1,272 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : run.py
+# Date   : 2017-09-11 11-00
+# Version: 0.0.1
+# Description: offline benchmarks of mycache with machine-readable results.
+#
+# python -m benchmarks.run                      # all benchmarks, JSON to stdout
+# python -m benchmarks.run --quick -o new.json  # smaller sizes
+# python -m benchmarks.run --compare old.json new.json
+
+import argparse
+import datetime
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from mycache.output import CACHE_TYPE_MAPPING, _compile_key_builder, output_cache
+from mycache.query import CacheManager, QueryTracker
+
+from benchmarks.standins import StandInCache, make_model
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+FORMAT_VERSION = 1
+
+# The in-memory cache db is available to `output_cache` as `cache_type='standin'`
+CACHE_TYPE_MAPPING.setdefault('standin', StandInCache)
+
+
+def measure(func, repeat, setup=None):
+    """
+    Call `func` `repeat` times, `setup` runs before each call and is not timed
+
+    :return: dict of the latency statistics in microseconds
+    """
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        for i in range(repeat):
+            if setup is not None:
+                setup(i)
+
+            start = time.perf_counter()
+            func(i)
+            timings.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    timings.sort()
+    total = sum(timings)
+    return {'n': repeat,
+            'mean_us': total / repeat * 1e6,
+            'p50_us': timings[repeat // 2] * 1e6,
+            'p99_us': timings[min(repeat - 1, int(repeat * 0.99))] * 1e6,
+            'min_us': timings[0] * 1e6,
+            'ops_per_sec': repeat / total if total else 0.0}
+
+
+def bench_key_generation(sizes):
+    def sample(x, y, z=None):
+        pass
+
+    results = []
+    for name, template in (('default', None), ('custom', 'sample_{x}_{y}_{z}')):
+        make_key = _compile_key_builder(sample, 'standin', template)
+        args = [((i, 'user_{}'.format(i)), {'z': i * 2}) for i in range(sizes['calls'])]
+        stats = measure(lambda i: make_key(*args[i]), sizes['calls'])
+        results.append(dict(benchmark='key_generation', params={'key': name}, **stats))
+
+    return results
+
+
+def bench_query_key(sizes):
+    results = []
+    for compact in (False, True):
+        model = make_model('BenchQueryKey{}'.format(int(compact)))
+        model.Meta.cache_compact_keys = compact
+        cache = CacheManager(model, model.objects.cache_db)
+
+        select = ['folder_id', 'name', 'icon_url']
+        queries = [{'select': select, 'where': {'name': 'name_{}'.format(i % 100) * 4}}
+                   for i in range(sizes['calls'])]
+        stats = measure(lambda i: cache.get_cache_key(queries[i]), len(queries))
+        key_length = sum(len(cache.get_cache_key(x).encode('utf-8')) for x in queries) / len(queries)
+        results.append(dict(benchmark='query_key', params={'compact': compact}, key_bytes=key_length, **stats))
+
+    return results
+
+
+def bench_output_cache(sizes):
+    results = []
+    for serializer in (None, 'pickle_zlib'):
+        @output_cache(timeout=3600, cache_type='standin', serializer=serializer, bench=serializer or 'raw')
+        def sample(x):
+            return {'id': x, 'name': 'user_{}'.format(x), 'tags': list(range(20))}
+
+        n = sizes['calls']
+        miss = measure(lambda i: sample(i), n)
+        hit = measure(lambda i: sample(i), n)
+        params = {'serializer': serializer}
+        results.append(dict(benchmark='output_cache_miss', params=params, **miss))
+        results.append(dict(benchmark='output_cache_hit', params=params, **hit))
+
+    return results
+
+
+def bench_fetch_results(sizes):
+    results = []
+    for normalized in (False, True):
+        model = make_model('BenchFetch{}'.format(int(normalized)), sizes['rows'], normalized)
+        names = ['name_{}'.format(i % 100) for i in range(sizes['calls'])]
+
+        for name in set(names):
+            list(model.objects.filter(name=name))
+
+        queries = model.Meta.table.queries
+        stats = measure(lambda i: list(model.objects.filter(name=names[i])), len(names))
+        assert model.Meta.table.queries == queries, 'Expected cache hits only'
+
+        results.append(dict(benchmark='fetch_results_hit',
+                            params={'normalized': normalized, 'rows_per_query': sizes['rows'] // 100},
+                            **stats))
+
+    return results
+
+
+def bench_invalidation(sizes):
+    results = []
+    for tracked in sizes['tracked']:
+        model = make_model('BenchInvalidation{}'.format(tracked))
+        cache_db = model.objects.cache_db
+        instance = model(folder_id=1, name='name_0', icon_url='')
+
+        def track(i):
+            # The conditions related to the instance are discarded by each run, track them again
+            with QueryTracker(model, cache_db) as tracker:
+                if i == 0:
+                    for n in range(tracked):
+                        tracker.track('cond_{}'.format(n), {'name': 'name_{}'.format(n)}, [n], 3600)
+
+                tracker.track('cond_0', {'name': 'name_0'}, [0], 3600)
+                tracker.track('cond_id', {'folder_id': 1}, [1], 3600)
+
+        stats = measure(lambda i: model.objects._invalidate_related_cache(instance), sizes['repeat'], track)
+        results.append(dict(benchmark='invalidation', params={'tracked_conditions': tracked}, **stats))
+
+    return results
+
+
+def bench_all_cache(sizes):
+    results = []
+    for chunk_size in sizes['chunks']:
+        model = make_model('BenchAllCache{}'.format(chunk_size), sizes['table'])
+        with CacheManager(model, model.objects.cache_db) as cache:
+            cache.clear()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        progress = model.objects.all_cache(chunk_size=chunk_size)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results.append({'benchmark': 'all_cache',
+                        'params': {'rows': sizes['table'], 'chunk_size': chunk_size},
+                        'n': 1,
+                        'seconds': elapsed,
+                        'rows_per_sec': sum(x.rows for x in progress) / elapsed,
+                        'groups': sum(x.groups for x in progress),
+                        'peak_memory_bytes': peak})
+
+    return results
+
+
+BENCHMARKS = {
+    'key_generation': bench_key_generation,
+    'query_key': bench_query_key,
+    'output_cache': bench_output_cache,
+    'fetch_results': bench_fetch_results,
+    'invalidation': bench_invalidation,
+    'all_cache': bench_all_cache,
+}
+
+SIZES = {
+    'full': {'calls': 20000, 'rows': 10000, 'repeat': 50, 'tracked': [10, 100, 1000, 10000, 100000],
+             'table': 100000, 'chunks': [1000, 10000]},
+    'quick': {'calls': 2000, 'rows': 1000, 'repeat': 10, 'tracked': [10, 100, 1000],
+              'table': 5000, 'chunks': [500]},
+}
+
+
+def run(names=None, quick=False):
+    random.seed(0)
+    sizes = SIZES['quick' if quick else 'full']
+    results = []
+
+    for name, bench in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        print('Running {}...'.format(name), file=sys.stderr)
+        results.extend(bench(sizes))
+
+    return {'format': FORMAT_VERSION,
+            'created_at': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sizes': 'quick' if quick else 'full',
+            'results': results}
+
+
+def _result_id(result):
+    return result['benchmark'] + json.dumps(result['params'], sort_keys=True)
+
+
+def compare(old, new):
+    """
+    Print the ratios of the main numbers (new / old), > 1 means slower for latencies
+    """
+    old_results = {_result_id(x): x for x in old['results']}
+
+    for result in new['results']:
+        base = old_results.get(_result_id(result))
+        if base is None:
+            continue
+
+        metric = 'mean_us' if 'mean_us' in result else 'seconds'
+        ratio = result[metric] / base[metric] if base[metric] else float('inf')
+        print('{:<20} {:<50} {:>12.2f} -> {:>12.2f} {:>7.2f}x'.format(
+            result['benchmark'], json.dumps(result['params'], sort_keys=True), base[metric], result[metric], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks of mycache')
+    parser.add_argument('benchmarks', nargs='*', help='names of the benchmarks, all by default: {}'.format(
+        ', '.join(BENCHMARKS)))
+    parser.add_argument('--quick', action='store_true', help='smaller sizes')
+    parser.add_argument('-o', '--output', help='write the JSON results to the file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON result files')
+    args = parser.parse_args(argv)
+
+    # The warnings of every miss and sync would dominate the timings
+    logging.getLogger('mycache').setLevel(logging.ERROR)
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    report = run(args.benchmarks, args.quick)
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : standins.py
+# Date   : 2017-09-11 10-10
+# Version: 0.0.1
+# Description: in-memory stand-ins of the cache db and the database used by the benchmarks and the tests.
+
+import copy
+import pickle
+import time
+from threading import RLock
+
+from werkzeug.contrib.cache import BaseCache
+
+from dataobj import IntField, Model, StrField
+from dataobj.manager import DataObjectsManager
+from mycache import query_cache
+from mycache.query import DataObjectsManagerWithCache
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+class StandInCache(BaseCache):
+    """
+    CacheDB-like object in a dict, values are pickled like the real backends do,
+    so that the (de)serialization cost is measured as well.
+    """
+
+    def __init__(self, default_timeout=300, **kwargs):
+        super().__init__(default_timeout)
+        self._data = dict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires, data = item
+        if expires and expires <= time.time():
+            self._data.pop(key, None)
+            return None
+
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        expires = time.time() + timeout if timeout > 0 else 0
+
+        with self._lock:
+            self._data[key] = (expires, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self.has(key):
+                return False
+
+            return self.set(key, value, timeout)
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def delete(self, key):
+        return self._data.pop(key, None) is not None
+
+    def clear(self):
+        self._data.clear()
+        return True
+
+
+class Table(object):
+    """
+    Rows of a model kept in memory, in place of the database behind the `dao_class`
+    """
+
+    OPERATORS = {
+        'lt': lambda a, b: a is not None and a < b,
+        'lte': lambda a, b: a is not None and a <= b,
+        'gt': lambda a, b: a is not None and a > b,
+        'gte': lambda a, b: a is not None and a >= b,
+        'in': lambda a, b: a in b,
+        'contains': lambda a, b: a is not None and b in a,
+        'isnull': lambda a, b: (a is None) is b,
+    }
+
+    def __init__(self, primary_key):
+        self.primary_key = primary_key
+        self.rows = dict()
+        # Queries answered by the table, i.e. cache misses
+        self.queries = 0
+
+    def insert(self, row):
+        self.rows[getattr(row, self.primary_key)] = row
+
+    def write(self, row):
+        """
+        Insert or replace a copy of the row, the next primary key is assigned if it's not given
+        """
+        if getattr(row, self.primary_key, None) is None:
+            setattr(row, self.primary_key, max(self.rows, default=0) + 1)
+
+        self.insert(copy.copy(row))
+        return 1
+
+    def delete(self, row):
+        return int(self.rows.pop(getattr(row, self.primary_key), None) is not None)
+
+    def select(self, query):
+        self.queries += 1
+        rows = [copy.copy(x) for x in self.rows.values() if self._match(x, query.get('where') or {})]
+
+        order_by = query.get('order_by') or [self.primary_key]
+        if isinstance(order_by, str):
+            order_by = [order_by]
+
+        rows.sort(key=lambda x: tuple(getattr(x, f) for f in order_by), reverse=bool(query.get('descending')))
+
+        limit = query.get('limit')
+        if isinstance(limit, int):
+            rows = rows[:limit]
+        elif isinstance(limit, (tuple, list)):
+            how_many, offset = limit[0], limit[1] if len(limit) > 1 else 0
+            rows = rows[offset:offset + how_many]
+
+        return rows
+
+    def _match(self, row, where):
+        for key, value in where.items():
+            field, _, lookup = key.partition('__')
+            if lookup:
+                if not self.OPERATORS[lookup](getattr(row, field, None), value):
+                    return False
+            elif getattr(row, field, None) != value:
+                return False
+
+        return True
+
+
+class TableManager(DataObjectsManager):
+    """
+    Answers the queries from the `Table` of the model instead of the DAO
+    """
+
+    def _fetch_results(self):
+        self._query_results_cache = self._model.Meta.table.select(self._query_collector)
+
+    def update(self, model_instance, conn=None):
+        return self._model.Meta.table.write(model_instance)
+
+    def dump(self, model_instance, conn=None):
+        return self._model.Meta.table.write(model_instance)
+
+    def delete(self, model_instance, conn=None):
+        return self._model.Meta.table.delete(model_instance)
+
+
+class StandInManager(DataObjectsManagerWithCache, TableManager):
+    pass
+
+
+class StandInDao(object):
+    @staticmethod
+    def execute(sql, args):
+        raise RuntimeError('The benchmarks never access the database')
+
+    query = execute
+
+
+def make_model(name, rows=0, normalized=False, cache_db=None, **options):
+    """
+    Create a `Folder`-like model backed by an in-memory table and an in-memory cache db
+
+    :param rows: int, rows inserted into the table, names are `name_<id % 100>`
+    :param options: other attributes of `Meta`, e.g. `cache_conditions` or `cache_pages`
+    """
+    cache_db = cache_db if cache_db is not None else StandInCache()
+
+    class Meta:
+        table_name = name.lower()
+        dao_class = StandInDao
+        cache_db_factory = lambda: cache_db
+        reuse_cache_db = False
+        cache_normalized = normalized
+        cache_conditions = {
+            '*': 3600,
+            'folder_id': 3600,
+            'name': 3600,
+            'name+folder_id': 3600,
+            'folder_id__lt': 3600,
+        }
+
+    for key, value in options.items():
+        setattr(Meta, key, value)
+
+    model = type(Model)(name, (Model,), {
+        '__module__': __name__,
+        'folder_id': IntField(db_column='id', primary_key=True, auto_increment=True),
+        'name': StrField(db_column='name', max_length=255),
+        'icon_url': StrField(max_length=1024),
+        'Meta': Meta,
+    })
+    model = query_cache(model)
+    model.objects = StandInManager(model)
+    model.Meta.table = Table('folder_id')
+
+    for i in range(1, rows + 1):
+        model.Meta.table.insert(model(folder_id=i, name='name_{}'.format(i % 100),
+                                      icon_url='https://example.com/icons/{}.png'.format(i)))
+
+    # Keep a reference so that the instances can be pickled
+    globals()[name] = model
+    return model
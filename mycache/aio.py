@@ -0,0 +1,84 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : aio.py
+# Date   : 2017-08-07 16-20
+# Version: 0.0.1
+# Description: asyncio helpers for `output_cache`.
+
+import asyncio
+import logging
+from functools import partial
+from weakref import WeakKeyDictionary
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+class ExecutorBackend(object):
+    """
+    Non-blocking facade of a CacheDB-like object (RedisCache, FileSystemCache, ...),
+    every call runs in a thread pool so that the event loop is never blocked.
+
+    :param get_cache_db: callable, returns the CacheDB-like object
+    :param executor: `concurrent.futures.Executor`, the default executor of the loop if None
+    """
+
+    def __init__(self, get_cache_db, executor=None):
+        self._get_cache_db = get_cache_db
+        self._executor = executor
+
+    def _run(self, method, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, partial(self._call, method, *args))
+
+    def _call(self, method, *args):
+        return getattr(self._get_cache_db(), method)(*args)
+
+    async def get(self, key):
+        return await self._run('get', key)
+
+    async def get_many(self, *keys):
+        return await self._run('get_many', *keys)
+
+    async def set(self, key, value, timeout=None):
+        return await self._run('set', key, value, timeout)
+
+    async def set_many(self, mapping, timeout=None):
+        return await self._run('set_many', mapping, timeout)
+
+    async def delete(self, key):
+        return await self._run('delete', key)
+
+
+class SharedTasks(object):
+    """
+    Concurrent awaits of the same key within a loop share one in-flight task.
+    """
+
+    def __init__(self):
+        self._tasks = WeakKeyDictionary()
+
+    def run(self, key, coro_func, *args):
+        """
+        Return the in-flight task of the key, or start a new one with `coro_func(*args)`
+        """
+        loop = asyncio.get_event_loop()
+        tasks = self._tasks.setdefault(loop, dict())
+        task = tasks.get(key)
+
+        if task is None:
+            task = tasks[key] = asyncio.ensure_future(coro_func(*args))
+            task.add_done_callback(partial(self._done, tasks, key))
+
+        return task
+
+    @staticmethod
+    def _done(tasks, key, task):
+        tasks.pop(key, None)
+
+        # Mark the exception as retrieved, awaiting callers get it raised anyway
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('Failed to compute key `{}`: {}'.format(key, task.exception()))
@@ -0,0 +1,198 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : broadcast.py
+# Date   : 2017-09-25 10-30
+# Version: 0.0.1
+# Description: transports broadcasting the invalidation messages to all the processes.
+
+import glob
+import logging
+import os
+import pickle
+import socket
+import uuid
+from collections import defaultdict
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+class Broadcast(object):
+    """
+    Base class of the transports, messages are dicts of picklable values.
+
+    Delivery is best effort, a message may be lost (e.g. a subscriber is restarting),
+    subscribers must be able to detect it, see `mycache.localquery.LocalQueryCache`.
+    """
+
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    def subscribe(self, channel, callback):
+        """
+        :param callback: callable, called with each message of the channel, from another thread
+         except for `InProcessBroadcast`
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InProcessBroadcast(Broadcast):
+    """
+    Messages are delivered synchronously to the subscribers of the current process, for tests
+    and single-process jobs.
+    """
+
+    def __init__(self):
+        self._callbacks = defaultdict(list)
+
+    def publish(self, channel, message):
+        for callback in list(self._callbacks.get(channel, ())):
+            _deliver(callback, channel, message)
+
+    def subscribe(self, channel, callback):
+        self._callbacks[channel].append(callback)
+
+    def close(self):
+        self._callbacks.clear()
+
+
+class LocalSocketBroadcast(Broadcast):
+    """
+    Processes of one host, each subscribing process binds a unix datagram socket
+    in `socket_dir`, messages are sent to all the sockets found there. Sockets of
+    the dead processes are removed by the publishers.
+
+    :param socket_dir: str, directory shared by the processes, created if missing
+    """
+
+    def __init__(self, socket_dir):
+        self._socket_dir = socket_dir
+        self._callbacks = defaultdict(list)
+        self._socket = None
+        self._path = None
+        self._lock = Lock()
+        self._sender = None
+
+    def publish(self, channel, message):
+        data = pickle.dumps((channel, message), pickle.HIGHEST_PROTOCOL)
+
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        for path in glob.glob(os.path.join(self._socket_dir, '*.sock')):
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The subscriber is gone
+                _remove(path)
+            except OSError as err:
+                logger.error('Failed to send invalidation message to {}: {}'.format(path, err))
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._callbacks[channel].append(callback)
+
+            if self._socket is None:
+                os.makedirs(self._socket_dir, mode=0o700, exist_ok=True)
+                self._path = os.path.join(self._socket_dir, '{}-{}.sock'.format(os.getpid(), uuid.uuid4().hex[:8]))
+                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._socket.bind(self._path)
+                Thread(target=self._receive, args=(self._socket,), daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            sock, self._socket = self._socket, None
+            if sock is not None:
+                sock.close()
+                _remove(self._path)
+
+            if self._sender is not None:
+                self._sender.close()
+                self._sender = None
+
+    def _receive(self, sock):
+        while True:
+            try:
+                data = sock.recv(1 << 20)
+            except OSError:
+                # Closed
+                return
+
+            try:
+                channel, message = pickle.loads(data)
+            except Exception as err:
+                logger.error('Bad invalidation message: {}'.format(err))
+                continue
+
+            for callback in list(self._callbacks.get(channel, ())):
+                _deliver(callback, channel, message)
+
+
+class RedisBroadcast(Broadcast):
+    """
+    Redis pub/sub, messages are received by a daemon thread of each subscribing process
+
+    :param client: redis client, e.g. `RedisCache._client`
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._pubsub = None
+        self._thread = None
+        self._lock = Lock()
+
+    def publish(self, channel, message):
+        try:
+            self._client.publish(channel, pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+        except Exception as err:
+            logger.error('Failed to publish invalidation message to {}: {}'.format(channel, err))
+
+    def subscribe(self, channel, callback):
+        def handler(item):
+            try:
+                message = pickle.loads(item['data'])
+            except Exception as err:
+                logger.error('Bad invalidation message: {}'.format(err))
+                return
+
+            _deliver(callback, channel, message)
+
+        with self._lock:
+            if self._pubsub is None:
+                self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+
+            self._pubsub.subscribe(**{channel: handler})
+
+            if self._thread is None:
+                self._thread = self._pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None:
+                self._thread.stop()
+                self._thread = None
+
+            if self._pubsub is not None:
+                self._pubsub.close()
+                self._pubsub = None
+
+
+def _deliver(callback, channel, message):
+    try:
+        callback(message)
+    except Exception as err:
+        logger.error('Failed to handle invalidation message of {}: {}'.format(channel, err))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,410 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : filecache.py
+# Date   : 2017-09-04 10-00
+# Version: 0.0.1
+# Description: sharded file system cache shared by the processes of a host.
+
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+from werkzeug.contrib.cache import BaseCache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+# Every cache file starts with the expiry time, 0 means never
+HEADER = struct.Struct('!d')
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    name TEXT PRIMARY KEY,
+    expires REAL NOT NULL,
+    size INTEGER NOT NULL,
+    stored REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored);
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    count INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE stats SET count = count + 1, size = size + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE stats SET count = count - 1, size = size - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE ON entries BEGIN
+    UPDATE stats SET size = size - OLD.size + NEW.size WHERE id = 0;
+END;
+"""
+
+
+class FileLock(object):
+    """
+    Inter-process lock of a host based on `flock`, released by the OS if the holder dies.
+
+    :param path: str, path of the lock file
+    :param blocking_timeout: int, max seconds to wait in `acquire`, None means forever
+    """
+
+    def __init__(self, path, blocking_timeout=None, sleep=0.05):
+        self._path = path
+        self._blocking_timeout = blocking_timeout
+        self._sleep = sleep
+        self._fd = None
+
+    def acquire(self):
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = None if self._blocking_timeout is None else time.time() + self._blocking_timeout
+
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._fd = fd
+                return True
+            except (IOError, OSError):
+                if deadline is not None and time.time() >= deadline:
+                    os.close(fd)
+                    return False
+
+                time.sleep(self._sleep)
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            raise RuntimeError('Cannot release an unlocked lock')
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+class ShardedFileCache(BaseCache):
+    """
+    File system cache for many entries and many processes.
+
+    1. Entries are spread over hashed sub-directories (`ab/cd/abcd...`), no directory grows too large;
+    2. Files are written to a temporary file then renamed, readers never see a partial file;
+    3. Large files are read through `mmap`;
+    4. Expiry times and sizes are kept in an SQLite index (`index.sqlite3` of the cache dir) along with
+       the total count and size, so that the eviction never lists or scans the directories. Expired
+       entries are evicted first, then the oldest ones, once `threshold` or `max_bytes` is exceeded.
+
+    Readers don't touch the index at all. The index is shared by the processes through the SQLite locking,
+    in case it's out of sync with the files (e.g. a process crashed in the middle), it only causes misses.
+
+    :param cache_dir: str, directory of the cache files
+    :param threshold: int, max entries, 0 means unlimited
+    :param default_timeout: int, default timeout in seconds, 0 means never expire
+    :param mode: int, file mode of the cache files
+    :param max_bytes: int, max total size in bytes of the cache files, None means unlimited
+    :param shard_depth: int, levels of the sub-directories
+    :param mmap_threshold: int, files larger than it (in bytes) are read through `mmap`
+    """
+
+    def __init__(self, cache_dir, threshold=500, default_timeout=300, mode=0o600, max_bytes=None,
+                 shard_depth=2, mmap_threshold=64 * 1024):
+        super().__init__(default_timeout)
+        self._path = cache_dir
+        self._threshold = threshold
+        self._mode = mode
+        self._max_bytes = max_bytes
+        self._shard_depth = shard_depth
+        self._mmap_threshold = mmap_threshold
+        self._index_path = os.path.join(cache_dir, 'index.sqlite3')
+        self._lock_dir = os.path.join(cache_dir, 'locks')
+        self._local = threading.local()
+
+        os.makedirs(self._lock_dir, exist_ok=True)
+        self._db().executescript(INDEX_SCHEMA)
+
+    def __len__(self):
+        return self._db().execute('SELECT count FROM stats WHERE id = 0').fetchone()[0]
+
+    @property
+    def size_in_bytes(self):
+        return self._db().execute('SELECT size FROM stats WHERE id = 0').fetchone()[0]
+
+    def _name(self, key):
+        return hashlib.sha1(key.encode('utf-8') if isinstance(key, str) else key).hexdigest()
+
+    def _get_filename(self, name):
+        shards = [name[i * 2:i * 2 + 2] for i in range(self._shard_depth)]
+        return os.path.join(self._path, *(shards + [name]))
+
+    def _db(self):
+        # One connection per thread, reconnect in the forked children
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            db = sqlite3.connect(self._index_path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, pid
+
+        return self._local.db
+
+    def _transaction(self):
+        return _Transaction(self._db())
+
+    def get(self, key):
+        filename = self._get_filename(self._name(key))
+
+        try:
+            expires, value = self._read(filename)
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logger.warning('Failed to read cache file {}: {}'.format(filename, err))
+            return None
+
+        if expires is None:
+            self.delete(key)
+
+        return value
+
+    def has(self, key):
+        filename = self._get_filename(self._name(key))
+
+        try:
+            with open(filename, 'rb') as f:
+                expires = HEADER.unpack(f.read(HEADER.size))[0]
+        except (IOError, OSError, struct.error):
+            return False
+
+        return expires == 0 or expires > time.time()
+
+    def set(self, key, value, timeout=None):
+        return self.set_many({key: value}, timeout)
+
+    def add(self, key, value, timeout=None):
+        name = self._name(key)
+        data, expires = self._dump(value, timeout)
+
+        try:
+            if not self._write(self._get_filename(name), data, overwrite=False):
+                if self.has(key):
+                    return False
+
+                # Expired, overwrite it
+                self._write(self._get_filename(name), data)
+
+            self._index([(name, expires, len(data))])
+        except (IOError, OSError, sqlite3.Error) as err:
+            logger.warning('Failed to add cache key `{}`: {}'.format(key, err))
+            return False
+
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        """
+        Write all the files first, then update the index in one transaction
+        """
+        entries = []
+
+        try:
+            for key, value in mapping.items():
+                name = self._name(key)
+                data, expires = self._dump(value, timeout)
+                self._write(self._get_filename(name), data)
+                entries.append((name, expires, len(data)))
+
+            self._index(entries)
+        except (IOError, OSError, sqlite3.Error) as err:
+            logger.warning('Failed to write {} cache keys: {}'.format(len(mapping), err))
+            return False
+
+        return True
+
+    def delete(self, key):
+        return self.delete_many(key)
+
+    def delete_many(self, *keys):
+        names = [self._name(key) for key in keys]
+
+        try:
+            with self._transaction() as db:
+                db.executemany('DELETE FROM entries WHERE name = ?', [(x,) for x in names])
+        except sqlite3.Error as err:
+            logger.warning('Failed to delete {} cache keys from the index: {}'.format(len(names), err))
+
+        return all([self._unlink(name) for name in names])
+
+    def clear(self):
+        with self._transaction() as db:
+            db.execute('DELETE FROM entries')
+
+        for root, dirs, files in os.walk(self._path):
+            if root == self._path:
+                # Keep the index and the locks
+                dirs[:] = [x for x in dirs if x != 'locks']
+                continue
+
+            for name in files:
+                try:
+                    os.remove(os.path.join(root, name))
+                except OSError:
+                    pass
+
+        return True
+
+    def lock(self, name, timeout=None, sleep=0.05, blocking_timeout=None, **kwargs):
+        """
+        Inter-process lock, the `timeout` is ignored as the lock is released when the holder dies
+        """
+        if fcntl is None:
+            raise NotImplementedError('File locks are not supported on this platform')
+
+        return FileLock(os.path.join(self._lock_dir, '{}.lock'.format(self._name(name))), blocking_timeout, sleep)
+
+    def _dump(self, value, timeout):
+        timeout = self._normalize_timeout(timeout)
+        expires = time.time() + timeout if timeout > 0 else 0
+        return HEADER.pack(expires) + pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires
+
+    def _read(self, filename):
+        """
+        :return: (expiry time, value), expiry time is None if expired
+        """
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+
+            if size < self._mmap_threshold:
+                data = f.read()
+                expires = HEADER.unpack_from(data)[0]
+                if 0 < expires <= time.time():
+                    return None, None
+
+                return expires, pickle.loads(data[HEADER.size:])
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                expires = HEADER.unpack_from(mm)[0]
+                if 0 < expires <= time.time():
+                    return None, None
+
+                # Unpickle from the mapped pages without copying the whole file
+                view = memoryview(mm)
+                payload = view[HEADER.size:]
+                try:
+                    return expires, pickle.loads(payload)
+                finally:
+                    payload.release()
+                    view.release()
+
+    def _write(self, filename, data, overwrite=True):
+        """
+        :return: bool, False if the file exists and `overwrite` is False
+        """
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.chmod(tmp, self._mode)
+
+            if overwrite:
+                os.replace(tmp, filename)
+                return True
+
+            try:
+                # Fails if the file exists, unlike rename
+                os.link(tmp, filename)
+                return True
+            except FileExistsError:
+                return False
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _unlink(self, name):
+        try:
+            os.remove(self._get_filename(name))
+            return True
+        except OSError:
+            return False
+
+    def _index(self, entries):
+        now = time.time()
+
+        with self._transaction() as db:
+            for name, expires, size in entries:
+                updated = db.execute('UPDATE entries SET expires = ?, size = ?, stored = ? WHERE name = ?',
+                                     (expires, size, now, name)).rowcount
+                if not updated:
+                    db.execute('INSERT INTO entries VALUES (?, ?, ?, ?)', (name, expires, size, now))
+
+            evicted = self._evict(db, now)
+
+        for name in evicted:
+            self._unlink(name)
+
+    def _evict(self, db, now):
+        """
+        Remove the expired entries and then the oldest ones from the index if any limit is exceeded,
+        10% more are removed so that it doesn't happen on every write.
+
+        :return: names of the removed entries
+        """
+        count, size = db.execute('SELECT count, size FROM stats WHERE id = 0').fetchone()
+        excess_count = count - int(self._threshold * 0.9) if self._threshold and count > self._threshold else 0
+        excess_bytes = size - int(self._max_bytes * 0.9) if self._max_bytes and size > self._max_bytes else 0
+
+        if excess_count <= 0 and excess_bytes <= 0:
+            return []
+
+        evicted, evicted_bytes = set(), 0
+        candidates = (db.execute('SELECT name, size FROM entries WHERE expires > 0 AND expires <= ? ORDER BY expires',
+                                 (now,)),
+                      db.execute('SELECT name, size FROM entries ORDER BY stored'))
+
+        for cursor in candidates:
+            for name, entry_size in cursor:
+                if len(evicted) >= excess_count and evicted_bytes >= excess_bytes:
+                    break
+
+                if name not in evicted:
+                    evicted.add(name)
+                    evicted_bytes += entry_size
+
+        db.executemany('DELETE FROM entries WHERE name = ?', [(x,) for x in evicted])
+        logger.info('Evict {} entries from file cache {}'.format(len(evicted), self._path))
+        return list(evicted)
+
+
+class _Transaction(object):
+    """
+    Write transaction of the index, other writers wait until it's committed
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        return self._db
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
@@ -0,0 +1,116 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : flight.py
+# Date   : 2017-07-28 14-40
+# Version: 0.0.1
+# Description: coalesce concurrent cache misses on the same key.
+
+import logging
+from threading import Event, Lock
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+class _Call(object):
+    __slots__ = ('event', 'result', 'failed')
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight(object):
+    """
+    Make sure only one thread in the current process runs the loader of a key,
+    the other threads wait for its result.
+
+    Waiters never wait longer than `wait_timeout` seconds, if the leader is
+    too slow or fails, each of them falls back to run the loader by itself.
+    """
+
+    def __init__(self):
+        self._calls = dict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, loader, wait_timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if is_leader:
+            try:
+                call.result = loader()
+                return call.result
+            except BaseException:
+                call.failed = True
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+
+        if not call.event.wait(wait_timeout):
+            logger.warning('Wait for the leader of key `{}` timed out, load it by myself'.format(key))
+            return loader()
+
+        if call.failed:
+            logger.warning('The leader of key `{}` failed, load it by myself'.format(key))
+            return loader()
+
+        return call.result
+
+
+def load_with_lock(cache_db, key, cache_get, loader, timeout=10):
+    """
+    Cross-process version of the single flight, only one process loads the key
+    at the same time by holding the `lock` of the cache db (see `mycache.utils.add_lock_method`).
+
+    The lock expires after `timeout` seconds so a crashed leader can't block
+    others forever; waiters give up after `timeout` seconds as well and load
+    the key by themselves.
+
+    :param cache_db: CacheDB-like object, the single flight works in process only if it has no `lock` method
+    :param key: cache key
+    :param cache_get: callable, cache_get(key), checked again once the lock is held
+    :param loader: callable, computes and stores the value
+    :param timeout: int, seconds
+    """
+    make_lock = getattr(cache_db, 'lock', None)
+    if make_lock is None:
+        return loader()
+
+    lock = make_lock('single_flight.{}'.format(key), timeout=timeout, blocking_timeout=timeout)
+
+    try:
+        acquired = lock.acquire()
+    except Exception as err:
+        logger.error('Failed to acquire the single flight lock of key `{}`: {}'.format(key, err))
+        acquired = False
+
+    try:
+        # The leader of other process may have loaded it
+        output = cache_get(key)
+        if output is not None:
+            return output
+
+        if not acquired:
+            logger.warning('Wait for the single flight lock of key `{}` timed out, load it by myself'.format(key))
+
+        return loader()
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except Exception as err:
+                # The lock may have expired already
+                logger.warning('Failed to release the single flight lock of key `{}`: {}'.format(key, err))
@@ -0,0 +1,121 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : local.py
+# Date   : 2017-07-24 10-12
+# Version: 0.0.1
+# Description: bounded in-process cache, the first tier in front of Redis/File cache.
+
+import pickle
+import sys
+import time
+from collections import OrderedDict
+from threading import RLock
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+def _sizeof(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class LocalCache(object):
+    """
+    A thread-safe LRU cache living in the current process.
+
+    The cache is bounded by the number of entries and, optionally, by the
+    approximated size (pickled length) of all the values. Entries expire
+    after `default_timeout` seconds, 0 means never expire.
+
+    Warning: values are shared between callers, don't modify them in place.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, default_timeout=300):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    @property
+    def size_in_bytes(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, size, value = entry
+            if expires_at and expires_at <= time.monotonic():
+                self._pop(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self._default_timeout
+
+        size = _sizeof(value) if self._max_bytes else 0
+        if self._max_bytes and size > self._max_bytes:
+            # Never let a single huge value flush the whole cache
+            self.delete(key)
+            return False
+
+        expires_at = time.monotonic() + timeout if timeout else 0
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (expires_at, size, value)
+            self._bytes += size
+            self._evict()
+
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._pop(key) is not None
+
+    def delete_if(self, predicate):
+        """
+        Delete the entries whose values match `predicate(value)`
+
+        :return: int, number of the deleted entries
+        """
+        with self._lock:
+            keys = [key for key, (_, _, value) in self._entries.items() if predicate(value)]
+            for key in keys:
+                self._pop(key)
+
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+        return entry
+
+    def _evict(self):
+        while len(self._entries) > self._max_entries or (self._max_bytes and self._bytes > self._max_bytes):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
@@ -0,0 +1,146 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : localquery.py
+# Date   : 2017-09-25 14-00
+# Version: 0.0.1
+# Description: process-local copies of the query results, dropped by broadcast invalidation messages.
+
+import copy
+import logging
+import time
+import uuid
+from threading import Lock
+
+from mycache.local import LocalCache
+from mycache.tracker import make_related_predicate
+from mycache.utils import camel_to_underscore
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+class LocalQueryCache(object):
+    """
+    Query results of a model kept in the current process, in front of the cache db.
+
+    Each invalidation increases the version of the model in the cache db and publishes
+    the conditions along with the new version to all the processes, which drop their
+    related copies with the same rules as `QueryTracker`. A message may be lost, so:
+    1. a version which doesn't follow the last one drops all the copies;
+    2. the version in the cache db is checked every `check_interval` seconds, copies
+       are dropped if it's not the last one seen, stale copies live no longer than that;
+    3. results loaded while an invalidation happened are not kept.
+
+    Results are shallow copies of the cached instances, callers can modify them.
+
+    :param model: model class
+    :param cache_db: CacheDB-like object holding the version
+    :param broadcast: `mycache.broadcast.Broadcast`, None means only the current process is notified
+    :param max_entries: int
+    :param max_bytes: int, None means unlimited
+    :param timeout: int, seconds each copy lives, 0 means never expire
+    :param check_interval: float, seconds
+    """
+
+    def __init__(self, model, cache_db, broadcast=None, max_entries=1000, max_bytes=None, timeout=60,
+                 check_interval=1):
+        name = camel_to_underscore(model.__name__)
+        self._model = model
+        self._cache_db = cache_db
+        self._broadcast = broadcast
+        self._check_interval = check_interval
+        self._entries = LocalCache(max_entries, max_bytes, timeout)
+        self._lock = Lock()
+        self._origin = uuid.uuid4().hex
+        self._checked_at = 0
+        self.version = None
+        self.version_key = '{}_local_version'.format(name)
+        self.channel = 'mycache.invalidation.{}'.format(name)
+
+        if broadcast is not None:
+            broadcast.subscribe(self.channel, self.receive)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self.check()
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        return [copy.copy(x) for x in entry[1]]
+
+    def set(self, key, where, results, version):
+        """
+        :param version: the `version` before loading the results, they are dropped if it has changed
+        """
+        with self._lock:
+            if version != self.version:
+                logger.debug('Results of key `{}` were loaded during an invalidation, drop them'.format(key))
+                return False
+
+            return self._entries.set(key, (where, [copy.copy(x) for x in results]))
+
+    def invalidate(self, wheres, rows=None):
+        """
+        Drop the copies related to the conditions in all the processes, empty `wheres` drops all.
+
+        :param rows: list of dicts, values of the written rows, see `mycache.tracker.is_related`
+        """
+        try:
+            version = self._cache_db.inc(self.version_key)
+        except Exception as err:
+            logger.error('Failed to increase version of {}: {}'.format(self._model.__name__, err))
+            version = None
+
+        self._apply(version, wheres, rows)
+
+        if self._broadcast is not None:
+            self._broadcast.publish(self.channel, {'origin': self._origin, 'version': version, 'wheres': wheres,
+                                                   'rows': rows})
+
+    def receive(self, message):
+        if message.get('origin') != self._origin:
+            self._apply(message.get('version'), message.get('wheres'), message.get('rows'))
+
+    def check(self, force=False):
+        """
+        Drop all the copies if the version in the cache db is not the last one seen
+        """
+        now = time.time()
+        if not force and now - self._checked_at < self._check_interval:
+            return
+
+        self._checked_at = now
+
+        try:
+            version = self._cache_db.get(self.version_key)
+        except Exception as err:
+            logger.error('Failed to check version of {}: {}'.format(self._model.__name__, err))
+            return
+
+        with self._lock:
+            if version != self.version:
+                if len(self._entries) > 0:
+                    logger.warning('Version of {} changed from {} to {} without messages, '
+                                   'drop all the local results'.format(self._model.__name__, self.version, version))
+
+                self._entries.clear()
+                self.version = version
+
+    def _apply(self, version, wheres, rows=None):
+        with self._lock:
+            if not wheres or version is None or self.version is None or version > self.version + 1:
+                # Some messages are missed, or all the copies are invalidated
+                self._entries.clear()
+            else:
+                is_related_to_any = make_related_predicate(wheres, rows)
+                self._entries.delete_if(lambda entry: is_related_to_any(entry[0]))
+
+            if version is None or self.version is None or version > self.version:
+                self.version = version
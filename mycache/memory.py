@@ -0,0 +1,265 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : memory.py
+# Date   : 2017-09-14 10-20
+# Version: 0.0.1
+# Description: thread-safe in-process cache db with expiry and a memory cap.
+
+import heapq
+import logging
+import pickle
+import time
+from collections import OrderedDict
+from threading import Lock, RLock
+from weakref import WeakValueDictionary
+
+from werkzeug.contrib.cache import BaseCache
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+class _Stripe(object):
+    def __init__(self):
+        self.lock = RLock()
+        # key -> (expiry time, pickled value), least recently used first
+        self.entries = OrderedDict()
+
+
+class _NamedLock(object):
+    def __init__(self, lock, blocking_timeout=None):
+        self._lock = lock
+        self._blocking_timeout = blocking_timeout
+
+    def acquire(self):
+        return self._lock.acquire(timeout=-1 if self._blocking_timeout is None else self._blocking_timeout)
+
+    def release(self):
+        self._lock.release()
+
+
+class MemoryCache(BaseCache):
+    """
+    Cache db of the current process, a replacement of Redis for single-process jobs and tests.
+
+    1. Keys are spread over `stripes` dicts, each guarded by its own lock, so that threads
+       accessing different keys rarely wait for each other;
+    2. Expiry times are kept in a heap, expired entries are purged from the top of the heap
+       on writes, never by scanning all the entries;
+    3. Values are pickled like the other backends, callers never share mutable objects and
+       the size of each entry is known. Once `max_entries` or `max_bytes` is exceeded, the least
+       recently used entries of each stripe are evicted in turn.
+
+    :param default_timeout: int, default timeout in seconds, 0 means never expire
+    :param max_entries: int, None means unlimited
+    :param max_bytes: int, max total size of the pickled values, None means unlimited
+    :param stripes: int, number of the lock stripes
+    """
+
+    def __init__(self, default_timeout=300, max_entries=None, max_bytes=None, stripes=16):
+        super().__init__(default_timeout)
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._heap = []
+        self._heap_lock = Lock()
+        self._size_lock = Lock()
+        self._count = 0
+        self._bytes = 0
+        self._next_victim = 0
+        self._locks = WeakValueDictionary()
+        self._locks_guard = Lock()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size_in_bytes(self):
+        return self._bytes
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key):
+        stripe = self._stripe(key)
+
+        with stripe.lock:
+            entry = stripe.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, data = entry
+            if expires and expires <= time.time():
+                self._remove(stripe, key)
+                return None
+
+            stripe.entries.move_to_end(key)
+
+        return pickle.loads(data)
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def has(self, key):
+        stripe = self._stripe(key)
+
+        with stripe.lock:
+            entry = stripe.entries.get(key)
+            return entry is not None and (not entry[0] or entry[0] > time.time())
+
+    def set(self, key, value, timeout=None):
+        stripe = self._stripe(key)
+
+        with stripe.lock:
+            self._store(stripe, key, value, timeout)
+
+        self._purge()
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        stripe = self._stripe(key)
+
+        with stripe.lock:
+            if self.has(key):
+                return False
+
+            self._store(stripe, key, value, timeout)
+
+        self._purge()
+        return True
+
+    def delete(self, key):
+        stripe = self._stripe(key)
+
+        with stripe.lock:
+            return self._remove(stripe, key)
+
+    def delete_many(self, *keys):
+        return all([self.delete(key) for key in keys])
+
+    def clear(self):
+        for stripe in self._stripes:
+            with stripe.lock:
+                for key in list(stripe.entries):
+                    self._remove(stripe, key)
+
+        with self._heap_lock:
+            self._heap = []
+
+        return True
+
+    def inc(self, key, delta=1):
+        stripe = self._stripe(key)
+
+        with stripe.lock:
+            value = (self.get(key) or 0) + delta
+            self._store(stripe, key, value, self._remaining(stripe, key))
+
+        self._purge()
+        return value
+
+    def lock(self, name, timeout=None, sleep=0.1, blocking_timeout=None, **kwargs):
+        """
+        Named lock of the current process, the `timeout` is ignored as the holder can't crash alone
+        """
+        with self._locks_guard:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = Lock()
+
+        return _NamedLock(lock, blocking_timeout)
+
+    def _store(self, stripe, key, value, timeout):
+        """
+        Called with the lock of the stripe held, other stripes must not be locked here
+        """
+        timeout = self._normalize_timeout(timeout)
+        expires = time.time() + timeout if timeout > 0 else 0
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        self._remove(stripe, key)
+        stripe.entries[key] = (expires, data)
+        self._resize(1, len(data))
+
+        if expires:
+            with self._heap_lock:
+                heapq.heappush(self._heap, (expires, key))
+
+    def _remaining(self, stripe, key):
+        entry = stripe.entries.get(key)
+        if entry is None or not entry[0]:
+            return None if entry is None else 0
+
+        return max(1, int(entry[0] - time.time()))
+
+    def _remove(self, stripe, key):
+        entry = stripe.entries.pop(key, None)
+        if entry is None:
+            return False
+
+        self._resize(-1, -len(entry[1]))
+        return True
+
+    def _resize(self, count, size):
+        with self._size_lock:
+            self._count += count
+            self._bytes += size
+
+    def _purge(self):
+        """
+        Remove the expired entries from the top of the heap, then evict entries if over the limits
+        """
+        now = time.time()
+
+        while True:
+            with self._heap_lock:
+                if not self._heap or self._heap[0][0] > now:
+                    break
+
+                expires, key = heapq.heappop(self._heap)
+
+            stripe = self._stripe(key)
+            with stripe.lock:
+                entry = stripe.entries.get(key)
+                # The key may have been set again with another expiry time
+                if entry is not None and entry[0] == expires:
+                    self._remove(stripe, key)
+
+        with self._heap_lock:
+            # Outdated items of the keys set again, rebuild the heap once they dominate
+            if len(self._heap) > 2 * self._count + 1024:
+                self._heap = [(e, k) for e, k in self._heap if self._is_current(k, e)]
+                heapq.heapify(self._heap)
+
+        evicted = 0
+        while self._is_over_limits():
+            stripe = self._stripes[self._next_victim % len(self._stripes)]
+            self._next_victim += 1
+
+            with stripe.lock:
+                if stripe.entries:
+                    self._remove(stripe, next(iter(stripe.entries)))
+                    evicted += 1
+
+        if evicted:
+            logger.debug('Evict {} entries from memory cache'.format(evicted))
+
+    def _is_current(self, key, expires):
+        entry = self._stripe(key).entries.get(key)
+        return entry is not None and entry[0] == expires
+
+    def _is_over_limits(self):
+        if self._count <= 0:
+            return False
+
+        return bool((self._max_entries and self._count > self._max_entries) or
+                    (self._max_bytes and self._bytes > self._max_bytes))
@@ -6,23 +6,41 @@
 # Version: 0.0.1
 # Description: description of this file.
 
+import asyncio
 import inspect
 import logging
 import pickle
 
-import hashlib
 import os
-from collections import ChainMap
-from threading import RLock
-from functools import wraps
+import re
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from string import Formatter
+from functools import partial, wraps
 from werkzeug.contrib.cache import FileSystemCache, RedisCache
 
+from mycache.aio import ExecutorBackend, SharedTasks
+from mycache.filecache import ShardedFileCache
+from mycache.flight import SingleFlight, load_with_lock
+from mycache.local import LocalCache
+from mycache.memory import MemoryCache
+from mycache.registry import REGISTRY, make_instance_id
+from mycache.serializer import get_serializer
+from mycache.stale import REFRESH_POOL, CacheEntry, is_stale, make_entry
+from mycache.stats import METRICS, output_scope
+from mycache.utils import get_hash_method, lock
+
 logger = logging.getLogger(__name__)
 
 __version__ = '0.0.1'
 __author__ = 'Chris'
 
 
+# Known empty output (None or one of `ignore_outputs`), cached for `negative_timeout` seconds
+NegativeEntry = namedtuple('NegativeEntry', ['value'])
+
+
 class Params(dict):
     def __getitem__(self, item):
         return super().__getitem__(item)
@@ -32,7 +50,9 @@ class Params(dict):
 
 
 def output_cache(enable=True, timeout=60, ignore_outputs=None, custom_cache_key=None, cache_type='redis',
-                 **cache_options):
+                 local_cache_size=0, local_cache_bytes=None, local_cache_timeout=None, key_hasher='md5',
+                 single_flight=False, single_flight_timeout=10, stale_timeout=None, early_expiration_beta=0,
+                 refresh_pool=None, serializer=None, negative_timeout=None, **cache_options):
     """
     A cache wrapper that caches the output of a function to Redis or File System.
 
@@ -60,16 +80,83 @@ def output_cache(enable=True, timeout=60, ignore_outputs=None, custom_cache_key=
     Call function_spam with an extra param `refresh_cache_now=True`
     y = function_spam(10, 20, refresh_cache_now=True)
 
+    5. With an in-process cache in front of Redis:
+    Hot keys are served from a bounded LRU cache in the current process,
+    the Redis cache is only accessed when missed.
+
+    @output_cache(timeout=120, local_cache_size=1000, local_cache_bytes=10 * 1024 * 1024, local_cache_timeout=10)
+    def function_eggs(x):
+        pass
+
+    6. Coalesce concurrent misses, only one caller computes the output of a key:
+    @output_cache(timeout=120, single_flight=True, single_flight_timeout=5)
+    def function_ham(x):
+        pass
+
+    7. Stale-while-revalidate, outputs older than 60 seconds are refreshed in background:
+    @output_cache(timeout=600, stale_timeout=60, early_expiration_beta=1.0)
+    def function_sausage(x):
+        pass
+
+    8. Coroutine functions are supported as well, the cache is accessed in a thread pool
+    without blocking the event loop, concurrent awaits of the same key share one computation:
+    @output_cache(timeout=120)
+    async def function_bacon(x):
+        pass
+
+    9. Resolve many calls with one multi-get, only the missed ones are computed
+    (on a thread pool if `max_workers` > 1) and written back with one multi-set.
+    Each call is a tuple of positional arguments, a dict of keyword arguments
+    or the only positional argument, outputs are returned in the input order:
+    users = function_foo.many([1, 2, 3], max_workers=4)
+    items = function_foo.many([(1, 'a'), {'x': 2, 'y': 'b'}])
+    users = await function_bacon.many([1, 2, 3])
+
+    10. Compact encoding, models are stored as field values, large outputs are compressed:
+    @output_cache(timeout=120, serializer='rows_zlib')
+    def function_spam_and_eggs(x):
+        pass
+
+    11. Remember the empty outputs for a shorter time, e.g. users not found:
+    @output_cache(timeout=600, negative_timeout=30)
+    def function_ham_and_eggs(user_id):
+        return None
+
     :param enable: bool, whether to enable cache or not
     :param timeout: int, default timeout in seconds
     :param ignore_outputs: list, ignored outputs won't be cached
     :param custom_cache_key: str template, define your own cache key
-    :param cache_type: str, support **Redis** cache and **FileSystem** cache
-    :param cache_options: dict, keyword arguments will be passed to `werkzeug.contrib.cache.RedisCache`
-     or `werkzeug.contrib.cache.FileSystemCache` object.
+    :param cache_type: str, `redis`, `file` (sharded file cache shared by the processes of a host),
+     `memory` (cache of the current process) or `filesystem` (werkzeug `FileSystemCache`,
+     used by `file` in the old versions)
+    :param local_cache_size: int, max entries of the in-process cache, 0 disables it
+    :param local_cache_bytes: int, max total size in bytes of the in-process cache, None means unlimited
+    :param local_cache_timeout: int, timeout in seconds of the in-process cache, never longer than `timeout`
+    :param key_hasher: str or callable, hash method of the default cache key, see `mycache.utils.HASH_METHODS`,
+     keep the default `md5` to reuse the keys generated by the old versions
+    :param single_flight: bool, coalesce concurrent misses on the same key, only one thread per process
+     and one process (if the cache db has a `lock` method, e.g. Redis) computes the output.
+     Coroutine functions always share the computation within the event loop, this option is ignored
+    :param single_flight_timeout: int, max seconds to wait for the leader before computing the output locally
+    :param stale_timeout: int, soft timeout in seconds, `timeout` is the hard one. A stale output is still returned
+     but recomputed in background, outputs older than `timeout` are recomputed synchronously
+    :param early_expiration_beta: float, refresh stale outputs a bit earlier at random, 1.0 is a good start,
+     0 disables it
+    :param refresh_pool: `mycache.stale.RefreshPool` used for background refreshing, a shared pool by default
+    :param serializer: str or `mycache.serializer.Serializer`, encodes the outputs before sending them to the
+     cache db (e.g. `pickle_zlib`, see `mycache.serializer.SERIALIZERS`), None stores them as they are.
+     Outputs stored without it are returned as they are, so it's safe to switch it on a running system,
+     but the encoded outputs are not decoded once it's switched off, change the keys or clear the cache then
+    :param negative_timeout: int, cache the empty outputs (None or one of `ignore_outputs`) for
+     `negative_timeout` seconds as well, usually shorter than `timeout`. None disables it, empty outputs
+     are always recomputed then
+    :param cache_options: dict, keyword arguments will be passed to the cache object of `cache_type`
             1. RedisCache(self, host='localhost', port=6379, password=None, db=0,
                         default_timeout=300, key_prefix=None, **kwargs)
-            2. FileSystemCache(cache_dir, threshold=500, default_timeout=300, mode=0o600)
+            2. ShardedFileCache(cache_dir, threshold=500, default_timeout=300, mode=0o600, max_bytes=None,
+                                shard_depth=2, mmap_threshold=64 * 1024)
+            3. MemoryCache(default_timeout=300, max_entries=None, max_bytes=None, stripes=16)
+            4. FileSystemCache(cache_dir, threshold=500, default_timeout=300, mode=0o600)
     :return: output of the wrapped function
     """
     try:
@@ -77,94 +164,585 @@ def output_cache(enable=True, timeout=60, ignore_outputs=None, custom_cache_key=
     except:
         ignore_outputs = list()
 
-    def make_cache_key(func, *args, **kwargs):
+    _check_cache_type(cache_type)
+    key_hasher = get_hash_method(key_hasher)
+
+    local_cache = None
+    if local_cache_size > 0:
+        if timeout:
+            local_cache_timeout = min(local_cache_timeout or timeout, timeout)
+
+        local_cache = LocalCache(local_cache_size, local_cache_bytes, local_cache_timeout or 0)
+
+    # Negative entries never live longer in the local cache than in the cache db
+    local_negative_timeout = min([x for x in (local_cache_timeout, timeout, negative_timeout) if x] or [0])
+
+    flight = SingleFlight() if single_flight else None
+
+    if stale_timeout and timeout and stale_timeout >= timeout:
+        raise ValueError('`stale_timeout` must be less than `timeout`, got {} >= {}'.format(stale_timeout, timeout))
+
+    refresh_pool = refresh_pool or REFRESH_POOL
+
+    serializer = get_serializer(serializer)
+    dumps = serializer.dumps if serializer is not None else (lambda stored: stored)
+    loads = serializer.loads if serializer is not None else (lambda data: data)
+
+    cache_instance_id = make_instance_id(cache_type, **cache_options)
+
+    def get_cache_db():
+        return _get_cache_instance(cache_instance_id, cache_type, cache_options)
+
+    # Helpers shared by the sync and the async wrappers, only the cache db accesses differ
+
+    def local_load_many(keys):
         """
-        Warning: in order to generate a default unique key for each object,
-        the method `__repr__` or `__str__` must be overridden
-        to identify the object. Still, custom cache key template can be used to
-        replace the default cache key.
+        :return: dict, cache key -> stored object of the keys found in the local cache, and list of the missing keys
         """
+        found = dict()
 
-        if custom_cache_key:
-            # params = Params(ChainMap(inspect.signature(func).parameters, kwargs))
-            # 2017.07.17: fix custom cache key generation error!
-            params = Params(
-                ChainMap(dict(zip(list(inspect.signature(func).parameters.keys())[:len(args)], args)), kwargs))
-            key = custom_cache_key.format(**params)
-            # remove `None` field
-            key = '_'.join(f.strip() for f in key.split('_') if f.strip() != 'None')
-            return key
+        if local_cache is not None:
+            for key in keys:
+                stored = local_cache.get(key)
+                if stored is not None:
+                    found[key] = stored
 
-        mod = inspect.getmodule(func)
-        name = '{}.{}.{}'.format(cache_type, os.path.splitext(os.path.split(mod.__file__)[-1])[0], func.__name__)
-        items = tuple(str(x) for x in args) + tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+        return found, [key for key in keys if key not in found]
 
-        try:
-            hash_key = hashlib.md5(pickle.dumps(items)).hexdigest()
-            return '{}_{}'.format(name, hash_key)
-        except (pickle.PickleError, pickle.PicklingError):
-            raise ValueError('Arguments of the function `{}` must be serializable'.format(func.__name__))
+    def decode_many(keys, data, scope=None):
+        """
+        Decode the objects read from the cache db, keep the hit ones in the local cache
 
-    def get_cache_db():
-        return _create_cache(cache_type, **cache_options)
+        :return: dict, cache key -> stored object of the hit keys
+        """
+        return fill_local_cache(keys, [loads(record_read(scope, x)) for x in data])
+
+    def fill_local_cache(keys, outputs):
+        found = dict()
+        for key, stored in zip(keys, outputs):
+            if stored is not None:
+                found[key] = stored
+
+                if local_cache is not None:
+                    local_cache.set(key, stored, local_timeout(stored))
+
+        return found
+
+    def local_timeout(stored):
+        return local_negative_timeout if isinstance(stored, NegativeEntry) else None
+
+    def db_timeout(stored):
+        return negative_timeout if isinstance(stored, NegativeEntry) else timeout
+
+    def unwrap(stored):
+        """
+        :return: the output (a `NegativeEntry` for the known empty outputs) of the stored object,
+         and whether it's stale and should be refreshed
+        """
+        if isinstance(stored, CacheEntry):
+            return stored.value, is_stale(stored, early_expiration_beta)
+
+        return stored, False
+
+    def split_found(found, pending):
+        """
+        Pop the hit calls of `many` from `pending`
+
+        :return: dict, cache key -> output of the hit keys, and dict, cache key -> (args, kwargs) of the stale ones
+        """
+        outputs = dict()
+        stale = dict()
+
+        for key, stored in found.items():
+            call = pending.pop(key)
+            output, is_stale_output = unwrap(stored)
+            outputs[key] = resolve(output)
+
+            if is_stale_output:
+                stale[key] = call
+
+        return outputs, stale
+
+    def encode(output, delta=0):
+        """
+        :return: object to be stored, None if the output should not be cached
+        """
+        if output is None or output in ignore_outputs:
+            if negative_timeout is not None:
+                return NegativeEntry(output)
+
+            if output is not None:
+                logger.warning('Output {} is in `ignored outputs`, ignore it'.format(output))
+            return None
+
+        return make_entry(output, stale_timeout, delta) if stale_timeout else output
+
+    def encode_many(outputs):
+        """
+        :param outputs: list of (cache key, output, seconds to compute it)
+        :return: list of (timeout, {cache key: object to be stored}, {cache key: encoded object}),
+         negative entries have their own timeout
+        """
+        groups = dict()
+        for key, output, delta in outputs:
+            stored = encode(output, delta)
+            if stored is not None:
+                groups.setdefault(db_timeout(stored), dict())[key] = stored
+
+        return [(expires, mapping, {k: dumps(v) for k, v in mapping.items()}) for expires, mapping in groups.items()]
+
+    def stored_many(batches, total, scope=None):
+        """
+        Keep the objects written to the cache db in the local cache as well, and record the writes
+
+        :param batches: list of (timeout, {cache key: object to be stored}, {cache key: encoded object})
+        :param total: int, number of the outputs, stored or not
+        """
+        dumped = []
+        negatives = 0
+
+        for _, mapping, data in batches:
+            fill_local_cache(list(mapping), list(mapping.values()))
+            dumped.extend(data.values())
+            negatives += sum(isinstance(x, NegativeEntry) for x in mapping.values())
+
+        record_write(scope, dumped, total - len(dumped), negatives)
+
+    def record_read(scope, data):
+        if scope is not None and serializer is not None and METRICS.enabled and isinstance(data, bytes):
+            METRICS.incr(scope, 'bytes_read', len(data))
+
+        return data
+
+    def record_write(scope, dumped, skipped=0, negatives=0):
+        """
+        :param dumped: list of the encoded outputs sent to the cache db
+        :param negatives: int, how many of them are negative entries
+        """
+        if scope is None or not METRICS.enabled:
+            return
+
+        METRICS.incr(scope, 'sets', len(dumped))
+        if skipped:
+            METRICS.incr(scope, 'skipped_sets', skipped)
+        if negatives:
+            METRICS.incr(scope, 'negative_misses', negatives)
+
+        if serializer is not None:
+            METRICS.incr(scope, 'bytes_written', sum(len(x) for x in dumped))
+
+    def start_lookup(scope):
+        """
+        :return: start time of the lookup, None if the metrics are disabled (`scope` is None), not measured then
+        """
+        return time.time() if scope is not None else None
+
+    def record_lookup(scope, stored, start):
+        if scope is not None:
+            METRICS.lookup(scope, stored is not None, time.time() - start, isinstance(stored, NegativeEntry))
+
+    def record_lookups(scope, found, misses, start):
+        """
+        Record the lookups of `many`
+
+        :param found: dict, cache key -> stored object of the hit keys
+        """
+        if scope is None:
+            return
+
+        METRICS.incr(scope, 'hits', len(found))
+        METRICS.incr(scope, 'misses', misses)
+        METRICS.incr(scope, 'negative_hits', sum(isinstance(x, NegativeEntry) for x in found.values()))
+        METRICS.observe(scope, 'get', time.time() - start)
+
+    def record_load(func, delta):
+        """
+        :return: metrics scope of the function, None if the metrics are disabled
+        """
+        if not METRICS.enabled:
+            return None
+
+        scope = output_scope(func)
+        METRICS.observe(scope, 'load', delta)
+        return scope
+
+    def record_loads(scope, computed):
+        if scope is None:
+            return
+
+        for _, _, delta in computed:
+            METRICS.observe(scope, 'load', delta)
+
+    # Sync cache db accesses
+
+    def cache_load(key, scope=None):
+        found, missing = local_load_many([key])
+        if missing:
+            logger.debug('Load result from %s cache with key `%s`', cache_type, key)
+            found = decode_many(missing, [get_cache_db().get(key)], scope)
+
+        return found.get(key)
+
+    def cache_load_many(keys, scope=None):
+        """
+        :return: dict, cache key -> stored object of the hit keys
+        """
+        found, missing = local_load_many(keys)
+        if missing:
+            logger.debug('Load %s results from %s cache', len(missing), cache_type)
+            found.update(decode_many(missing, get_cache_db().get_many(*missing), scope))
+
+        return found
 
     def cache_get(key):
-        logger.debug('Load result from {} cache with key `{}`'.format(cache_type, key))
-        cache_db = get_cache_db()
-        return cache_db.get(key)
+        """
+        :return: the cached output, a `NegativeEntry` for the known empty outputs, None if missed
+        """
+        return unwrap(cache_load(key))[0]
+
+    def cache_set(key, output, delta=0, scope=None):
+        batches = encode_many([(key, output, delta)])
+        for expires, _, data in batches:
+            logger.debug('Dump output result to %s cache with key `%s`', cache_type, key)
+            get_cache_db().set(key, data[key], expires)
+
+        stored_many(batches, 1, scope)
+        return output
+
+    def cache_set_many(outputs, scope=None):
+        batches = encode_many(outputs)
+        for expires, _, data in batches:
+            logger.debug('Dump %s output results to %s cache', len(data), cache_type)
+            get_cache_db().set_many(data, expires)
+
+        stored_many(batches, len(outputs), scope)
+
+    def compute(key, func, args, kwargs):
+        start = time.time()
+        output = func(*args, **kwargs)
+        delta = time.time() - start
+
+        return cache_set(key, output, delta, record_load(func, delta))
+
+    def compute_once(key, func, args, kwargs):
+        return load_with_lock(get_cache_db(), key, cache_get, partial(compute, key, func, args, kwargs),
+                              single_flight_timeout)
+
+    # Async cache db accesses, mirror the sync ones above
 
-    def cache_set(key, output):
-        if output is None:
-            return output
+    async_backend = ExecutorBackend(get_cache_db)
+    shared_tasks = SharedTasks()
 
-        if output in ignore_outputs:
-            logger.warning('Output {} is in `ignored outputs`, ignore it'.format(output))
-            return output
+    async def async_cache_load(key, scope=None):
+        found, missing = local_load_many([key])
+        if missing:
+            logger.debug('Load result from %s cache with key `%s`', cache_type, key)
+            found = decode_many(missing, [await async_backend.get(key)], scope)
 
-        logger.debug('Dump output result to {} cache with key `{}`'.format(cache_type, key))
-        cache_db = get_cache_db()
-        cache_db.set(key, output, timeout)
+        return found.get(key)
 
+    async def async_cache_load_many(keys, scope=None):
+        found, missing = local_load_many(keys)
+        if missing:
+            logger.debug('Load %s results from %s cache', len(missing), cache_type)
+            found.update(decode_many(missing, await async_backend.get_many(*missing), scope))
+
+        return found
+
+    async def async_cache_set(key, output, delta=0, scope=None):
+        batches = encode_many([(key, output, delta)])
+        for expires, _, data in batches:
+            logger.debug('Dump output result to %s cache with key `%s`', cache_type, key)
+            await async_backend.set(key, data[key], expires)
+
+        stored_many(batches, 1, scope)
         return output
 
+    async def async_cache_set_many(outputs, scope=None):
+        batches = encode_many(outputs)
+        for expires, _, data in batches:
+            logger.debug('Dump %s output results to %s cache', len(data), cache_type)
+            await async_backend.set_many(data, expires)
+
+        stored_many(batches, len(outputs), scope)
+
+    async def async_compute(key, func, args, kwargs):
+        start = time.time()
+        output = await func(*args, **kwargs)
+        delta = time.time() - start
+
+        return await async_cache_set(key, output, delta, record_load(func, delta))
+
+    def decorate_coroutine_func(func):
+        make_cache_key = _compile_key_builder(func, cache_type, custom_cache_key, key_hasher)
+        scope = output_scope(func)
+
+        @wraps(func)
+        async def inner_wrapper(*args, **kwargs):
+            refresh_cache_now = kwargs.pop('refresh_cache_now', False)
+            cache_key = make_cache_key(args, kwargs)
+
+            if refresh_cache_now is not False:
+                return await async_compute(cache_key, func, args, kwargs)
+
+            stats_scope = scope if METRICS.enabled else None
+            start = start_lookup(stats_scope)
+            cached_obj, stale = unwrap(await async_cache_load(cache_key, stats_scope))
+            record_lookup(stats_scope, cached_obj, start)
+
+            if stale:
+                # Refresh it in background, the task is shared with concurrent misses
+                shared_tasks.run(cache_key, async_compute, cache_key, func, args, kwargs)
+
+            if cached_obj is not None:
+                return resolve(cached_obj)
+
+            # Don't cancel the shared task if only this caller is cancelled
+            return await asyncio.shield(shared_tasks.run(cache_key, async_compute, cache_key, func, args, kwargs))
+
+        async def many(calls, refresh_cache_now=False):
+            """
+            Resolve many calls with one multi-get and one multi-set, see `output_cache`.
+            """
+            keys, pending = _group_calls(make_cache_key, calls)
+            outputs = dict()
+            stats_scope = scope if METRICS.enabled else None
+
+            if refresh_cache_now is False:
+                start = start_lookup(stats_scope)
+                found = await async_cache_load_many(list(pending), stats_scope)
+                record_lookups(stats_scope, found, len(pending) - len(found), start)
+
+                outputs, stale = split_found(found, pending)
+                for key, (args, kwargs) in stale.items():
+                    shared_tasks.run(key, async_compute, key, func, args, kwargs)
+
+            if pending:
+                computed = await asyncio.gather(
+                    *[_async_timed_call(func, key, args, kwargs) for key, (args, kwargs) in pending.items()])
+                record_loads(stats_scope, computed)
+                await async_cache_set_many(computed, stats_scope)
+                outputs.update((key, output) for key, output, _ in computed)
+
+            return [outputs[key] for key in keys]
+
+        inner_wrapper.local_cache = local_cache
+        inner_wrapper.many = many
+        return inner_wrapper
+
     def decorate_func(func):
         if not enable:
             return func
 
+        if inspect.iscoroutinefunction(func):
+            return decorate_coroutine_func(func)
+
+        make_cache_key = _compile_key_builder(func, cache_type, custom_cache_key, key_hasher)
+        scope = output_scope(func)
+
         @wraps(func)
         def inner_wrapper(*args, **kwargs):
             refresh_cache_now = kwargs.pop('refresh_cache_now', False)
-            cache_key = make_cache_key(func, *args, **kwargs)
-            cached_obj = cache_get(cache_key) if refresh_cache_now is False else None
-            return cached_obj if cached_obj is not None else cache_set(cache_key, func(*args, **kwargs))
-
+            cache_key = make_cache_key(args, kwargs)
+
+            if refresh_cache_now is False:
+                stats_scope = scope if METRICS.enabled else None
+                start = start_lookup(stats_scope)
+                cached_obj, stale = unwrap(cache_load(cache_key, stats_scope))
+                record_lookup(stats_scope, cached_obj, start)
+
+                if stale:
+                    refresh_pool.submit(cache_key, compute, cache_key, func, args, kwargs)
+
+                if cached_obj is not None:
+                    return resolve(cached_obj)
+
+                if flight is not None:
+                    # The leader of other process may have cached a negative entry
+                    return resolve(flight.do(cache_key, partial(compute_once, cache_key, func, args, kwargs),
+                                             single_flight_timeout))
+
+            return compute(cache_key, func, args, kwargs)
+
+        def many(calls, max_workers=0, refresh_cache_now=False):
+            """
+            Resolve many calls with one multi-get and one multi-set, see `output_cache`.
+            """
+            keys, pending = _group_calls(make_cache_key, calls)
+            outputs = dict()
+            stats_scope = scope if METRICS.enabled else None
+
+            if refresh_cache_now is False:
+                start = start_lookup(stats_scope)
+                found = cache_load_many(list(pending), stats_scope)
+                record_lookups(stats_scope, found, len(pending) - len(found), start)
+
+                outputs, stale = split_found(found, pending)
+                for key, (args, kwargs) in stale.items():
+                    refresh_pool.submit(key, compute, key, func, args, kwargs)
+
+            if pending:
+                computed = _run_calls(func, pending, max_workers)
+                record_loads(stats_scope, computed)
+                cache_set_many(computed, stats_scope)
+                outputs.update((key, output) for key, output, _ in computed)
+
+            return [outputs[key] for key in keys]
+
+        inner_wrapper.local_cache = local_cache
+        inner_wrapper.many = many
         return inner_wrapper
 
     return decorate_func
 
 
-CACHE_INSTANCES = dict()
-ACCESS_LOCK = RLock()
+def resolve(stored):
+    """
+    :return: the original empty output of a negative entry, anything else as it is
+    """
+    return stored.value if isinstance(stored, NegativeEntry) else stored
+
+
+# Shared with `mycache.registry.REGISTRY`
+CACHE_INSTANCES = REGISTRY.instances
 CACHE_TYPE_MAPPING = {
-    'file': FileSystemCache,
+    'file': ShardedFileCache,
+    'filesystem': FileSystemCache,
+    'memory': MemoryCache,
     'redis': RedisCache
 }
 
 
-def _create_cache(cache_type='redis', **cache_options):
+def _compile_key_builder(func, cache_type, custom_cache_key=None, key_hasher=None):
+    """
+    Precompute everything that does not depend on the call, the returned
+    builder only canonicalizes the arguments and hashes them.
+
+    Warning: in order to generate a default unique key for each object,
+    the method `__repr__` or `__str__` must be overridden
+    to identify the object. Still, custom cache key template can be used to
+    replace the default cache key.
+
+    :return: callable, builder(args, kwargs) -> cache key
+    """
+    if custom_cache_key:
+        # 2017.07.17: fix custom cache key generation error!
+        # Positional arguments take precedence over keyword arguments
+        positions = {name: i for i, name in enumerate(inspect.signature(func).parameters.keys())}
+        fields = []
+        for _, field, _, _ in Formatter().parse(custom_cache_key):
+            if field:
+                name = re.split(r'[.\[]', field, 1)[0]
+                if name not in (x for x, _ in fields):
+                    fields.append((name, positions.get(name)))
+
+        def make_custom_cache_key(args, kwargs):
+            params = Params()
+            for name, position in fields:
+                if position is not None and position < len(args):
+                    params[name] = args[position]
+                elif name in kwargs:
+                    params[name] = kwargs[name]
+
+            key = custom_cache_key.format_map(params)
+            # remove `None` field
+            return '_'.join(f.strip() for f in key.split('_') if f.strip() != 'None')
+
+        return make_custom_cache_key
+
+    key_hasher = key_hasher or get_hash_method()
+    mod = inspect.getmodule(func)
+    prefix = '{}.{}.{}_'.format(cache_type, os.path.splitext(os.path.split(mod.__file__)[-1])[0], func.__name__)
+
+    def make_cache_key(args, kwargs):
+        items = tuple(str(x) for x in args) + tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+        return prefix + key_hasher(pickle.dumps(items))
+
+    return make_cache_key
+
+
+def _split_call(call):
+    """
+    A tuple (or list) holds the positional arguments, a dict holds the keyword arguments,
+    anything else is the only positional argument.
+    """
+    if isinstance(call, (tuple, list)):
+        return tuple(call), {}
+
+    if isinstance(call, dict):
+        return (), call
+
+    return (call,), {}
+
+
+def _group_calls(make_cache_key, calls):
+    """
+    :return: cache keys in the input order, and an ordered dict of unique cache key -> (args, kwargs)
+    """
+    keys = []
+    pending = OrderedDict()
+
+    for call in calls:
+        args, kwargs = _split_call(call)
+        key = make_cache_key(args, kwargs)
+        keys.append(key)
+        pending.setdefault(key, (args, kwargs))
+
+    return keys, pending
+
+
+def _timed_call(func, key, args, kwargs):
+    start = time.time()
+    output = func(*args, **kwargs)
+    return key, output, time.time() - start
+
+
+async def _async_timed_call(func, key, args, kwargs):
+    start = time.time()
+    output = await func(*args, **kwargs)
+    return key, output, time.time() - start
+
+
+def _run_calls(func, calls, max_workers=0):
+    """
+    :param calls: dict, cache key -> (args, kwargs)
+    :return: list of (cache key, output, seconds to compute it)
+    """
+    if max_workers > 1 and len(calls) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+            return list(executor.map(lambda item: _timed_call(func, item[0], *item[1]), calls.items()))
+
+    return [_timed_call(func, key, args, kwargs) for key, (args, kwargs) in calls.items()]
+
+
+def _check_cache_type(cache_type):
     if cache_type.lower() not in CACHE_TYPE_MAPPING:
         raise RuntimeError(
             "Unknown cache type `{}`, allowed options are [{}]".format(cache_type, ', '.join(CACHE_TYPE_MAPPING)))
 
-    cache_instance_id = cache_type + '?' + '&'.join('{}={}'.format(k, v) for k, v in sorted(cache_options.items()))
-    logger.info('Cache instance id is `{}`'.format(cache_instance_id))
 
-    # Lock the global variable: `CACHE_INSTANCES`
-    with ACCESS_LOCK:
-        if cache_instance_id not in CACHE_INSTANCES:
-            CACHE_INSTANCES[cache_instance_id] = CACHE_TYPE_MAPPING[cache_type](**cache_options)
+def _make_cache_instance(cache_type, cache_options):
+    cache_class = CACHE_TYPE_MAPPING[cache_type.lower()]
+
+    if cache_class is RedisCache:
+        cache_options = REGISTRY.redis_options(**cache_options)
+
+    instance = cache_class(**cache_options)
+
+    if hasattr(instance, '_client') and not hasattr(instance, 'lock'):
+        # Redis-like cache, so that the single flight works across processes
+        instance.lock = partial(lock, instance)
 
-        return CACHE_INSTANCES[cache_instance_id]
+    return instance
+
+
+def _get_cache_instance(cache_instance_id, cache_type, cache_options):
+    return REGISTRY.get(cache_instance_id, _make_cache_instance, cache_type, cache_options)
+
+
+def _create_cache(cache_type='redis', **cache_options):
+    _check_cache_type(cache_type)
+    return _get_cache_instance(make_instance_id(cache_type, **cache_options), cache_type, cache_options)
 
 
 if __name__ == '__main__':
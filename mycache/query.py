@@ -7,17 +7,36 @@
 # Description: description of this file.
 
 import logging
+import random
+import time
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from dataobj.manager import DataObjectsManager
-from mycache.utils import camel_to_underscore, get_query_fingerprint
+from mycache.local import LocalCache
+from mycache.localquery import LocalQueryCache
+from mycache.registry import REGISTRY
+from mycache.serializer import get_serializer
+from mycache.stats import METRICS, query_scope
+from mycache.tracker import canonical_where, make_tracker_store
+from mycache.transaction import get_transaction
+from mycache.utils import camel_to_underscore, get_query_fingerprint, make_compact_key
 
 logger = logging.getLogger(__name__)
 
 __version__ = '0.0.1'
 __author__ = 'Chris'
 
+# Local copies are checked against the conditions of at most these rows, all are dropped otherwise
+MAX_LOCAL_INVALIDATION_ROWS = 100
+
+# Compact key -> readable key, only kept for the models with `Meta.cache_key_debug`
+KEY_NAMES = LocalCache(max_entries=10000, default_timeout=0)
+
+# An old row needed but failed to load, all the conditions with lookups are invalidated then
+UNKNOWN_ROW = object()
+
 
 def query_cache(model):
     """
@@ -62,70 +81,287 @@ class DataObjectsManagerWithCache(DataObjectsManager):
             raise RuntimeError("Cache db factory is not defined yet")
 
         assert callable(factory), 'Expected a callable factory, not {}'.format(factory)
-        return factory()
+
+        if getattr(self._model.Meta, 'reuse_cache_db', True) is False:
+            return factory()
+
+        # Call the factory only once, the cache dbs with the same configuration are shared
+        return REGISTRY.get(('model', self._model, factory), self._resolve_cache_db, factory)
+
+    @staticmethod
+    def _resolve_cache_db(factory):
+        return REGISTRY.add(factory())
+
+    @property
+    def local_cache(self):
+        """
+        Process-local copies of the query results (see `mycache.localquery.LocalQueryCache`),
+        None if `Meta.cache_local_size` is not set.
+
+        class Meta:
+            cache_local_size = 1000           # max entries
+            cache_local_bytes = None          # optional, max total size in bytes
+            cache_local_timeout = 60          # optional, seconds each copy lives
+            cache_local_check_interval = 1    # optional, seconds between the version checks
+            cache_broadcast_factory = lambda: BROADCAST  # optional, `mycache.broadcast.Broadcast`
+                                                         # shared by the models, e.g. `RedisBroadcast`
+        """
+        if not getattr(getattr(self._model, 'Meta', None), 'cache_local_size', 0):
+            return None
+
+        return REGISTRY.get(('local_query', self._model), self._make_local_cache)
+
+    def _make_local_cache(self):
+        meta = self._model.Meta
+        factory = getattr(meta, 'cache_broadcast_factory', None)
+
+        return LocalQueryCache(self._model, self.cache_db, factory() if factory is not None else None,
+                               meta.cache_local_size, getattr(meta, 'cache_local_bytes', None),
+                               getattr(meta, 'cache_local_timeout', 60),
+                               getattr(meta, 'cache_local_check_interval', 1))
 
     def update(self, model_instance, conn=None):
-        self._invalidate_related_cache(model_instance, conn)
+        if getattr(getattr(self._model, 'Meta', None), 'cache_normalized', False) is True:
+            return self._update_normalized(model_instance, conn)
+
+        self._invalidate_related_cache(model_instance, conn, self._load_old_instance(model_instance, conn))
         return super().update(model_instance, conn)
 
     def delete(self, model_instance, conn=None):
-        self._invalidate_related_cache(model_instance, conn)
+        self._invalidate_related_cache(model_instance, conn, drop_entity=True)
         return super().delete(model_instance, conn)
 
     def dump(self, model_instance, conn=None):
-        self._invalidate_related_cache(model_instance, conn)
+        # The row may be replaced if the primary key is given, so is the row cached under it
+        self._invalidate_related_cache(model_instance, conn, self._load_old_instance(model_instance, conn),
+                                       drop_entity=True)
         return super().dump(model_instance, conn)
 
+    def bulk_update(self, model_instances, conn=None, batch_size=500):
+        """
+        Update the instances, the related queries of all of them are invalidated in one pass
+        before writing, see `_bulk_write`
+
+        :return: list, result of `update` of each instance
+        """
+        normalized = getattr(getattr(self._model, 'Meta', None), 'cache_normalized', False) is True
+        return self._bulk_write(model_instances, super().update, conn, batch_size, load_old=True,
+                                drop_entity=normalized)
+
+    def bulk_delete(self, model_instances, conn=None, batch_size=500):
+        return self._bulk_write(model_instances, super().delete, conn, batch_size, drop_entity=True)
+
+    def bulk_dump(self, model_instances, conn=None, batch_size=500):
+        return self._bulk_write(model_instances, super().dump, conn, batch_size, load_old=True, drop_entity=True)
+
     def limit(self, how_many, offset=0):
-        self._dont_cache = True
+        """
+        Only the first `Meta.cache_pages` pages are cached, the pages of a condition are tracked
+        along with the condition, so they are invalidated once a row of the condition changes:
+
+        class Meta:
+            cache_pages = 5
+            cache_conditions = {'*': 3600, 'name': 3600}
+
+        Folder.objects.filter(name='foo').order_by('folder_id', descending=True).limit(20, 40)  # cached
+        Folder.objects.filter(name='foo').order_by('folder_id', descending=True).limit(20, 100)  # not cached
+        """
+        if offset + how_many > self._cached_pages * how_many:
+            self._dont_cache = True
+
         return super().limit(how_many, offset)
 
     def order_by(self, *field_names, descending=False):
-        self._dont_cache = True
+        if self._cached_pages <= 0:
+            self._dont_cache = True
+
         return super().order_by(*field_names, descending=descending)
 
-    def all_cache(self):
+    def uncached(self):
         """
-        Complex cache conditions are not supported now in this method.
+        Query the database directly
         """
-        # cache_db = RedisCacheFactory().make_redis_cache('data_objects')
+        self._dont_cache = True
+        return self
 
-        with CacheManager(self._model, self.cache_db) as cache:
-            results = self.all()
+    @property
+    def _cached_pages(self):
+        return getattr(getattr(self._model, 'Meta', None), 'cache_pages', 0) or 0
 
-            for key in self._get_valid_single_cache_keys():
-                logger.debug('All cache with single condition key {}'.format(key))
-                data = defaultdict(list)
+    def all_cache(self, chunk_size=1000, max_workers=1, progress=None):
+        """
+        Warm up the cache of the conditions without lookups, composite ones (e.g. `name+folder_id`) included.
+
+        Rows of each condition are read in chunks ordered by the condition fields (then the primary key),
+        so the rows of a group are adjacent, each group is cached as soon as all its rows are read and
+        written in batches of about `chunk_size` rows. Each chunk starts after the values of the last
+        group (keyset pagination, see `_get_keyset_where`), and a group reaching the end of a chunk
+        is read whole in one more query, so no group is cached with a part of its rows even if the
+        table is written meanwhile. The peak memory is bounded by the chunk size and the largest group,
+        instead of the whole table. The whole table condition `*` is not warmed up,
+        it's cached by the first `all()` query as usual.
+
+        :param chunk_size: int, rows read by each query
+        :param max_workers: int, conditions warmed up in parallel
+        :param progress: callable, called with the `WarmUpProgress` of a condition after each chunk,
+         from the worker threads if `max_workers` > 1
+        :return: list of `WarmUpProgress`, one for each condition
+        """
+        conditions = self._get_warm_up_conditions()
 
-                for item in results:
-                    data[getattr(item, key)].append(item)
+        if max_workers > 1 and len(conditions) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(conditions))) as executor:
+                futures = [executor.submit(self._warm_up, fields, chunk_size, progress) for fields in conditions]
+                return [f.result() for f in futures]
 
-                for value, rows in data.items():
-                    cache.add(self._get_single_query(key, value), *rows)
+        return [self._warm_up(fields, chunk_size, progress) for fields in conditions]
 
     def clear_cache(self):
+        """
+        Discard all the cached queries of the model, with `Meta.cache_generations` it's one write
+        of a new generation, the old entries are left to expire by themselves.
+        """
         # cache_db = RedisCacheFactory().make_redis_cache('data_objects')
         with CacheManager(self._model, self.cache_db) as cache:
             cache.clear()
 
-    def _get_single_query(self, key, value):
+        if self.local_cache is not None:
+            self.local_cache.invalidate([])
+
+    def _warm_up(self, fields, chunk_size, progress=None):
+        stats = WarmUpProgress('+'.join(fields))
+        primary_key = get_primary_key(self._model)
+        # Each row is a group of its own if the primary key is one of the fields
+        unique = primary_key is not None and primary_key in fields
+        keys = [primary_key] if unique else fields
+        order = keys + [primary_key] if primary_key and primary_key not in keys else keys
+        logger.debug('All cache with condition key {}'.format(stats.condition))
+
+        with CacheManager(self._model, self.cache_db) as cache:
+            # Values of the keys of the last group cached, the next chunk starts right after it
+            last_values = None
+            # The next chunk has the same values of the first `level` keys as the last group
+            level = len(keys) - 1
+            pending = 0
+
+            while level >= 0:
+                where = self._get_keyset_where(keys, last_values, level)
+                rows = list(self._order_rows(where, order, chunk_size))
+                complete = len(rows) < chunk_size
+                groups = self._group_rows(keys, rows)
+
+                if groups and not complete and not unique:
+                    # The last group may go on in the next chunk, read it whole in one query
+                    values, _ = groups.pop()
+                    groups.append((values, list(self._order_rows(self._get_group_where(keys, values), order))))
+                    stats.chunks += 1
+
+                for _, group in groups:
+                    values = tuple(getattr(group[0], f) for f in fields)
+                    cache.add(self._get_condition_query(fields, values), *group)
+                    stats.groups += 1
+                    stats.rows += len(group)
+                    pending += len(group)
+
+                if pending >= chunk_size or complete:
+                    cache.flush()
+                    pending = 0
+
+                stats.chunks += 1
+                if progress is not None:
+                    progress(stats)
+
+                if last_values is None and complete:
+                    break
+
+                if groups:
+                    last_values = groups[-1][0]
+
+                # Go on after the last group, or with one key less once the rows with the same
+                # values of the first `level` keys are all read
+                level = level - 1 if complete else len(keys) - 1
+
+        return stats
+
+    def _order_rows(self, where, order, how_many=None):
+        queryset = self.all().uncached()
+        if where:
+            queryset = queryset.filter(**where)
+
+        queryset = queryset.order_by(*order)
+        return queryset.limit(how_many) if how_many is not None else queryset
+
+    @staticmethod
+    def _group_rows(fields, rows):
+        """
+        :return: list of (values of the fields, rows), the rows ordered by the fields are grouped by their values
+        """
+        groups = []
+        for row in rows:
+            values = tuple(getattr(row, f) for f in fields)
+            if not groups or groups[-1][0] != values:
+                groups.append((values, []))
+
+            groups[-1][1].append(row)
+
+        return groups
+
+    @staticmethod
+    def _get_group_where(fields, values):
+        where = {}
+        for field, value in zip(fields, values):
+            if value is None:
+                where[field + '__isnull'] = True
+            else:
+                where[field] = value
+
+        return where
+
+    @classmethod
+    def _get_keyset_where(cls, fields, values, level):
+        """
+        Condition of the rows ordered after the group of `values` (keyset pagination), whose first
+        `level` fields have the same values, i.e. `fields[:level] == values[:level] and
+        fields[level] > values[level]`. NULL is ordered before any other value, as MySQL does.
+
+        Unlike OFFSET, each chunk is an index range scan starting where the last one ended,
+        rows inserted or deleted meanwhile never shift the chunks.
+
+        :param values: values of the fields, None for the first chunk
+        """
+        if values is None:
+            return {}
+
+        where = cls._get_group_where(fields[:level], values[:level])
+        if values[level] is None:
+            where[fields[level] + '__isnull'] = False
+        else:
+            where[fields[level] + '__gt'] = values[level]
+
+        return where
+
+    def _get_condition_query(self, fields, values):
         return {'select': list(self._model.__mappings__.keys()),
-                'where': {key: value},
+                'where': dict(zip(fields, values)),
                 'limit': None,
                 'order_by': None,
                 'descending': False}
 
-    def _get_valid_single_cache_keys(self):
-        valid_cache_keys = []
+    def _get_warm_up_conditions(self):
+        """
+        Conditions whose fields are all model fields, lookups (e.g. `folder_id__lt`) and `*` are excluded
+        """
+        conditions = []
 
         for key in getattr(self._model.Meta, 'cache_conditions', {}):
-            if len(key.split('+')) != 1:
-                continue
+            names = set(x.strip() for x in key.split('+'))
+            # Use the field names of the model, the query fingerprint is sensitive to the string objects
+            fields = sorted(x for x in self._model.__mappings__ if x in names)
 
-            if key in self._model:
-                valid_cache_keys.append(key)
+            if len(fields) == len(names):
+                conditions.append(fields)
 
-        return valid_cache_keys
+        return conditions
 
     def _fetch_results(self):
         if self._dont_cache is True:
@@ -137,16 +373,42 @@ class DataObjectsManagerWithCache(DataObjectsManager):
 
         # cache_db = RedisCacheFactory().make_redis_cache('data_objects')
         # Check Redis/File cache before accessing database
+        local_cache = self.local_cache
+
         with CacheManager(self._model, self.cache_db) as cache:
+            scope = query_scope(self._model, self._query_collector.get('where') or {}) if METRICS.enabled else None
+            start = time.time() if scope is not None else None
+            results = local_key = version = None
+
+            if local_cache is not None:
+                local_key = cache.get_cache_key(self._query_collector, namespaced=False)
+                results = local_cache.get(local_key)
+                # Taken before loading, results loaded during an invalidation are not kept
+                version = local_cache.version
+
+                if results is not None:
+                    if scope is not None:
+                        METRICS.lookup(scope, True, time.time() - start)
+
+                    self._query_results_cache = results
+                    return
+
             results = cache.get(self._query_collector)
 
+            if scope is not None:
+                METRICS.lookup(scope, results is not None, time.time() - start)
+
             if results is None:
                 logger.warning(
                     'Load results from database for model "{}" with query condition "{}"'.format(self._model.__name__,
                                                                                                  self._query_collector[
                                                                                                      'where']))
                 # Fetch results from database and save the results to cache
+                start = time.time() if scope is not None else None
                 super()._fetch_results()
+                if scope is not None:
+                    METRICS.observe(scope, 'load', time.time() - start)
+
                 cache.add(self._query_collector, *list(self._query_results_cache))
             else:
                 logger.info('Load results from cache for model "{}" with condition "{}"'.format(self._model.__name__,
@@ -154,12 +416,247 @@ class DataObjectsManagerWithCache(DataObjectsManager):
                                                                                                     'where']))
                 self._query_results_cache = results
 
-    def _invalidate_related_cache(self, model_instance, conn=None):
-        # cache_db = RedisCacheFactory().make_redis_cache('data_objects')
+            if local_cache is not None:
+                local_cache.set(local_key, self._query_collector.get('where') or {}, self._query_results_cache,
+                                version)
+
+    def _update_normalized(self, model_instance, conn=None):
+        """
+        Rows are cached once under their primary keys, so if none of the condition
+        fields (nor the fields ordering the cached pages) changes, the cached queries
+        (lists of primary keys) are still valid, only the row itself has to be rewritten.
+
+        In a transaction (see `mycache.transaction.DeferredInvalidation`), the row is not
+        rewritten before the commit, it's deleted with the queries after the commit.
+        """
+        old_instance = self._load_old_instance(model_instance, conn)
+        if old_instance is None:
+            unchanged = not self._old_instance_needed()
+        else:
+            unchanged = old_instance is not UNKNOWN_ROW and \
+                not self._condition_fields_changed(old_instance, model_instance) and \
+                not self._ordering_fields_changed(old_instance, model_instance)
+
+        transaction = get_transaction(conn)
+        if transaction is None and unchanged:
+            logger.debug('Condition fields of model "{}" are not changed, '
+                         'rewrite the row only'.format(self._model.__name__))
+
+            # The local copies of the results hold the whole rows
+            if self.local_cache is not None:
+                self.local_cache.invalidate([q['where'] for q in self._get_related_queries(model_instance)],
+                                            [self._get_row(model_instance)])
+        else:
+            self._invalidate_related_cache(model_instance, conn, old_instance, drop_entity=True)
+
+        result = super().update(model_instance, conn)
+
+        if transaction is None:
+            with CacheManager(self._model, self.cache_db) as cache:
+                cache.set_entity(model_instance)
+
+        return result
+
+    def _bulk_write(self, model_instances, write, conn=None, batch_size=500, load_old=False, drop_entity=False):
+        """
+        Writing the instances one by one loads the tracker and sends the deletes once per
+        instance, here the conditions of all the instances are deduplicated and invalidated
+        with one `CacheManager.remove` (or after the commit, see `_invalidate`), then the rows
+        are written `batch_size` at a time.
+
+        :param write: callable, `write(model_instance, conn)` of the parent manager
+        :param load_old: bool, load the rows before writing (`batch_size` per query), so that
+         the queries related to the old values are invalidated as well
+        :param drop_entity: bool, also delete the rows cached under their primary keys
+        """
+        model_instances = list(model_instances)
+        if not model_instances:
+            return []
+
+        old_instances = self._load_old_instances(model_instances, conn, batch_size) if load_old else []
+        unknown = any(x is UNKNOWN_ROW for x in old_instances)
+        instances = model_instances + [x for x in old_instances if x is not UNKNOWN_ROW]
+
+        queries = []
+        seen = set()
+        for query in self._get_related_queries(*instances):
+            where = canonical_where(query['where'])
+            if where not in seen:
+                seen.add(where)
+                queries.append(query)
+
+        rows = None if unknown else [self._get_row(x) for x in instances]
+        self._invalidate(queries, rows, model_instances if drop_entity else (), conn)
+
+        results = []
+        for start in range(0, len(model_instances), batch_size):
+            batch = model_instances[start:start + batch_size]
+            results.extend(write(x, conn) for x in batch)
+            logger.debug('Wrote %s/%s rows of model "%s"', start + len(batch), len(model_instances),
+                         self._model.__name__)
+
+        return results
+
+    def _load_old_instances(self, model_instances, conn=None, batch_size=500):
+        """
+        The rows before writing, not any if they're not needed (see `_old_instance_needed`).
+        The rows cached under the primary keys are used in normalized mode, the others are read
+        through the manager `batch_size` primary keys at a time, `UNKNOWN_ROW` is added for
+        the batches failing to load.
+
+        :param conn: the connection of the writes, the rows are read through `Meta.dao_class`
+         which takes none, the rows written earlier in a `DeferredInvalidation` block are
+         collected with their new values anyway
+        """
+        primary_key = get_primary_key(self._model)
+        if primary_key is None or not self._old_instance_needed():
+            return []
+
+        values = [getattr(x, primary_key, None) for x in model_instances]
+        values = list(OrderedDict.fromkeys(x for x in values if x is not None))
+
+        old_instances = []
         with CacheManager(self._model, self.cache_db) as cache:
-            # Generate queries firstly
-            queries = []
-            for key in getattr(model_instance.Meta, 'cache_conditions', {}):
+            if cache.normalized and values:
+                cached = cache.get_entities(values)
+                old_instances.extend(x for x in cached if x is not None)
+                values = [x for x, instance in zip(values, cached) if instance is None]
+
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            try:
+                old_instances.extend(self.all().uncached().filter(**{primary_key + '__in': batch}))
+            except Exception as err:
+                logger.error('Failed to load the old rows of model "{}": {}'.format(self._model.__name__, err))
+                old_instances.append(UNKNOWN_ROW)
+
+        return old_instances
+
+    def _load_old_instance(self, model_instance, conn=None):
+        """
+        The row before updating, None if there's not any or it's not needed, `UNKNOWN_ROW`
+        if it fails to load, see `_load_old_instances`, one more query before the write
+        """
+        old_instances = self._load_old_instances([model_instance], conn)
+        return old_instances[0] if old_instances else None
+
+    def _old_instance_needed(self):
+        """
+        Whether the cached queries may depend on the old values of the row, not if they're
+        conditioned on nothing but the primary key, which never changes (nor are the pages
+        cached in normalized mode, see `_ordering_fields_changed`)
+        """
+        meta = getattr(self._model, 'Meta', None)
+        fields = {condition.strip().split('__')[0]
+                  for key in getattr(meta, 'cache_conditions', {}) for condition in key.split('+')}
+
+        generations = getattr(meta, 'cache_generations', None)
+        if isinstance(generations, (list, tuple, set)):
+            fields.update(generations)
+
+        if getattr(meta, 'cache_normalized', False) is True and self._cached_pages > 0:
+            return True
+
+        return len(fields - {'*', get_primary_key(self._model)}) > 0
+
+    def _get_row(self, model_instance):
+        """
+        :return: dict, field name -> value, the primary key is left out if it's not assigned
+         yet (e.g. auto increment), so that any condition on it may match
+        """
+        row = {name: getattr(model_instance, name, None) for name in self._model.__mappings__}
+
+        primary_key = get_primary_key(self._model)
+        if primary_key is not None and row.get(primary_key) is None:
+            row.pop(primary_key, None)
+
+        return row
+
+    def _condition_fields_changed(self, old_instance, new_instance):
+        for key in getattr(self._model.Meta, 'cache_conditions', {}):
+            for condition in key.split('+'):
+                field = condition.strip().split('__')[0]
+                if field != '*' and getattr(old_instance, field, None) != getattr(new_instance, field, None):
+                    return True
+
+        return False
+
+    def _ordering_fields_changed(self, old_instance, new_instance):
+        """
+        Whether any changed field orders the cached pages (see `limit`), their order and rows may change
+        """
+        if self._cached_pages <= 0:
+            return False
+
+        changed = [x for x in self._model.__mappings__
+                   if getattr(old_instance, x, None) != getattr(new_instance, x, None)]
+        return len(CacheManager(self._model, self.cache_db).get_ordering_fields(changed)) > 0
+
+    def _invalidate_related_cache(self, model_instance, conn=None, old_instance=None, drop_entity=False):
+        """
+        :param old_instance: the instance before updating, if known, the queries related to
+         the old values are invalidated as well, `UNKNOWN_ROW` invalidates all the conditions with lookups
+        :param drop_entity: bool, also delete the row cached under its primary key (normalized mode)
+
+        Conditions with lookups (e.g. `folder_id__lt`) are only invalidated if the old or
+        the new values of the row satisfy them, see `mycache.tracker.matches`.
+        """
+        # Generate queries firstly
+        if old_instance is UNKNOWN_ROW:
+            queries, rows = self._get_related_queries(model_instance), None
+        else:
+            queries = self._get_related_queries(model_instance, old_instance)
+            rows = [self._get_row(x) for x in (model_instance, old_instance) if x is not None]
+        self._invalidate(queries, rows, [model_instance] if drop_entity else (), conn)
+
+    def _invalidate(self, queries, rows, entity_instances=(), conn=None):
+        """
+        Invalidate the queries now, or after the transaction of `conn` is committed if the
+        writes are in a `mycache.transaction.DeferredInvalidation` block
+
+        :param rows: list of dicts, values of the written rows, None if unknown, every condition
+         with lookups is invalidated then
+        :param entity_instances: instances whose rows cached under the primary keys are
+         deleted as well (normalized mode), the ones without primary keys are skipped
+        """
+        cache = CacheManager(self._model, self.cache_db)
+        entity_keys = []
+        if cache.normalized:
+            primary_key = get_primary_key(self._model)
+            entity_keys = [cache.get_entity_key(x) for x in entity_instances
+                           if getattr(x, primary_key, None) is not None]
+
+        transaction = get_transaction(conn)
+        if transaction is not None:
+            logger.debug('Defer invalidating %s conditions of model "%s"', len(queries), self._model.__name__)
+            transaction.add(self, queries, rows, entity_keys)
+        else:
+            self._remove_related(queries, rows, entity_keys)
+
+    def _remove_related(self, queries, rows, entity_keys=()):
+        with CacheManager(self._model, self.cache_db) as cache:
+            round_trips = cache.remove(*queries, keys=entity_keys, rows=rows)
+            logger.debug('Invalidate %s conditions of %s rows of model "%s" with %s round trips', len(queries),
+                         'unknown' if rows is None else len(rows), self._model.__name__, round_trips)
+
+        if self.local_cache is not None and queries:
+            if rows is not None and len(rows) > MAX_LOCAL_INVALIDATION_ROWS:
+                # Checking the copies against all the rows, in every process, costs more
+                # than loading the results again
+                self.local_cache.invalidate([])
+            else:
+                self.local_cache.invalidate([q['where'] for q in queries], rows)
+
+    def _get_related_queries(self, *model_instances):
+        """
+        :return: list of the queries of each condition with the values of the instances, None is skipped
+        """
+        queries = []
+        for instance in model_instances:
+            if instance is None:
+                continue
+
+            for key in getattr(self._model.Meta, 'cache_conditions', {}):
                 possible_query = self._query_collector.copy()
 
                 where = {}
@@ -168,17 +665,85 @@ class DataObjectsManagerWithCache(DataObjectsManager):
                     if condition == '*':
                         where = {}
                     else:
-                        where[condition] = getattr(model_instance, condition, None)
+                        where[condition] = getattr(instance, condition, None)
 
                 possible_query['where'] = where
                 queries.append(possible_query)
 
-            cache.remove(*queries)
+        return queries
+
+
+class WarmUpProgress(object):
+    """
+    Progress of warming up one condition with `all_cache`
+    """
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.rows = 0
+        self.groups = 0
+        self.chunks = 0
+        self.started_at = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return '<WarmUpProgress {}: {} rows, {} groups, {} chunks, {:.1f} rows/s>'.format(
+            self.condition, self.rows, self.groups, self.chunks, self.rows_per_second)
+
+
+def get_primary_key(model):
+    for name, field in model.__mappings__.items():
+        if getattr(field, 'primary_key', False):
+            return name
+
+    return None
+
+
+class PrimaryKeyList(list):
+    """
+    Primary keys of the query results, stored in normalized mode
+    """
+
+
+def new_generation():
+    """
+    A new generation of a namespace, never equal to an old one even if the old one is
+    evicted or deleted, so that the entries of the old generations are never reachable again
+    """
+    return '{:x}{:04x}'.format(int(time.time() * 1000), random.getrandbits(16))
 
 
 class CacheManager(object):
     """
     Data cache manager
+
+    Generation namespaces (opt-in with `Meta.cache_generations`):
+    the current generations are part of the cache keys, a new generation invalidates
+    every query of the namespace at once, instead of finding and deleting the keys.
+
+    1. `cache_generations = True`, a namespace of the model, `clear_cache` writes a new
+       generation of it, and a namespace of the whole table query `*`;
+    2. `cache_generations = ['folder_id']`, also a namespace of each value of the fields,
+       e.g. all the queries with `folder_id=1`, composite conditions included.
+
+    Queries in the namespaces of `*` or of a field are not tracked at all, writes only
+    delete the generations of the old and new values, new ones are created by the next reads.
+    Reads cost one more request to get the current generations. Generations of the fields
+    expire after the longest condition timeout, the one of the model never expires.
+
+    Compact keys (opt-in with `Meta.cache_compact_keys`): queries are cached under
+    `<prefix>:<digest of the readable key>`, 22 characters after the prefix whatever the
+    values of the conditions are. The prefix is the value of the option if it's a str,
+    the model name otherwise. With `Meta.cache_key_debug = True`, the readable keys are
+    kept in the current process, see `get_readable_key`.
     """
 
     def __init__(self, model, cache_db):
@@ -194,17 +759,65 @@ class CacheManager(object):
         except AttributeError:
             self._condition_timeout_map = {}
 
+        # Normalized mode: rows are cached once under their primary keys,
+        # queries are cached as lists of primary keys
+        self._primary_key = None
+        if getattr(getattr(self._model, 'Meta', None), 'cache_normalized', False) is True:
+            self._primary_key = get_primary_key(self._model)
+            if self._primary_key is None:
+                logger.warning('No primary key found for model "{}", '
+                               'normalized cache is disabled'.format(self._model.__name__))
+
+        self._entity_timeout = getattr(getattr(self._model, 'Meta', None), 'cache_entity_timeout', None) or max(
+            [x for x in self._condition_timeout_map.values() if x] or [0])
+
+        # Encoding of the cached results, stored as they are if None
+        serializer = get_serializer(getattr(getattr(self._model, 'Meta', None), 'cache_serializer', None))
+        self._dumps = serializer.dumps if serializer is not None else (lambda value: value)
+        self._loads = serializer.loads if serializer is not None else (lambda data: data)
+
+        # Fields of the generation namespaces, None if disabled
+        generations = getattr(getattr(self._model, 'Meta', None), 'cache_generations', None)
+        self._generation_fields = None
+        if generations:
+            self._generation_fields = () if generations is True else tuple(generations)
+
+        # Generations used by this manager, the keys of a query never change before it's synced
+        self._generations = dict()
+
+        # Prefix of the compact keys, None if disabled
+        compact_keys = getattr(getattr(self._model, 'Meta', None), 'cache_compact_keys', False)
+        self._key_prefix = None
+        if compact_keys:
+            self._key_prefix = compact_keys if isinstance(compact_keys, str) else camel_to_underscore(model.__name__)
+
+        self._key_debug = getattr(getattr(self._model, 'Meta', None), 'cache_key_debug', False) is True
+
+        # Compact key -> bytes saved by it, for the metrics
+        self._key_savings = dict()
+
+        # Fields ordering the pages to be cached (normalized mode), see `get_ordering_fields`
+        self._ordering_fields = set()
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._records = dict(self._records)
+        self.flush()
 
+    def flush(self):
+        """
+        Sync the records added so far, the manager can still be used afterwards.
+        """
         if len(self._records) == 0:
             return
 
         logger.warning('Sync records with {} items'.format(len(self._records)))
         self.__sync_records()
+        self._records = defaultdict(list)
+        self._timeouts.clear()
+        self._conditions.clear()
+        self._ordering_fields.clear()
 
     def add(self, query, *record_or_records):
         """
@@ -213,6 +826,11 @@ class CacheManager(object):
         :param record_or_records:
         :return:
         """
+        if self.normalized and not self.__selects_all(query):
+            # Can't rebuild the query from the whole rows
+            self.__record_skipped(query)
+            return
+
         key = self.__get_unique_cache_key(query)
         timeout = self.__get_timeout(query)
 
@@ -221,6 +839,12 @@ class CacheManager(object):
             self._timeouts[key] = self.__get_timeout(query)
             self._conditions[key] = query.get('where', {}) or {}
 
+            order_by = query.get('order_by')
+            if self.normalized and order_by:
+                self._ordering_fields.update([order_by] if isinstance(order_by, str) else order_by)
+        else:
+            self.__record_skipped(query)
+
     def has(self, query):
         if not query:
             return False
@@ -231,19 +855,187 @@ class CacheManager(object):
         if not query:
             return None
 
+        if self.normalized and not self.__selects_all(query):
+            return None
+
         key = self.__get_unique_cache_key(query)
-        return self._cache_db.get(key)
+        data = self._cache_db.get(key)
+
+        if METRICS.enabled and isinstance(data, bytes):
+            METRICS.incr(query_scope(self._model, query.get('where') or {}), 'bytes_read', len(data))
+
+        results = self._loads(data)
+
+        if isinstance(results, PrimaryKeyList):
+            return self.__hydrate(results)
+
+        return results
+
+    def get_cache_key(self, query, namespaced=True):
+        """
+        :param namespaced: bool, whether the generations are part of the key, see `Meta.cache_generations`
+        """
+        return self.__get_unique_cache_key(query, namespaced=namespaced)
+
+    @staticmethod
+    def get_readable_key(key):
+        """
+        :return: str, the readable key of a compact key, None if unknown, for debugging only
+         (kept in the current process for the models with `Meta.cache_key_debug`)
+        """
+        return KEY_NAMES.get(key)
+
+    def remove(self, *queries, keys=(), rows=None):
+        """
+        Stop tracking related queries in Redis, all the related keys are deleted in one batch
+
+        :param keys: other keys to be deleted in the same batch
+        :param rows: list of dicts, values of the written rows, see `mycache.tracker.is_related`
+        :return: requests sent to the cache db
+        """
+        round_trips = 0
+
+        if self.generational:
+            names = []
+            seen = set()
+            tracked = []
+            for query in queries:
+                # Renew the namespaces of the query except the model's
+                related = self.get_generation_names(query.get('where') or {})[1:]
+                if related:
+                    names.extend(x for x in related if x not in seen)
+                    seen.update(related)
+                else:
+                    tracked.append(query)
+
+            round_trips += self.renew_generations(names)
+            queries = tracked
+
+            if not queries and not keys:
+                return round_trips
+
+        with self.__tracker() as tracker:
+            tracker.discard_many([q.get('where', {}) for q in queries], keys, rows)
+
+        return round_trips + tracker.round_trips
+
+    @property
+    def normalized(self):
+        return self._primary_key is not None
+
+    def get_entity_key(self, instance_or_pk):
+        pk = getattr(instance_or_pk, self._primary_key, instance_or_pk)
+        return '{}_pk_{}'.format(camel_to_underscore(self._model.__name__), pk)
 
-    def remove(self, *queries):
+    def get_entity(self, instance_or_pk):
+        if not self.normalized:
+            return None
+
+        return self._loads(self._cache_db.get(self.get_entity_key(instance_or_pk)))
+
+    def get_entities(self, primary_keys):
         """
-        Stop tracking related queries in Redis
+        :return: list, the row cached under each primary key, None if it's not cached
         """
-        with QueryTracker(self._model, self._cache_db) as tracker:
-            for q in queries:
-                tracker.discard(q.get('where', {}))
+        if not self.normalized or not primary_keys:
+            return [None] * len(primary_keys)
+
+        return [self._loads(x) for x in self._cache_db.get_many(*[self.get_entity_key(pk) for pk in primary_keys])]
+
+    def set_entity(self, instance):
+        if not self.normalized or getattr(instance, self._primary_key, None) is None:
+            return False
+
+        return self._cache_db.set(self.get_entity_key(instance), self._dumps(instance), self._entity_timeout)
+
+    def get_ordering_key(self, field):
+        return '{}_ordering_{}'.format(camel_to_underscore(self._model.__name__), field)
+
+    def get_ordering_fields(self, fields):
+        """
+        Fields ordering any cached page (normalized mode), changing their values may change the order
+        and the rows of the pages, the lists of primary keys are not valid any more then
+
+        :return: list, the ones of `fields`
+        """
+        if not self.normalized or not fields:
+            return []
+
+        markers = self._cache_db.get_many(*[self.get_ordering_key(x) for x in fields])
+        return [field for field, marker in zip(fields, markers) if marker is not None]
+
+    @property
+    def generational(self):
+        return self._generation_fields is not None
+
+    def get_generation_names(self, where):
+        """
+        Names of the generations in the keys of the condition:
+        `model` for all the queries, `*` for the whole table, `field:<field>=<value>`
+        for the conditions containing the fields in `Meta.cache_generations`
+        """
+        names = ['model']
+
+        if all(k == '*' for k in where):
+            names.append('*')
+
+        for field in self._generation_fields or ():
+            if where.get(field) is not None:
+                names.append('field:{}={!r}'.format(field, where[field]))
+
+        return names
+
+    def get_generations(self, names):
+        """
+        :return: list of the current generations, the missing ones are created
+        """
+        missing = [x for x in names if x not in self._generations]
+
+        if missing:
+            keys = [self.__get_generation_key(x) for x in missing]
+            # timeout -> {generation key: new generation}
+            created = defaultdict(dict)
+            timeout = max([x for x in self._condition_timeout_map.values() if x] or [0])
+
+            for name, key, generation in zip(missing, keys, self._cache_db.get_many(*keys)):
+                if generation is None:
+                    # Never seen, expired or renewed, may be created by others at the same time,
+                    # a lost one only makes its entries unreachable
+                    generation = created[0 if name == 'model' else timeout][key] = new_generation()
+
+                self._generations[name] = generation
+
+            for timeout, mapping in created.items():
+                self._cache_db.set_many(mapping, timeout)
+
+        return [self._generations[x] for x in names]
+
+    def renew_generations(self, names):
+        """
+        Invalidate all the queries in the namespaces at once
+
+        :return: requests sent to the cache db
+        """
+        if not names:
+            return 0
+
+        logger.warning('Renew generations {} of model "{}"'.format(', '.join(names), self._model.__name__))
+        self._cache_db.delete_many(*[self.__get_generation_key(x) for x in names])
+
+        for name in names:
+            self._generations.pop(name, None)
+
+        if METRICS.enabled:
+            METRICS.incr(query_scope(self._model), 'invalidations', len(names))
+
+        return 1
 
     def clear(self):
-        with QueryTracker(self._model, self._cache_db) as tracker:
+        if self.generational:
+            self.renew_generations(['model'])
+            return
+
+        with self.__tracker() as tracker:
             tracker.discard_all()
 
     def __sync_records(self):
@@ -251,15 +1043,77 @@ class CacheManager(object):
         Sync records to Redis server.
         :return:
         """
-        with QueryTracker(self._model, self._cache_db) as tracker:
+        if self.normalized:
+            # Rows go first, so that the lists of primary keys never refer to missing rows
+            entities = dict()
+            for records in self._records.values():
+                entities.update((self.get_entity_key(r), self._dumps(r)) for r in records)
+
+            if entities:
+                self._cache_db.set_many(entities, self._entity_timeout)
+
+            if self._ordering_fields:
+                # Before the pages, so that an update of the fields never misses them
+                self._cache_db.set_many({self.get_ordering_key(x): 1 for x in self._ordering_fields}, 0)
+
+        # Queries in the generation namespaces, timeout -> {cache key: value}
+        untracked = defaultdict(dict)
+
+        with self.__tracker() as tracker:
             for key, records in self._records.items():
-                # tracker.track(key, records)
-                tracker.track(key, self._conditions.get(key))
-                self.__set_cond(key, records, self._timeouts.get(key))
+                logger.debug('Cache records with key {}, timeout is {}'.format(key, self._timeouts.get(key)))
+
+                if self.normalized:
+                    records = PrimaryKeyList(getattr(r, self._primary_key) for r in records)
 
-    def __set_cond(self, cache_key, records, timeout=300):
-        logger.debug('Cache records with key {}, timeout is {}'.format(cache_key, timeout))
-        return self._cache_db.set(cache_key, records, timeout)
+                value = self._dumps(records)
+                where = self._conditions.get(key)
+
+                if self.generational and len(self.get_generation_names(where)) > 1:
+                    untracked[self._timeouts.get(key)][key] = value
+                else:
+                    tracker.track(key, where, value, self._timeouts.get(key))
+
+                if METRICS.enabled:
+                    scope = query_scope(self._model, self._conditions.get(key))
+                    METRICS.incr(scope, 'sets')
+                    METRICS.incr(scope, 'key_bytes', len(key.encode('utf-8')))
+                    METRICS.incr(scope, 'key_bytes_saved', self._key_savings.get(key, 0))
+                    if isinstance(value, bytes):
+                        METRICS.incr(scope, 'bytes_written', len(value))
+
+        for timeout, mapping in untracked.items():
+            self._cache_db.set_many(mapping, timeout)
+
+    def __tracker(self):
+        if not self.generational:
+            return QueryTracker(self._model, self._cache_db)
+
+        # Trackers of the old generations expire along with their keys
+        return QueryTracker(self._model, self._cache_db, self.get_generations(['model'])[0],
+                            max([x for x in self._condition_timeout_map.values() if x] or [0]))
+
+    def __get_generation_key(self, name):
+        return '{}_generation_{}'.format(camel_to_underscore(self._model.__name__), name)
+
+    def __record_skipped(self, query):
+        if METRICS.enabled:
+            METRICS.incr(query_scope(self._model, query.get('where') or {}), 'skipped_sets')
+
+    def __hydrate(self, primary_keys):
+        if len(primary_keys) == 0:
+            return []
+
+        rows = self.get_entities(primary_keys)
+        if any(row is None for row in rows):
+            # Some rows expired or changed, load the query again
+            return None
+
+        return rows
+
+    def __selects_all(self, query):
+        select = query.get('select')
+        return not select or set(select) >= set(self._model.__mappings__)
 
     def __get_timeout(self, query):
         where = query.get('where', {}) or {}
@@ -270,7 +1124,22 @@ class CacheManager(object):
         key = '&'.join(sorted(where))
         return self._condition_timeout_map.get(key) or None
 
-    def __get_unique_cache_key(self, query, no_fp=False):
+    def __get_unique_cache_key(self, query, no_fp=False, namespaced=True):
+        key = self.__get_readable_cache_key(query, no_fp, namespaced)
+        if self._key_prefix is None:
+            return key
+
+        compact_key = make_compact_key(self._key_prefix, key)
+
+        if self._key_debug:
+            KEY_NAMES.set(compact_key, key)
+
+        if METRICS.enabled:
+            self._key_savings[compact_key] = len(key.encode('utf-8')) - len(compact_key.encode('utf-8'))
+
+        return compact_key
+
+    def __get_readable_cache_key(self, query, no_fp=False, namespaced=True):
         conditions = list()
         where = query.get('where', {})
 
@@ -283,74 +1152,101 @@ class CacheManager(object):
 
         conditions = '&'.join('{}={}'.format(k, v) for k, v in conditions) or '*'
 
+        namespace = camel_to_underscore(self._model.__name__)
+        if self.generational and namespaced:
+            namespace += '_g' + '.'.join(self.get_generations(self.get_generation_names(where)))
+
+        # The fingerprint sorts the values, the order of the fields and the page are kept here
+        conditions += self.__get_ordering(query)
+
         if no_fp is True:
-            return '{}_where_{}'.format(camel_to_underscore(self._model.__name__), conditions)
+            return '{}_where_{}'.format(namespace, conditions)
 
         query_fp = get_query_fingerprint(query)
-        return '{}_where_{}_fp_{}'.format(camel_to_underscore(self._model.__name__), conditions, query_fp)
+        return '{}_where_{}_fp_{}'.format(namespace, conditions, query_fp)
+
+    @staticmethod
+    def __get_ordering(query):
+        """
+        :return: str, e.g. `_order_folder_id_desc_limit_20_40`, empty if the query is not ordered or limited
+        """
+        order_by, limit = query.get('order_by'), query.get('limit')
+        ordering = ''
+
+        if order_by:
+            if isinstance(order_by, str):
+                order_by = [order_by]
+
+            ordering += '_order_' + ','.join(order_by) + ('_desc' if query.get('descending') else '')
+
+        if limit:
+            how_many, offset = (limit, 0) if isinstance(limit, int) else (tuple(limit) + (0,))[:2]
+            ordering += '_limit_{}_{}'.format(how_many, offset)
+
+        return ordering
 
 
 class QueryTracker(object):
     """
     Track all the cached conditions, delete them if needed.
+
+    Conditions are stored in a Redis hash with field indexes if the cache db
+    is a Redis cache (see `mycache.tracker.RedisTrackerStore`), otherwise
+    in one pickled dict.
     """
 
-    def __init__(self, model, cache_db):
+    def __init__(self, model, cache_db, generation=None, timeout=0):
+        """
+        :param generation: generation of the model namespace, each generation has its own tracker
+        :param timeout: int, seconds the tracker lives after the last track, 0 means never expire
+        """
         self._cache_db = cache_db
         self._model = model
-        self._tracker_container = None
+        self._generation = generation
+        self._timeout = timeout
+        self._store = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if len(self.tracker_container) > 0:
-            logger.warning('Sync tracker {} with {} items'.format(self.tracker_key, len(self.tracker_container)))
-            self._cache_db.set(self.tracker_key, self.tracker_container, 0)
-        else:
-            self._cache_db.delete(self.tracker_key)
+        self.store.flush()
 
-    def track(self, key, where):
+    def track(self, key, where, value=None, timeout=None):
+        """
+        Track the key of the condition, if `value` is given, it's cached
+        along with the tracking atomically.
+        """
         logger.info('Track query with key: {}'.format(key))
-        self.tracker_container[key] = where
+        self.store.track(key, where, value, timeout)
 
     def discard(self, where):
         """
         Related query keys will be discarded
+        """
+        return self.discard_many([where])
+
+    def discard_many(self, wheres, keys=(), rows=None):
+        """
+        Related query keys of all the conditions will be discarded in one batch
 
-        Pool way to find related keys and delete them
+        :param keys: other keys to be deleted in the same batch
+        :param rows: list of dicts, values of the written rows, conditions with lookups
+         are kept if none of the rows satisfies them. None discards them all
         """
         try:
-            exact_match = all(where.values())
-            tip = 'Exact' if exact_match else 'Contained'
+            discarded = self.store.discard_many(wheres, keys, rows)
+        except Exception as err:
+            logger.error(err)
+            return False
 
-            for key in list(self.tracker_container.keys()):
-                value = self.tracker_container[key]
-                should_delete = False
+        for key in discarded:
+            logger.warning('Discard related condition key <{}>'.format(key))
 
-                if exact_match is True:
-                    if value == where:
-                        should_delete = True
-                else:
-                    # Must be careful, have to delete all the related keys at last
-                    for k, v in where.items():
-                        if '__' in k and k in value:
-                            should_delete = True
-                            break
-
-                        if v is None:
-                            continue
-
-                        if value.get(k) == v:
-                            should_delete = True
-                            break
-
-                if should_delete is True:
-                    logger.warning('[{}] Discard related condition key <{}>'.format(tip, key))
-                    del self.tracker_container[key]
-                    self._cache_db.delete(key)
-        except Exception:
-            return False
+        if METRICS.enabled:
+            METRICS.incr(query_scope(self._model), 'invalidations', len(discarded))
+
+        return discarded
 
     def discard_all(self):
         """
@@ -359,24 +1255,37 @@ class QueryTracker(object):
         logger.warning('Discard all the related keys for {}'.format(self.tracker_key))
 
         try:
-            keys = list(self.tracker_container)
-            self._cache_db.delete_many(*keys)
-            self.tracker_container.clear()
-            return True
+            discarded = self.store.discard_all()
         except Exception as err:
             logger.error(err)
             return False
 
+        if METRICS.enabled:
+            METRICS.incr(query_scope(self._model), 'invalidations', len(discarded))
+
+        return True
+
+    @property
+    def round_trips(self):
+        """
+        Requests sent to the cache db so far, for debugging
+        """
+        return self._store.round_trips if self._store is not None else 0
+
     @property
-    def tracker_container(self):
-        if self._tracker_container is None:
-            self._tracker_container = self._cache_db.get(self.tracker_key) or dict()
+    def store(self):
+        if self._store is None:
+            self._store = make_tracker_store(self._cache_db, self.tracker_key, self._timeout)
 
-        return self._tracker_container
+        return self._store
 
     @property
     def tracker_key(self):
-        return 'query_tracker_for_{}'.format(camel_to_underscore(self._model.__name__))
+        key = 'query_tracker_for_{}'.format(camel_to_underscore(self._model.__name__))
+        if self._generation is not None:
+            key += '_g{}'.format(self._generation)
+
+        return key
 
 
 __all__ = ['query_cache']
@@ -0,0 +1,135 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : registry.py
+# Date   : 2017-08-21 09-40
+# Version: 0.0.1
+# Description: process-wide registry of the cache db instances.
+
+import hashlib
+import logging
+import os
+from threading import RLock
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+def make_instance_id(cache_type, **cache_options):
+    return cache_type + '?' + '&'.join('{}={}'.format(k, v) for k, v in sorted(cache_options.items()))
+
+
+# Connection options holding helper objects created for each client, equal as long as their types are
+SHARED_OPTIONS = {'retry', 'driver_info', 'socket_keepalive_options', 'himport_registry',
+                  'maint_notifications_pool_handler', 'maint_notifications_config'}
+
+
+def _describe_option(key, value):
+    """
+    Other objects (e.g. credential providers, SSL contexts) are the same option only if they're the same object
+    """
+    if value is None or isinstance(value, (str, bytes, int, float, bool)):
+        return repr(value)
+
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(_describe_option(key, x) for x in value))
+
+    if key in SHARED_OPTIONS:
+        return type(value).__qualname__
+
+    return '{}@{:x}'.format(type(value).__qualname__, id(value))
+
+
+def get_instance_id(cache_db):
+    """
+    Identify a cache db by its class and configuration, so that the cache dbs created
+    by different factories with the same configuration share one instance.
+    The connection options (e.g. passwords) are part of the id as a digest only.
+    """
+    cache_class = '{}.{}'.format(type(cache_db).__module__, type(cache_db).__qualname__)
+
+    pool = getattr(getattr(cache_db, '_client', None), 'connection_pool', None)
+    if pool is not None:
+        kwargs = pool.connection_kwargs
+        options = sorted((k, _describe_option(k, v)) for k, v in kwargs.items())
+        options.append(('connection_class', repr(getattr(pool, 'connection_class', None))))
+
+        return make_instance_id('redis', cache_class=cache_class, key_prefix=getattr(cache_db, 'key_prefix', None),
+                                default_timeout=getattr(cache_db, 'default_timeout', None),
+                                connection=hashlib.sha1(repr(options).encode('utf-8')).hexdigest(),
+                                **{k: kwargs.get(k) for k in ('host', 'port', 'path', 'db')})
+
+    cache_dir = getattr(cache_db, '_path', None)
+    if cache_dir is not None:
+        return make_instance_id('file', cache_class=cache_class, cache_dir=os.path.abspath(cache_dir),
+                                threshold=getattr(cache_db, '_threshold', None),
+                                default_timeout=getattr(cache_db, 'default_timeout', None))
+
+    return 'object?id={}'.format(id(cache_db))
+
+
+class BackendRegistry(object):
+    """
+    Cache db instances of the current process, each configuration is created
+    only once and reused by all the callers, so is its connection pool.
+
+    :param max_connections: int, size of the connection pool of each Redis cache created by
+     the registry (see `redis_options`), None means unlimited
+    """
+
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections
+        self.instances = dict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __contains__(self, instance_id):
+        return instance_id in self.instances
+
+    def get(self, instance_id, factory, *args, **kwargs):
+        """
+        Return the instance of the id, or create it with `factory(*args, **kwargs)`
+        """
+        instance = self.instances.get(instance_id)
+        if instance is not None:
+            return instance
+
+        with self._lock:
+            if instance_id not in self.instances:
+                logger.info('Cache instance id is `{}`'.format(instance_id))
+                self.instances[instance_id] = factory(*args, **kwargs)
+
+            return self.instances[instance_id]
+
+    def add(self, cache_db):
+        """
+        Register a cache db created somewhere else, the instance registered
+        earlier with the same configuration is returned if there's one.
+        """
+        return self.get(get_instance_id(cache_db), lambda: cache_db)
+
+    def redis_options(self, **cache_options):
+        if self.max_connections and 'max_connections' not in cache_options:
+            cache_options['max_connections'] = self.max_connections
+
+        return cache_options
+
+    def reset(self):
+        """
+        Forget all the instances, call it in the child process of fork based servers
+        (e.g. the `postfork` hook of uWSGI) so that children don't share sockets.
+        It's called automatically after `os.fork` on Python 3.7+.
+        """
+        # The lock may be held by a thread of the parent which doesn't exist any more
+        self._lock = RLock()
+        self.instances.clear()
+
+
+REGISTRY = BackendRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=REGISTRY.reset)
@@ -0,0 +1,178 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : serializer.py
+# Date   : 2017-08-30 10-10
+# Version: 0.0.1
+# Description: compact encodings of the cached values.
+
+import logging
+import lzma
+import pickle
+import zlib
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+# Encoded values start with the magic bytes, then one byte 0bFFFFCCCC, FFFF is the codec,
+# CCCC is the compression. Values without them (e.g. stored by the old versions) are returned
+# as they are, encoded values that can't be decoded are read as misses (None).
+MAGIC = b'\xb0mycache'
+HEADER_SIZE = len(MAGIC) + 1
+
+CODECS = ('pickle', 'rows')
+
+COMPRESSIONS = {
+    None: (lambda data, level: data, lambda data: data),
+    'zlib': (lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+COMPRESSION_IDS = {None: 0, 'zlib': 1, 'lzma': 2}
+COMPRESSION_NAMES = {v: k for k, v in COMPRESSION_IDS.items()}
+
+
+def is_encoded(data):
+    return isinstance(data, bytes) and len(data) >= HEADER_SIZE and data.startswith(MAGIC)
+
+
+def _is_model(obj):
+    return hasattr(type(obj), '__mappings__')
+
+
+def _dump_rows(value):
+    """
+    Encode a model instance or a list of instances of the same model as field values only,
+    returns None if the value is something else.
+    """
+    single = _is_model(value)
+    rows = [value] if single else value
+
+    if type(rows) is not list or len(rows) == 0 or not _is_model(rows[0]):
+        return None
+
+    model = type(rows[0])
+    if any(type(x) is not model for x in rows):
+        return None
+
+    fields = tuple(model.__mappings__)
+    values = [tuple(getattr(x, f, None) for f in fields) for x in rows]
+    return pickle.dumps((model, fields, values, single), pickle.HIGHEST_PROTOCOL)
+
+
+def _load_rows(payload):
+    model, fields, values, single = pickle.loads(payload)
+    rows = [model(**dict(zip(fields, x))) for x in values]
+    return rows[0] if single else rows
+
+
+def loads(data):
+    """
+    Decode a value encoded by any `Serializer`, values not encoded (e.g. in the old format) are
+    returned as they are. Values of unknown encodings or failing to decode (e.g. the pickled class
+    was moved) return None, a miss to the callers, so that they're computed and overwritten again
+    """
+    if not is_encoded(data):
+        return data
+
+    header = data[len(MAGIC)]
+    codec_id, compression_id = header >> 4, header & 0x0F
+    if codec_id >= len(CODECS) or compression_id not in COMPRESSION_NAMES:
+        logger.warning('Unknown encoding {:#04x} of the cached value, read it as a miss'.format(header))
+        return None
+
+    try:
+        payload = COMPRESSIONS[COMPRESSION_NAMES[compression_id]][1](data[HEADER_SIZE:])
+
+        if CODECS[codec_id] == 'rows':
+            return _load_rows(payload)
+
+        return pickle.loads(payload)
+    except Exception as err:
+        logger.warning('Failed to decode the cached value, read it as a miss: {}'.format(err))
+        return None
+
+
+class Serializer(object):
+    """
+    Encode the values to bytes before sending them to the cache db, decoding
+    works with any of the formats so that readers and writers may differ.
+
+    :param codec: str, `pickle` pickles the value with the highest protocol, `rows` stores
+     `dataobj` model instances (or lists of them) as tuples of the field values and rebuilds them
+     through `__mappings__`, other values are pickled
+    :param compression: str, `zlib`, `lzma` or None
+    :param compress_threshold: int, only encodings longer than it (in bytes) are compressed
+    :param level: int, compression level, the default of the compression if None
+    """
+
+    def __init__(self, codec='pickle', compression=None, compress_threshold=1024, level=None):
+        if codec not in CODECS:
+            raise ValueError("Unknown codec `{}`, allowed options are [{}]".format(codec, ', '.join(CODECS)))
+
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression `{}`, allowed options are [zlib, lzma]".format(compression))
+
+        self.codec = codec
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.level = level
+
+    def __repr__(self):
+        return '<Serializer codec={}, compression={}>'.format(self.codec, self.compression)
+
+    def dumps(self, value):
+        codec, payload = 'pickle', None
+
+        if self.codec == 'rows':
+            payload = _dump_rows(value)
+            if payload is not None:
+                codec = 'rows'
+
+        if payload is None:
+            payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        compression = None
+        if self.compression is not None and len(payload) > self.compress_threshold:
+            compressed = COMPRESSIONS[self.compression][0](payload, self.level)
+
+            # Not worth it for incompressible data
+            if len(compressed) < len(payload):
+                compression, payload = self.compression, compressed
+
+        header = (CODECS.index(codec) << 4) | COMPRESSION_IDS[compression]
+        return MAGIC + bytes([header]) + payload
+
+    @staticmethod
+    def loads(data):
+        return loads(data)
+
+
+SERIALIZERS = {
+    'pickle': Serializer('pickle'),
+    'pickle_zlib': Serializer('pickle', 'zlib'),
+    'pickle_lzma': Serializer('pickle', 'lzma'),
+    'rows': Serializer('rows'),
+    'rows_zlib': Serializer('rows', 'zlib'),
+    'rows_lzma': Serializer('rows', 'lzma'),
+}
+
+
+def get_serializer(serializer=None):
+    """
+    Resolve a serializer
+
+    :param serializer: str, one of `SERIALIZERS`, a `Serializer`-like object with `dumps` and `loads`,
+     or None to store the values as they are (pickled by the cache db)
+    :return: serializer or None
+    """
+    if serializer is None or hasattr(serializer, 'dumps'):
+        return serializer
+
+    try:
+        return SERIALIZERS[serializer]
+    except KeyError:
+        raise ValueError(
+            "Unknown serializer `{}`, allowed options are [{}]".format(serializer, ', '.join(SERIALIZERS)))
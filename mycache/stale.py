@@ -0,0 +1,105 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : stale.py
+# Date   : 2017-08-02 11-05
+# Version: 0.0.1
+# Description: stale-while-revalidate support for `output_cache`.
+
+import logging
+import math
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+# `value` becomes stale at `stale_at` (timestamp), it took `delta` seconds to compute it
+CacheEntry = namedtuple('CacheEntry', ['value', 'stale_at', 'delta'])
+
+
+def make_entry(value, stale_timeout, delta=0):
+    return CacheEntry(value, time.time() + stale_timeout, delta)
+
+
+def is_stale(entry, beta=0):
+    """
+    Check whether the entry should be refreshed.
+
+    With a positive `beta`, entries are refreshed a bit earlier at random
+    (probabilistic early expiration), the more expensive the computation is,
+    the earlier it tends to be refreshed, so that keys written at the same time
+    won't be refreshed all together.
+    """
+    now = time.time()
+    if beta > 0 and entry.delta > 0:
+        # 1 - random() lies in (0, 1], log of it is never positive
+        now -= entry.delta * beta * math.log(1.0 - random.random())
+
+    return now >= entry.stale_at
+
+
+class RefreshPool(object):
+    """
+    A bounded thread pool refreshing stale cache entries in background.
+
+    Each key is refreshed by one task at most at the same time, new tasks
+    are dropped once `max_pending` tasks are waiting.
+    """
+
+    def __init__(self, max_workers=4, max_pending=1000):
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._executor = None
+        self._pending = set()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, key, func, *args, **kwargs):
+        with self._lock:
+            if key in self._pending or len(self._pending) >= self._max_pending:
+                return False
+
+            if self._executor is None:
+                # Create it lazily, don't start threads before the process forks
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+
+            self._pending.add(key)
+
+        try:
+            self._executor.submit(self._run, key, func, args, kwargs)
+            return True
+        except RuntimeError as err:
+            logger.error('Failed to refresh key `{}` in background: {}'.format(key, err))
+            self._done(key)
+            return False
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _run(self, key, func, args, kwargs):
+        try:
+            logger.debug('Refresh stale key `%s` in background', key)
+            func(*args, **kwargs)
+        except Exception as err:
+            logger.error('Failed to refresh key `{}` in background: {}'.format(key, err))
+        finally:
+            self._done(key)
+
+    def _done(self, key):
+        with self._lock:
+            self._pending.discard(key)
+
+
+REFRESH_POOL = RefreshPool()
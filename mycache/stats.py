@@ -0,0 +1,163 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : stats.py
+# Date   : 2017-09-07 14-00
+# Version: 0.0.1
+# Description: hit/miss counters and latency histograms of the caches.
+
+import logging
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+# Upper bounds of the latency buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+
+# `negative_hits` are the hits of the known empty outputs, counted in `hits` as well,
+# `negative_misses` are the misses computed to an empty output and cached as a negative entry,
+# `key_bytes` is the total length of the keys written, `key_bytes_saved` what compact keys saved
+COUNTERS = ('hits', 'misses', 'negative_hits', 'negative_misses', 'sets', 'skipped_sets', 'invalidations',
+            'bytes_read', 'bytes_written', 'key_bytes', 'key_bytes_saved')
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                'buckets': {'+Inf' if b == float('inf') else str(b): n for b, n in zip(LATENCY_BUCKETS, self.buckets)}}
+
+
+class Metrics(object):
+    """
+    In-process counters and latency histograms grouped by scope:
+    1. `output:<module>.<function>`, functions decorated by `output_cache`;
+    2. `query:<model>:<condition>`, queries of the models decorated by `query_cache`,
+       e.g. `query:Folder:name&folder_id`, `query:Folder:*`;
+    3. `query:<model>`, invalidations of the model.
+
+    Counters are `COUNTERS`, histograms are `get` (cache lookups) and `load` (computing the
+    output or querying the database). Bytes are only known if a serializer is used.
+
+    Disabled by default, callers check `enabled` before measuring anything, so the cost
+    is one attribute lookup when disabled.
+
+    metrics = mycache.stats.METRICS
+    metrics.enable()
+    metrics.add_exporter(lambda snapshot: statsd_client.send(snapshot))
+    metrics.export(reset=True)  # e.g. every minute
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = Lock()
+        self._counters = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self._histograms = defaultdict(dict)
+        self._exporters = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def incr(self, scope, name, value=1):
+        with self._lock:
+            self._counters[scope][name] += value
+
+    def observe(self, scope, name, seconds):
+        with self._lock:
+            histogram = self._histograms[scope].get(name)
+            if histogram is None:
+                histogram = self._histograms[scope][name] = Histogram()
+
+            histogram.observe(seconds)
+
+    def lookup(self, scope, hit, seconds, negative=False):
+        """
+        Record a cache lookup
+
+        :param negative: bool, whether a negative entry was hit
+        """
+        with self._lock:
+            self._counters[scope]['hits' if hit else 'misses'] += 1
+            if negative:
+                self._counters[scope]['negative_hits'] += 1
+
+        self.observe(scope, 'get', seconds)
+
+    def snapshot(self, reset=False):
+        """
+        :return: dict, scope -> {counter name: value, 'latency': {histogram name: dict}}
+        """
+        with self._lock:
+            result = dict()
+            for scope in set(self._counters) | set(self._histograms):
+                data = dict(self._counters.get(scope) or dict.fromkeys(COUNTERS, 0))
+                data['latency'] = {k: v.to_dict() for k, v in self._histograms.get(scope, {}).items()}
+                result[scope] = data
+
+            if reset:
+                self._counters.clear()
+                self._histograms.clear()
+
+        return result
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+    def add_exporter(self, exporter):
+        """
+        :param exporter: callable, called with the snapshot dict by `export`
+        """
+        self._exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        self._exporters.remove(exporter)
+
+    def export(self, reset=False):
+        """
+        Send a snapshot to all the exporters, failures of an exporter are logged only
+        """
+        snapshot = self.snapshot(reset)
+
+        for exporter in self._exporters:
+            try:
+                exporter(snapshot)
+            except Exception as err:
+                logger.error('Failed to export cache metrics with {}: {}'.format(exporter, err))
+
+        return snapshot
+
+
+METRICS = Metrics()
+
+
+def output_scope(func):
+    return 'output:{}.{}'.format(func.__module__, getattr(func, '__qualname__', func.__name__))
+
+
+def query_scope(model, where=None):
+    if where is None:
+        return 'query:{}'.format(model.__name__)
+
+    return 'query:{}:{}'.format(model.__name__, '&'.join(sorted(where)) or '*')
@@ -0,0 +1,603 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : tracker.py
+# Date   : 2017-08-14 10-30
+# Version: 0.0.1
+# Description: storages of the tracked query conditions used by `QueryTracker`.
+
+import logging
+import pickle
+from threading import Lock, RLock
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+
+def _fold(value):
+    if isinstance(value, str):
+        return value.casefold()
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return type(value)(_fold(x) for x in value)
+
+    return value
+
+
+def _collated(test):
+    """
+    Strings match with either a binary or a case-insensitive (`_ci`) collation,
+    matching more rows only discards more queries
+    """
+
+    def collated_test(actual, expected):
+        return test(actual, expected) or test(_fold(actual), _fold(expected))
+
+    return collated_test
+
+
+def _compare(op):
+    def test(actual, expected):
+        return actual is not None and op(actual, expected)
+
+    return _collated(test)
+
+
+def _text(op):
+    def test(actual, expected):
+        if actual is None or expected is None:
+            return False
+
+        # Case-insensitive matches include the case-sensitive ones
+        return op(str(actual).casefold(), str(expected).casefold())
+
+    return test
+
+
+# Lookups of the query conditions, test(value of the row, value of the condition),
+# NULL never matches the comparisons like in SQL
+LOOKUPS = {
+    'exact': _collated(lambda actual, expected: actual == expected),
+    'ne': _compare(lambda a, b: a != b),
+    'lt': _compare(lambda a, b: a < b),
+    'lte': _compare(lambda a, b: a <= b),
+    'gt': _compare(lambda a, b: a > b),
+    'gte': _compare(lambda a, b: a >= b),
+    'in': _compare(lambda a, b: a in b),
+    'not_in': _compare(lambda a, b: a not in b),
+    'range': _compare(lambda a, b: b[0] <= a <= b[1]),
+    'between': _compare(lambda a, b: b[0] <= a <= b[1]),
+    'isnull': lambda actual, expected: (actual is None) == bool(expected),
+    'contains': _text(lambda a, b: b in a),
+    'icontains': _text(lambda a, b: b in a),
+    'startswith': _text(lambda a, b: a.startswith(b)),
+    'istartswith': _text(lambda a, b: a.startswith(b)),
+    'endswith': _text(lambda a, b: a.endswith(b)),
+    'iendswith': _text(lambda a, b: a.endswith(b)),
+}
+
+
+def matches(where, row):
+    """
+    Check whether the row may satisfy the condition. Unknown fields and lookups,
+    and values that can't be compared, are assumed to match.
+
+    :param row: dict, field name -> value
+    """
+    for key, expected in where.items():
+        field, _, lookup = key.partition('__')
+        test = LOOKUPS.get(lookup or 'exact')
+
+        if field == '*' or field not in row or test is None:
+            continue
+
+        try:
+            if not test(row[field], expected):
+                return False
+        except Exception:
+            continue
+
+    return True
+
+
+def canonical_where(where):
+    return '&'.join('{}={!r}'.format(k, where[k]) for k in sorted(where)) or '*'
+
+
+def index_names(where):
+    """
+    Names of the index sets a tracked condition belongs to:
+    1. `cond:<where>`, all the keys of exactly the same condition;
+    2. `field:<field>=<value>`, all the keys whose condition contains the field value;
+    3. `lookup:<field>__<lookup>`, all the keys whose condition contains the lookup field.
+    """
+    names = ['cond:' + canonical_where(where)]
+
+    for k in sorted(where):
+        if '__' in k:
+            names.append('lookup:' + k)
+        elif where[k] is not None:
+            names.append('field:{}={!r}'.format(k, where[k]))
+
+    return names
+
+
+def related_index_names(where):
+    """
+    Names of the index sets holding the keys related to the condition,
+    same rules as the old linear scan of `QueryTracker.discard`.
+    """
+    if all(where.values()):
+        # Exact match
+        return ['cond:' + canonical_where(where)]
+
+    names = []
+    for k in sorted(where):
+        if '__' in k:
+            names.append('lookup:' + k)
+        elif where[k] is not None:
+            names.append('field:{}={!r}'.format(k, where[k]))
+
+    return names
+
+
+def is_related(where, value, rows=None):
+    """
+    Check whether the tracked condition `value` is related to the condition `where`
+
+    :param rows: list of dicts, the old and new values of the written row, a tracked
+     condition with lookups is related only if any of them satisfies it, None means always
+    """
+    if all(where.values()):
+        return value == where
+
+    for k, v in where.items():
+        if '__' in k and k in value:
+            if rows is None or any(matches(value, row) for row in rows):
+                return True
+
+            continue
+
+        if v is None:
+            continue
+
+        if value.get(k) == v:
+            return True
+
+    return False
+
+
+def make_related_predicate(wheres, rows=None):
+    """
+    Same as `lambda value: any(is_related(where, value, rows) for where in wheres)`, but the
+    conditions are indexed once, checking a tracked condition costs O(its fields) instead
+    of O(len(wheres)), for invalidating the conditions of many rows at once.
+    """
+    exact = set()
+    fields = set()
+    lookups = set()
+
+    for where in wheres:
+        if all(where.values()):
+            exact.add(canonical_where(where))
+            continue
+
+        for k, v in where.items():
+            if '__' in k:
+                lookups.add(k)
+            elif v is not None:
+                fields.add((k, repr(v)))
+
+    def is_related_to_any(value):
+        if exact and canonical_where(value) in exact:
+            return True
+
+        for k in value:
+            if '__' in k:
+                if k in lookups and (rows is None or any(matches(value, row) for row in rows)):
+                    return True
+            elif fields and (k, repr(value[k])) in fields:
+                return True
+
+        return False
+
+    return is_related_to_any
+
+
+class BlobTrackerStore(object):
+    """
+    All the tracked conditions of a model are stored as one pickled dict,
+    works with any CacheDB-like object.
+
+    The dict is loaded, modified and written back while holding the `lock`
+    of the cache db (see `mycache.utils.add_lock_method`), so that concurrent
+    writers don't lose each other's changes. Cache dbs without a `lock`
+    method fall back to a lock of the current process.
+
+    If the lock can't be acquired after `lock_retries` more tries, the dict is never written
+    back: tracks don't cache their values (a value not tracked could never be invalidated),
+    discards still delete the keys of the conditions found in it.
+
+    :param timeout: int, seconds the dict lives after the last change, 0 means never expire
+    """
+
+    local_locks = dict()
+    local_locks_guard = Lock()
+
+    def __init__(self, cache_db, tracker_key, lock_timeout=10, timeout=0, lock_retries=2):
+        self._cache_db = cache_db
+        self._tracker_key = tracker_key
+        self._lock_timeout = lock_timeout
+        self._lock_retries = lock_retries
+        self._timeout = timeout
+        self._container = None
+        self._lock = None
+        self._remote_lock = False
+        self._read_only = False
+        # Requests sent to the cache db, for debugging
+        self.round_trips = 0
+
+    def __len__(self):
+        return len(self.container)
+
+    @property
+    def container(self):
+        if self._container is None:
+            self._read_only = not self._acquire()
+            try:
+                self.round_trips += 1
+                self._container = self._cache_db.get(self._tracker_key) or dict()
+            except Exception:
+                self._release()
+                raise
+
+        return self._container
+
+    def track(self, key, where, value=None, timeout=None):
+        self.container[key] = where
+
+        if value is not None and not self._read_only:
+            self.round_trips += 1
+            self._cache_db.set(key, value, timeout)
+
+    def discard(self, where):
+        return self.discard_many([where])
+
+    def discard_many(self, wheres, keys=(), rows=None):
+        is_related_to_any = make_related_predicate(wheres, rows)
+        related = [key for key, value in self.container.items() if is_related_to_any(value)]
+
+        for key in related:
+            del self.container[key]
+
+        seen = set(related)
+        related.extend(x for x in keys if x not in seen)
+        if related:
+            self.round_trips += 1
+            self._cache_db.delete_many(*related)
+
+        return related
+
+    def discard_all(self):
+        keys = list(self.container)
+        if keys:
+            self.round_trips += 1
+            self._cache_db.delete_many(*keys)
+
+        self.container.clear()
+        return keys
+
+    def flush(self):
+        if self._container is None:
+            return
+
+        try:
+            if self._read_only:
+                logger.error('Tracker {} is not locked, changes are dropped'.format(self._tracker_key))
+                return
+
+            self.round_trips += 1
+            if len(self._container) > 0:
+                logger.warning('Sync tracker {} with {} items'.format(self._tracker_key, len(self._container)))
+                self._cache_db.set(self._tracker_key, self._container, self._timeout)
+            else:
+                self._cache_db.delete(self._tracker_key)
+        finally:
+            self._container = None
+            self._release()
+
+    def _acquire(self):
+        """
+        :return: bool, whether the lock is held
+        """
+        make_lock = getattr(self._cache_db, 'lock', None)
+
+        for attempt in range(self._lock_retries + 1):
+            if make_lock is not None:
+                lock = make_lock('{}.lock'.format(self._tracker_key), timeout=self._lock_timeout,
+                                 blocking_timeout=self._lock_timeout)
+                self.round_trips += 1
+                acquired = lock.acquire()
+            else:
+                with self.local_locks_guard:
+                    lock = self.local_locks.setdefault(self._tracker_key, RLock())
+                acquired = lock.acquire(timeout=self._lock_timeout)
+
+            if acquired:
+                self._lock = lock
+                self._remote_lock = make_lock is not None
+                return True
+
+            logger.warning('Failed to lock tracker {} in {} seconds, attempt {}'.format(
+                self._tracker_key, self._lock_timeout, attempt + 1))
+
+        logger.error('Failed to lock tracker {}, it is read only'.format(self._tracker_key))
+        return False
+
+    def _release(self):
+        lock, self._lock = self._lock, None
+        if lock is None:
+            return
+
+        if self._remote_lock:
+            self.round_trips += 1
+
+        try:
+            lock.release()
+        except Exception as err:
+            # The lock may have expired already
+            logger.error('Failed to unlock tracker {}: {}'.format(self._tracker_key, err))
+
+
+# Remove the keys in the index sets ARGV[4...3+n] and the keys ARGV[4+n...] from the tracker,
+# along with the cached data, returns the removed keys.
+# ARGV[1]: prefix of the tracker keys, ARGV[2]: prefix of the cache keys, ARGV[3]: n
+DISCARD_SCRIPT = """
+local tracker, prefix, n = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local keys, seen = {}, {}
+
+local function add(key)
+    if not seen[key] then
+        seen[key] = true
+        keys[#keys + 1] = key
+    end
+end
+
+for i = 4, 3 + n do
+    for _, key in ipairs(redis.call('SMEMBERS', tracker .. ARGV[i])) do
+        add(key)
+    end
+end
+
+for i = 4 + n, #ARGV do
+    add(ARGV[i])
+end
+
+for _, key in ipairs(keys) do
+    local refs = redis.call('HGET', tracker .. 'refs', key)
+    if refs then
+        for name in string.gmatch(refs, '[^\\n]+') do
+            redis.call('SREM', tracker .. name, key)
+        end
+    end
+
+    redis.call('HDEL', tracker .. 'refs', key)
+    redis.call('HDEL', tracker .. 'where', key)
+    redis.call('DEL', prefix .. key)
+end
+
+return keys
+"""
+
+# Members of the index sets ARGV[2...] along with their pickled conditions, as a flat list.
+# ARGV[1]: prefix of the tracker keys
+LOOKUP_SCRIPT = """
+local tracker = ARGV[1]
+local result = {}
+
+for i = 2, #ARGV do
+    for _, key in ipairs(redis.call('SMEMBERS', tracker .. ARGV[i])) do
+        result[#result + 1] = key
+        result[#result + 1] = redis.call('HGET', tracker .. 'where', key) or ''
+    end
+end
+
+return result
+"""
+
+# Remove all the tracked keys and the tracker itself, returns the removed keys.
+# ARGV[1]: prefix of the tracker keys, ARGV[2]: prefix of the cache keys
+DISCARD_ALL_SCRIPT = """
+local tracker, prefix = ARGV[1], ARGV[2]
+local keys = redis.call('HKEYS', tracker .. 'where')
+
+for _, key in ipairs(keys) do
+    redis.call('DEL', prefix .. key)
+end
+
+for _, name in ipairs(redis.call('SMEMBERS', tracker .. 'indexes')) do
+    redis.call('DEL', tracker .. name)
+end
+
+redis.call('DEL', tracker .. 'where', tracker .. 'refs', tracker .. 'indexes')
+return keys
+"""
+
+
+class RedisTrackerStore(object):
+    """
+    Tracked conditions are stored in a Redis hash (cache key -> pickled where),
+    along with the index sets (see `index_names`), so that the related keys
+    are found in O(matches) instead of loading and scanning all the conditions.
+
+    Redis keys of model `Folder` (without the key prefix of the cache db):
+    1. query_tracker_for_folder:where, the hash of the tracked conditions;
+    2. query_tracker_for_folder:refs, the hash of the index names of each tracked key;
+    3. query_tracker_for_folder:indexes, names of all the index sets;
+    4. query_tracker_for_folder:<index name>, the index sets.
+
+    Every mutation is atomic on the server side: tracks (along with the cached data)
+    are sent in one MULTI/EXEC transaction, discards run as Lua scripts, there's no
+    read-modify-write in the client at all.
+
+    Warning: the scripts access keys which are not passed in `KEYS`, Redis Cluster is not supported.
+
+    :param timeout: int, seconds the tracker lives after the last track, 0 means never expire
+    """
+
+    # Trackers migrated from the old pickled dict in this process
+    migrated = set()
+
+    def __init__(self, cache_db, tracker_key, timeout=0):
+        self._cache_db = cache_db
+        self._client = cache_db._client
+        self._key_prefix = getattr(cache_db, 'key_prefix', '') or ''
+        self._tracker_key = tracker_key
+        self._timeout = timeout
+        self._tracker_prefix = '{}{}:'.format(self._key_prefix, tracker_key)
+        self._pipeline = None
+        # Requests sent to Redis, for debugging
+        self.round_trips = 0
+        self._discard_script = self._client.register_script(DISCARD_SCRIPT)
+        self._discard_all_script = self._client.register_script(DISCARD_ALL_SCRIPT)
+        self._lookup_script = self._client.register_script(LOOKUP_SCRIPT)
+        self.migrate()
+
+    def __len__(self):
+        return self._client.hlen(self._name('where'))
+
+    def _name(self, suffix):
+        return self._tracker_prefix + suffix
+
+    def track(self, key, where, value=None, timeout=None):
+        if self._pipeline is None:
+            self._pipeline = self._client.pipeline(transaction=True)
+
+        names = index_names(where)
+        self._pipeline.hset(self._name('where'), key, pickle.dumps(where, pickle.HIGHEST_PROTOCOL))
+        self._pipeline.hset(self._name('refs'), key, '\n'.join(names))
+        self._pipeline.sadd(self._name('indexes'), *names)
+
+        for name in names:
+            self._pipeline.sadd(self._name(name), key)
+
+        if self._timeout > 0:
+            for name in ['where', 'refs', 'indexes'] + names:
+                self._pipeline.expire(self._name(name), self._timeout)
+
+        if value is not None:
+            self._set(self._pipeline, key, value, timeout)
+
+    def discard(self, where):
+        return self.discard_many([where])
+
+    def discard_many(self, wheres, keys=(), rows=None):
+        """
+        Discard the keys related to any of the conditions, along with `keys`, in one request.
+        If `rows` are given (see `is_related`), the conditions with lookups are loaded and
+        checked against them first, in one more request.
+        """
+        names = []
+        seen = set()
+        for where in wheres:
+            for name in related_index_names(where):
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+
+        if rows is not None:
+            lookups = [x for x in names if x.startswith('lookup:')]
+            if lookups:
+                names = [x for x in names if not x.startswith('lookup:')]
+                seen = set(keys)
+                keys = list(keys) + [x for x in self._match_lookups(lookups, rows) if x not in seen]
+
+        if not names and not keys:
+            return []
+
+        return self._discard(names, keys)
+
+    def _match_lookups(self, names, rows):
+        """
+        :return: the keys of the index sets whose conditions are satisfied by any of the rows
+        """
+        self.round_trips += 1
+        result = self._lookup_script(args=[self._tracker_prefix] + list(names))
+
+        matched = []
+        seen = set()
+        for key, where in zip(result[::2], result[1::2]):
+            key = key.decode('utf-8')
+            if key in seen:
+                continue
+
+            seen.add(key)
+
+            try:
+                where = pickle.loads(where)
+            except Exception:
+                # Unknown condition, discard it anyway
+                where = {}
+
+            if any(matches(where, row) for row in rows):
+                matched.append(key)
+
+        return matched
+
+    def discard_all(self):
+        self.round_trips += 1
+        keys = self._discard_all_script(args=[self._tracker_prefix, self._key_prefix])
+        return [k.decode('utf-8') for k in keys]
+
+    def flush(self):
+        if self._pipeline is not None:
+            pipeline, self._pipeline = self._pipeline, None
+            self.round_trips += 1
+            pipeline.execute()
+
+    def _discard(self, names, keys=()):
+        self.round_trips += 1
+        args = [self._tracker_prefix, self._key_prefix, len(names)] + list(names) + list(keys)
+        keys = self._discard_script(args=args)
+        return [k.decode('utf-8') for k in keys]
+
+    def _set(self, pipeline, key, value, timeout=None):
+        if timeout is None:
+            timeout = getattr(self._cache_db, 'default_timeout', 300)
+
+        dump = self._cache_db.dump_object(value)
+        pipeline.set(self._key_prefix + key, dump, ex=timeout if timeout > 0 else None)
+
+    def migrate(self):
+        """
+        Move the conditions tracked by the old versions (one pickled dict) into the hash
+        """
+        kwargs = getattr(getattr(self._client, 'connection_pool', None), 'connection_kwargs', {})
+        migration_id = tuple(kwargs.get(k) for k in ('host', 'port', 'path', 'db')) + (self._key_prefix,
+                                                                                      self._tracker_key)
+        if migration_id in self.migrated:
+            return
+
+        self.round_trips += 2
+        old = self._cache_db.get(self._tracker_key)
+        if isinstance(old, dict) and old:
+            logger.warning('Migrate tracker {} with {} items'.format(self._tracker_key, len(old)))
+            for key, where in old.items():
+                self.track(key, where)
+
+            self.flush()
+
+        self._cache_db.delete(self._tracker_key)
+        self.migrated.add(migration_id)
+
+
+def make_tracker_store(cache_db, tracker_key, timeout=0):
+    """
+    Use the hash store if the cache db is a Redis cache, otherwise the pickled dict
+    """
+    if hasattr(cache_db, '_client') and hasattr(cache_db._client, 'pipeline'):
+        return RedisTrackerStore(cache_db, tracker_key, timeout)
+
+    return BlobTrackerStore(cache_db, tracker_key, timeout=timeout)
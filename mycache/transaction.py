@@ -0,0 +1,189 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : transaction.py
+# Date   : 2017-10-16 10-20
+# Version: 0.0.1
+# Description: invalidations of the writes in a transaction, deferred until it's committed.
+
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+from mycache.tracker import canonical_where
+
+logger = logging.getLogger(__name__)
+
+__version__ = '0.0.1'
+__author__ = 'Chris'
+
+# id(conn) -> the outermost `DeferredInvalidation` of the connection
+_TRANSACTIONS = dict()
+_LOCK = Lock()
+
+
+def get_transaction(conn):
+    """
+    :return: `DeferredInvalidation` collecting the invalidations of the writes with `conn`, None if not any
+    """
+    if conn is None:
+        return None
+
+    return _TRANSACTIONS.get(id(conn))
+
+
+class DelayedCalls(object):
+    """
+    Calls run after their delays by one daemon thread, new calls are dropped
+    once `max_pending` calls are waiting.
+    """
+
+    def __init__(self, max_pending=10000):
+        self._max_pending = max_pending
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, delay, func, *args, **kwargs):
+        with self._condition:
+            if len(self._heap) >= self._max_pending:
+                logger.error('Too many delayed calls, drop {}'.format(func))
+                return False
+
+            if self._thread is None or not self._thread.is_alive():
+                # Create it lazily, don't start threads before the process forks
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), func, args, kwargs))
+            self._condition.notify()
+
+        return True
+
+    def run_pending(self):
+        """
+        Run all the waiting calls now, e.g. before the process exits
+
+        :return: int, number of the calls
+        """
+        with self._condition:
+            calls, self._heap = self._heap, []
+
+        for _, _, func, args, kwargs in sorted(calls):
+            self._call(func, args, kwargs)
+
+        return len(calls)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+
+                _, _, func, args, kwargs = heapq.heappop(self._heap)
+
+            self._call(func, args, kwargs)
+
+    @staticmethod
+    def _call(func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as err:
+            logger.error('Failed to run delayed call {}: {}'.format(func, err))
+
+
+DELAYED_CALLS = DelayedCalls()
+
+
+class DeferredInvalidation(object):
+    """
+    Writes with `conn` (`update`, `dump`, `delete` and the bulk versions) inside the block
+    don't invalidate the cache before their SQL runs, their conditions and rows are collected,
+    deduplicated and invalidated in one batch per model when the block exits, i.e. after
+    the transaction is committed. Otherwise a concurrent reader may cache the rows of the
+    old state again before the commit, and the stale results live until they expire.
+
+        with DeferredInvalidation(conn, delay=0.5):
+            Folder.objects.update(folder, conn)
+            Folder.objects.delete(other_folder, conn)
+            conn.commit()
+
+    Blocks of the same connection can be nested, the outermost one invalidates.
+
+    :param conn: the connection passed to the writes
+    :param delay: float, seconds, if given, the same invalidation runs once more after the
+     delay (see `DelayedCalls`), in case a reader loaded the old rows before the commit and
+     wrote them to the cache after the first invalidation, or read a lagging replica
+    :param scheduler: `DelayedCalls`, the shared one by default
+    """
+
+    def __init__(self, conn, delay=None, scheduler=None):
+        self.conn = conn
+        self.delay = delay
+        self._scheduler = scheduler or DELAYED_CALLS
+        self._pending = OrderedDict()
+        self._owner = None
+
+    def __enter__(self):
+        with _LOCK:
+            self._owner = _TRANSACTIONS.setdefault(id(self.conn), self)
+
+        return self._owner
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._owner is not self:
+            return
+
+        with _LOCK:
+            _TRANSACTIONS.pop(id(self.conn), None)
+
+        # Also invalidate if the transaction failed, some writes may have been committed,
+        # invalidating the unchanged rows costs only cache misses
+        self.flush()
+
+    def __len__(self):
+        return sum(len(queries) + len(keys) for _, queries, _, keys in self._pending.values())
+
+    def add(self, manager, queries, rows, entity_keys=()):
+        """
+        :param manager: `DataObjectsManagerWithCache` of the written model
+        :param rows: list of dicts, values of the written rows, None if unknown, then all the
+         conditions with lookups of the model are invalidated
+        """
+        pending = self._pending.get(manager._model)
+        if pending is None:
+            pending = self._pending[manager._model] = [manager, OrderedDict(), OrderedDict(), OrderedDict()]
+
+        _, unique_queries, unique_rows, unique_keys = pending
+        for query in queries:
+            unique_queries.setdefault(canonical_where(query.get('where') or {}), query)
+
+        # Rows written more than once are checked (and broadcast) once
+        if rows is None or unique_rows is None:
+            pending[2] = None
+        else:
+            for row in rows:
+                unique_rows.setdefault(canonical_where(row), row)
+
+        unique_keys.update((x, None) for x in entity_keys)
+
+    def flush(self):
+        pending, self._pending = self._pending, OrderedDict()
+
+        for manager, queries, rows, keys in pending.values():
+            args = (list(queries.values()), list(rows.values()) if rows is not None else None, list(keys))
+
+            try:
+                manager._remove_related(*args)
+            except Exception as err:
+                logger.error('Failed to invalidate the cache of model "{}": {}'.format(manager._model.__name__, err))
+
+            if self.delay is not None:
+                self._scheduler.schedule(self.delay, manager._remove_related, *args)
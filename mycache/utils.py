@@ -6,13 +6,26 @@
 # Version: 0.0.1
 # Description: description of this file.
 
+import base64
 import pickle
+from functools import partial, wraps
 from string import ascii_uppercase, ascii_lowercase
 
 import hashlib
 
 ASCII_MAPPING = dict((k, '_{}'.format(v)) for k, v in zip(ascii_uppercase, ascii_lowercase))
 
+# Fingerprints of the query shapes, see `get_query_fingerprint`
+MAX_FINGERPRINTS = 10000
+_FINGERPRINTS = dict()
+
+HASH_METHODS = {
+    'md5': lambda data: hashlib.md5(data).hexdigest(),
+    'sha1': lambda data: hashlib.sha1(data).hexdigest(),
+    'blake2b': lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+    'blake2s': lambda data: hashlib.blake2s(data, digest_size=16).hexdigest(),
+}
+
 
 def camel_to_underscore(key):
     """
@@ -23,12 +36,83 @@ def camel_to_underscore(key):
     return ''.join(ASCII_MAPPING.get(x) or x for x in key).strip('_')
 
 
+def lock(self, name, timeout=None, sleep=0.1, blocking_timeout=None,
+         lock_class=None, thread_local=True):
+    # Pass by keywords, the positional order differs between redis-py versions
+    return self._client.lock(name, timeout=timeout, sleep=sleep, blocking_timeout=blocking_timeout,
+                             lock_class=lock_class, thread_local=thread_local)
+
+
+def add_lock_method(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        cache_db = func(*args, **kwargs)
+        cache_db.lock = partial(lock, cache_db)
+        return cache_db
+
+    return wrapper
+
+
+def get_hash_method(hash_method='md5'):
+    """
+    Resolve a hash method which maps bytes to a hex digest string
+
+    :param hash_method: str, one of `HASH_METHODS`, or a callable
+    :return: callable
+    """
+    if callable(hash_method):
+        return hash_method
+
+    try:
+        return HASH_METHODS[hash_method]
+    except KeyError:
+        raise ValueError(
+            "Unknown hash method `{}`, allowed options are [{}]".format(hash_method, ', '.join(HASH_METHODS)))
+
+
 def get_query_fingerprint(query, hash_method='md5'):
     """
     Generate a unique fingerprint for the given query
 
+    Only the fields of `where` are part of it, not their values, so the fingerprint of
+    each query shape (select list, fields, ordering...) is computed once and memoized.
+
     :return: hash value
     """
+    try:
+        shape = _get_shape(query, hash_method)
+        fingerprint = _FINGERPRINTS.get(shape)
+    except TypeError:
+        # Unhashable parts
+        return _make_query_fingerprint(query, hash_method)
+
+    if fingerprint is None:
+        if len(_FINGERPRINTS) >= MAX_FINGERPRINTS:
+            _FINGERPRINTS.clear()
+
+        fingerprint = _FINGERPRINTS[shape] = _make_query_fingerprint(query, hash_method)
+
+    return fingerprint
+
+
+def _get_shape(query, hash_method):
+    """
+    Hashable key of the query parts, equal keys make equal fingerprints, e.g. only the
+    fields of `where` are kept, the types keep `1` and `True` apart. Cheaper than sorting
+    and pickling them, raises TypeError if a part is unhashable.
+    """
+    shape = [hash_method]
+    for k, v in query.items():
+        t = type(v)
+        if t is list or t is tuple or t is dict:
+            shape.append((k, t, tuple(v), tuple(map(type, v))))
+        else:
+            shape.append((k, t, v))
+
+    return tuple(shape)
+
+
+def _make_query_fingerprint(query, hash_method='md5'):
     sorted_query = []
     for k in sorted(query.keys()):
         value = query.get(k)
@@ -41,6 +125,15 @@ def get_query_fingerprint(query, hash_method='md5'):
     return method(pickle.dumps(sorted_query)).hexdigest()
 
 
+def make_compact_key(prefix, key):
+    """
+    Fixed-length form of a long cache key, `<prefix>:<digest>`, the digest is 128 bits of
+    blake2b in url-safe base64 (22 characters)
+    """
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    return '{}:{}'.format(prefix, base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii'))
+
+
 def make_cache_key_for_object(obj):
     import pickle
     import hashlib
@@ -0,0 +1,51 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_aio.py
+# Date   : 2017-10-23 14-00
+# Version: 0.0.1
+# Description: cached coroutine functions.
+
+import asyncio
+
+from mycache.output import output_cache
+
+
+def test_coroutine_hit_and_miss():
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory')
+    async def double(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    async def run():
+        assert await double(1) == 2 and await double(1) == 2 and calls == [1]
+        assert await double(2) == 4 and calls == [1, 2]
+
+        # Computed and cached again
+        assert await double(1, refresh_cache_now=True) == 2 and calls == [1, 2, 1]
+        assert await double(1) == 2 and calls == [1, 2, 1]
+
+    asyncio.run(run())
+
+
+def test_coroutine_shared_task():
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory')
+    async def slow_double(x):
+        calls.append(x)
+        await asyncio.sleep(0.2)
+        return x * 2
+
+    async def run():
+        # Concurrent misses of the same key await one computation
+        outputs = await asyncio.gather(*[slow_double(x) for x in (1, 1, 1, 2, 2)])
+        assert outputs == [2, 2, 2, 4, 4] and sorted(calls) == [1, 2]
+
+        # Mix of hits and misses in the input order
+        assert await slow_double.many([3, 1, 3, 2, 4]) == [6, 2, 6, 4, 8] and sorted(calls) == [1, 2, 3, 4]
+
+    asyncio.run(run())
@@ -0,0 +1,65 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_broadcast.py
+# Date   : 2017-09-25 16-00
+# Version: 0.0.1
+# Description: local query results dropped by the messages of other processes.
+
+import shutil
+import tempfile
+import time
+
+from mycache.broadcast import LocalSocketBroadcast
+from mycache.localquery import LocalQueryCache
+from mycache.memory import MemoryCache
+
+
+class Folder(object):
+    pass
+
+
+def _wait(predicate, seconds=2):
+    deadline = time.time() + seconds
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+
+    return predicate()
+
+
+def test_local_socket_invalidation():
+    socket_dir = tempfile.mkdtemp()
+    cache_db = MemoryCache()
+    cache_db.set('folder_local_version', 0)
+    broadcasts = [LocalSocketBroadcast(socket_dir) for _ in range(2)]
+
+    try:
+        caches = [LocalQueryCache(Folder, cache_db, x) for x in broadcasts]
+        for cache in caches:
+            cache.check(force=True)
+            cache.set('k1', {'folder_id': 1}, [1], cache.version)
+            cache.set('k2', {'folder_id': 2}, [2], cache.version)
+
+        caches[0].invalidate([{'folder_id': 1}])
+        assert caches[0].get('k1') is None and caches[0].get('k2') == [2]
+        assert _wait(lambda: caches[1].get('k1') is None) and caches[1].get('k2') == [2]
+
+        # A message is missed, the next one drops everything
+        cache_db.inc('folder_local_version')
+        caches[0].invalidate([{'folder_id': 3}])
+        assert _wait(lambda: len(caches[1]) == 0)
+
+        # Results loaded during an invalidation are not kept
+        version = caches[1].version
+        caches[0].invalidate([{'folder_id': 1}])
+        assert _wait(lambda: caches[1].version != version)
+        assert caches[1].set('k1', {'folder_id': 1}, [1], version) is False
+    finally:
+        for broadcast in broadcasts:
+            broadcast.close()
+
+        shutil.rmtree(socket_dir)
+
+
+if __name__ == '__main__':
+    test_local_socket_invalidation()
@@ -0,0 +1,114 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_bulk.py
+# Date   : 2017-10-25 16-00
+# Version: 0.0.1
+# Description: bulk writes invalidate the old and new values of all the rows in one deduplicated pass.
+
+from benchmarks.standins import make_model
+from mycache.query import DataObjectsManagerWithCache
+from mycache.tracker import canonical_where
+
+
+def _record_removes(monkeypatch):
+    removes = []
+    remove_related = DataObjectsManagerWithCache._remove_related
+
+    def record(self, queries, rows, entity_keys=()):
+        removes.append(([q['where'] for q in queries], rows, list(entity_keys)))
+        return remove_related(self, queries, rows, entity_keys)
+
+    monkeypatch.setattr(DataObjectsManagerWithCache, '_remove_related', record)
+    return removes
+
+
+def _ids(results):
+    return sorted(x.folder_id for x in results)
+
+
+def _cache_names(folder, names):
+    for name in names:
+        list(folder.objects.filter(name=name))
+
+
+def test_bulk_update(monkeypatch):
+    folder = make_model('BulkUpdateFolder', rows=10)
+    table = folder.Meta.table
+    _cache_names(folder, ['name_1', 'name_2', 'name_3'])
+
+    instances = [folder.objects.get(folder_id=x) for x in (1, 2, 3, 4, 5)]
+    for instance in instances:
+        instance.name = 'name_9'
+
+    removes = _record_removes(monkeypatch)
+    queries = table.queries
+    assert folder.objects.bulk_update(instances, batch_size=2) == [1] * 5
+
+    # The old rows are read 2 at a time, then invalidated once, without duplicated conditions
+    assert table.queries - queries == 3 and len(removes) == 1
+    wheres, rows, entity_keys = removes[0]
+    assert len(wheres) == len({canonical_where(x) for x in wheres}) and len(rows) == 10 and entity_keys == []
+
+    # Queries of the old and the new names are invalidated
+    assert _ids(folder.objects.filter(name='name_1')) == []
+    assert _ids(folder.objects.filter(name='name_9')) == [1, 2, 3, 4, 5, 9]
+    assert _ids(folder.objects.filter(folder_id__lt=3)) == [1, 2]
+
+
+def test_bulk_update_without_old_rows(monkeypatch):
+    folder = make_model('BulkUpdatePrimaryKeyFolder', rows=5, cache_conditions={'*': 3600, 'folder_id': 3600})
+    table = folder.Meta.table
+    instances = list(folder.objects.all())
+    for instance in instances:
+        instance.name = 'new'
+
+    # The queries depend on the primary keys only
+    queries = table.queries
+    folder.objects.bulk_update(instances)
+    assert table.queries == queries
+    assert {x.name for x in folder.objects.all()} == {'new'}
+
+
+def test_bulk_update_normalized():
+    folder = make_model('BulkUpdateNormalizedFolder', rows=5, normalized=True)
+    table = folder.Meta.table
+    _cache_names(folder, ['name_1', 'name_2'])
+
+    instances = [folder.objects.get(folder_id=x) for x in (1, 2)]
+    for instance in instances:
+        instance.name = 'name_3'
+
+    # The old rows are cached under their primary keys
+    queries = table.queries
+    folder.objects.bulk_update(instances)
+    assert table.queries == queries
+
+    assert _ids(folder.objects.filter(name='name_1')) == [] and _ids(folder.objects.filter(name='name_3')) == [1, 2, 3]
+
+
+def test_bulk_delete(monkeypatch):
+    folder = make_model('BulkDeleteFolder', rows=5, normalized=True)
+    table = folder.Meta.table
+    _cache_names(folder, ['name_1', 'name_2'])
+
+    removes = _record_removes(monkeypatch)
+    queries = table.queries
+    assert folder.objects.bulk_delete([folder(folder_id=x, name='name_{}'.format(x)) for x in (1, 2)]) == [1, 1]
+
+    # Nothing is read, the rows cached under the primary keys are dropped with the queries
+    assert table.queries == queries and len(removes) == 1
+    assert sorted(removes[0][2]) == ['bulk_delete_folder_pk_1', 'bulk_delete_folder_pk_2']
+    assert _ids(folder.objects.filter(name='name_1')) == [] and _ids(folder.objects.all()) == [3, 4, 5]
+
+
+def test_bulk_dump():
+    folder = make_model('BulkDumpFolder', rows=3)
+    _cache_names(folder, ['name_1', 'name_4'])
+    assert _ids(folder.objects.all()) == [1, 2, 3]
+
+    # A new row and a replaced one
+    folder.objects.bulk_dump([folder(name='name_4', icon_url=''), folder(folder_id=1, name='name_5', icon_url='')])
+    assert _ids(folder.objects.all()) == [1, 2, 3, 4]
+    assert _ids(folder.objects.filter(name='name_4')) == [4]
+    assert _ids(folder.objects.filter(name='name_1')) == []
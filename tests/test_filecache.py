@@ -0,0 +1,82 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_filecache.py
+# Date   : 2017-09-04 16-30
+# Version: 0.0.1
+# Description: processes sharing one sharded file cache.
+
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import Process
+
+from mycache.filecache import ShardedFileCache
+
+WORKERS = 4
+ROUNDS = 200
+THRESHOLD = 100
+
+
+def _work(cache_dir, worker_id):
+    cache_db = ShardedFileCache(cache_dir, threshold=THRESHOLD)
+
+    for i in range(ROUNDS):
+        key = 'w{}_{}'.format(worker_id, i)
+        cache_db.set(key, (worker_id, i))
+
+        # May be evicted by others already, but never partial
+        assert cache_db.get(key) in (None, (worker_id, i))
+
+
+def _count_files(cache_dir):
+    return sum(len(files) for root, dirs, files in os.walk(cache_dir)
+               if root != cache_dir and os.path.basename(root) != 'locks')
+
+
+def test_basic_operations():
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        cache_db = ShardedFileCache(cache_dir, mmap_threshold=1024)
+        assert cache_db.set('a', 1) and cache_db.get('a') == 1
+        assert cache_db.add('a', 2) is False and cache_db.get('a') == 1
+
+        cache_db.set('big', list(range(10000)))
+        assert cache_db.get('big') == list(range(10000))
+
+        cache_db.set('short', 1, timeout=1)
+        time.sleep(1.1)
+        assert cache_db.get('short') is None and cache_db.has('short') is False
+
+        assert cache_db.get_many('a', 'big', 'missing')[::2] == [1, None]
+        cache_db.delete_many('a', 'big')
+        assert len(cache_db) == 0 and _count_files(cache_dir) == 0
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_concurrent_writers():
+    cache_dir = tempfile.mkdtemp()
+
+    try:
+        workers = [Process(target=_work, args=(cache_dir, i)) for i in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+        cache_db = ShardedFileCache(cache_dir, threshold=THRESHOLD)
+
+        # The index agrees with the files, and the threshold holds
+        assert len(cache_db) == _count_files(cache_dir) <= THRESHOLD
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    test_basic_operations()
+    test_concurrent_writers()
@@ -0,0 +1,104 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_flight.py
+# Date   : 2017-10-23 11-00
+# Version: 0.0.1
+# Description: concurrent misses on the same key run one loader.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, Lock
+
+from mycache.flight import SingleFlight, load_with_lock
+from mycache.memory import MemoryCache
+from mycache.output import output_cache
+
+THREADS = 8
+
+
+class _Loader(object):
+    def __init__(self, value=1, seconds=0.2, error=None):
+        self.value = value
+        self.seconds = seconds
+        self.error = error
+        self.calls = 0
+        self._lock = Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+
+        time.sleep(self.seconds)
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+
+def _run_together(func, threads=THREADS):
+    barrier = Barrier(threads)
+
+    def run(_):
+        barrier.wait()
+        return func()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(run, range(threads)))
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    loader = _Loader()
+
+    assert _run_together(lambda: flight.do('key', loader, 5)) == [1] * THREADS
+    assert loader.calls == 1 and len(flight) == 0
+
+    # Nothing is kept once the leader is done
+    assert flight.do('key', loader) == 1 and loader.calls == 2
+
+
+def test_single_flight_failure_and_timeout():
+    flight = SingleFlight()
+    loader = _Loader(error=ValueError('oops'))
+
+    def load():
+        try:
+            return flight.do('key', loader, 5)
+        except ValueError:
+            return 'failed'
+
+    # The waiters run the loader by themselves after the leader failed
+    assert _run_together(load) == ['failed'] * THREADS and loader.calls == THREADS
+
+    loader = _Loader(seconds=0.5)
+    assert _run_together(lambda: flight.do('key', loader, 0.1), 2) == [1, 1] and loader.calls == 2
+
+
+def test_load_with_lock():
+    cache_db = MemoryCache()
+    loader = _Loader()
+
+    def load():
+        cache_db.set('key', loader())
+        return cache_db.get('key')
+
+    assert _run_together(lambda: load_with_lock(cache_db, 'key', cache_db.get, load)) == [1] * THREADS
+    assert loader.calls == 1
+
+
+def test_output_single_flight():
+    calls = []
+
+    @output_cache(timeout=1, cache_type='memory', single_flight=True, single_flight_timeout=5)
+    def slow_square(x):
+        calls.append(x)
+        time.sleep(0.2)
+        return x * x
+
+    assert _run_together(lambda: slow_square(3)) == [9] * THREADS and calls == [3]
+
+    # Hit, then expired and computed again
+    assert slow_square(3) == 9 and calls == [3]
+    time.sleep(1.1)
+    assert slow_square(3) == 9 and calls == [3, 3]
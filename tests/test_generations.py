@@ -0,0 +1,75 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_generations.py
+# Date   : 2017-10-24 16-00
+# Version: 0.0.1
+# Description: a new generation makes the keys of its namespace unreachable, and only them.
+
+from benchmarks.standins import make_model
+from mycache.query import CacheManager
+
+CONDITIONS = {'*': 3600, 'folder_id': 3600, 'name': 3600, 'name+folder_id': 3600}
+
+QUERIES = {
+    'all': {},
+    'folder_1': {'folder_id': 1},
+    'folder_2': {'folder_id': 2},
+    'name_1': {'name': 'name_1'},
+    'name_1_folder_1': {'name': 'name_1', 'folder_id': 1},
+    'name_2_folder_2': {'name': 'name_2', 'folder_id': 2},
+}
+
+
+def _missed(folder):
+    """
+    :return: names of the queries answered by the table
+    """
+    table = folder.Meta.table
+    missed = []
+
+    for name, where in sorted(QUERIES.items()):
+        queries = table.queries
+        list(folder.objects.filter(**where) if where else folder.objects.all())
+        if table.queries > queries:
+            missed.append(name)
+
+    return missed
+
+
+def _keys(folder):
+    cache = CacheManager(folder, folder.objects.cache_db)
+    return {name: cache.get_cache_key(folder.objects.filter(**where)._query_collector)
+            for name, where in QUERIES.items() if where}
+
+
+def test_clear_cache():
+    folder = make_model('GenerationClearFolder', rows=5, cache_conditions=CONDITIONS, cache_generations=True)
+
+    assert _missed(folder) == sorted(QUERIES) and _missed(folder) == []
+    keys = _keys(folder)
+
+    folder.objects.clear_cache()
+    assert not set(keys.values()) & set(_keys(folder).values())
+    assert _missed(folder) == sorted(QUERIES) and _missed(folder) == []
+
+    # The old entries are left to expire by themselves
+    assert all(folder.objects.cache_db.get(x) is not None for x in keys.values())
+
+
+def test_field_generations():
+    folder = make_model('GenerationFieldFolder', rows=5, cache_conditions=CONDITIONS,
+                        cache_generations=['folder_id'])
+
+    assert _missed(folder) == sorted(QUERIES) and _missed(folder) == []
+    keys = _keys(folder)
+
+    instance = folder.objects.get(folder_id=1)
+    instance.icon_url = 'https://example.com/new.png'
+    folder.objects.update(instance)
+
+    # The namespaces of `folder_id=1` and `*` are renewed, `name` is tracked and discarded
+    new_keys = _keys(folder)
+    assert {x for x in keys if keys[x] != new_keys[x]} == {'folder_1', 'name_1_folder_1'}
+    assert _missed(folder) == ['all', 'folder_1', 'name_1', 'name_1_folder_1']
+    assert [x.icon_url for x in folder.objects.filter(name='name_1', folder_id=1)] == ['https://example.com/new.png']
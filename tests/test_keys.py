@@ -0,0 +1,90 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_keys.py
+# Date   : 2017-10-19 11-00
+# Version: 0.0.1
+# Description: memoized query fingerprints keep the old values, compact keys have a fixed length,
+# output keys are the same as the ones of the old versions.
+
+import hashlib
+import inspect
+import os
+import pickle
+from collections import ChainMap
+
+from mycache.output import Params, _compile_key_builder
+from mycache.utils import _make_query_fingerprint, get_query_fingerprint, make_compact_key
+
+CALLS = [((), {}), ((1, 'a'), {}), ((1,), {'y': 'a'}), ((None, [1, 2]), {'z': {'k': 1}}), (('中文',), {'y': 1.5})]
+
+
+def _old_cache_key(func, cache_type, custom_cache_key, *args, **kwargs):
+    """
+    `make_cache_key` of version 2017-07-17
+    """
+    if custom_cache_key:
+        params = Params(
+            ChainMap(dict(zip(list(inspect.signature(func).parameters.keys())[:len(args)], args)), kwargs))
+        key = custom_cache_key.format(**params)
+        key = '_'.join(f.strip() for f in key.split('_') if f.strip() != 'None')
+        return key
+
+    mod = inspect.getmodule(func)
+    name = '{}.{}.{}'.format(cache_type, os.path.splitext(os.path.split(mod.__file__)[-1])[0], func.__name__)
+    items = tuple(str(x) for x in args) + tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+    return '{}_{}'.format(name, hashlib.md5(pickle.dumps(items)).hexdigest())
+
+
+def function_spam(x=None, y=None, z=None):
+    pass
+
+
+def test_output_keys():
+    for cache_type in ('redis', 'file'):
+        make_cache_key = _compile_key_builder(function_spam, cache_type, key_hasher=None)
+        for args, kwargs in CALLS:
+            key = make_cache_key(args, kwargs)
+            assert key == _old_cache_key(function_spam, cache_type, None, *args, **kwargs)
+            assert key.startswith('{}.test_keys.function_spam_'.format(cache_type))
+
+    template = 'function_spam_{x}_{y}_{z}'
+    make_cache_key = _compile_key_builder(function_spam, 'redis', template)
+    for args, kwargs in [((1, 'a', None), {}), ((1,), {'y': 'a', 'z': 2}), ((), {'x': '中文', 'y': 1.5, 'z': 0})]:
+        assert make_cache_key(args, kwargs) == _old_cache_key(function_spam, 'redis', template, *args, **kwargs)
+
+    assert make_cache_key((10, 20, 30), {}) == 'function_spam_10_20_30'
+    assert make_cache_key((10,), {'z': 30, 'y': 'b'}) == 'function_spam_10_b_30'
+
+
+def test_missing_template_fields():
+    make_cache_key = _compile_key_builder(function_spam, 'redis', 'function_spam_{x}_{y}_{z}_{w}')
+
+    # The old versions raised KeyError, missing fields are "None" and removed now
+    assert make_cache_key((1,), {}) == 'function_spam_1'
+    assert make_cache_key((1,), {'z': 3}) == 'function_spam_1_3'
+    assert make_cache_key((), {'w': 'x'}) == 'function_spam_x'
+
+
+def test_memoized_fingerprints():
+    queries = [{'select': ['folder_id', 'name'], 'where': {'name': 'abc', 'folder_id': 1}},
+               {'select': ['folder_id', 'name'], 'where': {'name': 'xyz', 'folder_id': 2}},
+               {'select': ['name', 'folder_id'], 'where': {'name': 'abc'}, 'order_by': 'name', 'limit': (20, 40)},
+               {'select': ['folder_id'], 'where': {}, 'limit': True},
+               {'select': ['folder_id'], 'where': {}, 'limit': 1},
+               {'select': ['folder_id'], 'where': {'tags': [[1], [2]]}, 'limit': [[20]]}]
+
+    for query in queries * 2:
+        for hash_method in ('md5', 'sha1'):
+            assert get_query_fingerprint(query, hash_method) == _make_query_fingerprint(query, hash_method)
+
+    assert get_query_fingerprint(queries[0]) == get_query_fingerprint(queries[1])
+
+
+def test_compact_keys():
+    keys = ['folder_where_*_fp_0', 'folder_where_name={}_fp_0'.format('文件夹' * 100)]
+    compact_keys = [make_compact_key('fd', x) for x in keys]
+
+    assert len(set(compact_keys)) == 2
+    assert all(x.startswith('fd:') and len(x) == 25 for x in compact_keys)
+    assert compact_keys[0] == make_compact_key('fd', keys[0])
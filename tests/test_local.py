@@ -0,0 +1,71 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_local.py
+# Date   : 2017-10-23 10-30
+# Version: 0.0.1
+# Description: the in-process LRU tier in front of the cache db.
+
+import time
+
+from mycache.local import LocalCache
+from mycache.output import _create_cache, output_cache
+
+
+def test_hit_miss_and_expiry():
+    cache = LocalCache(max_entries=10, default_timeout=1)
+    assert cache.get('a') is None
+
+    cache.set('a', 1)
+    cache.set('b', 2, timeout=0)
+    assert cache.get('a') == 1 and 'a' in cache
+
+    time.sleep(1.1)
+    assert cache.get('a') is None and cache.get('b') == 2 and len(cache) == 1
+
+
+def test_eviction():
+    cache = LocalCache(max_entries=3)
+    for key in 'abc':
+        cache.set(key, key)
+
+    # "a" is used recently, "b" is the least recently used one
+    cache.get('a')
+    cache.set('d', 'd')
+    assert cache.get('b') is None and [cache.get(x) for x in 'acd'] == ['a', 'c', 'd']
+
+    cache = LocalCache(max_entries=100, max_bytes=1000)
+    assert cache.set('huge', 'x' * 2000) is False and cache.get('huge') is None
+
+    for i in range(20):
+        cache.set(i, 'x' * 100)
+    assert cache.size_in_bytes <= 1000 and cache.get(19) is not None and cache.get(0) is None
+
+    size = len(cache)
+    assert cache.delete_if(lambda value: True) == size and len(cache) == 0 and cache.size_in_bytes == 0
+
+
+def test_output_cache_tier():
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory', local_cache_size=10, local_cache_timeout=1,
+                  default_timeout=61)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    cache_db = _create_cache(cache_type='memory', default_timeout=61)
+
+    assert square(3) == 9 and len(square.local_cache) == 1
+    cache_db.clear()
+
+    # Served by the local tier without the cache db
+    assert square(3) == 9 and calls == [3]
+
+    # Expired locally, missed in the cleared cache db
+    time.sleep(1.1)
+    assert square(3) == 9 and calls == [3, 3]
+
+    # Expired locally, hit in the cache db and kept locally again
+    time.sleep(1.1)
+    assert square(3) == 9 and calls == [3, 3] and len(square.local_cache) == 1
@@ -0,0 +1,153 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_lookups.py
+# Date   : 2017-10-09 10-40
+# Version: 0.0.1
+# Description: only the tracked conditions with lookups satisfied by the old or new row are discarded.
+
+import itertools
+
+import pytest
+
+from mycache.tracker import LOOKUPS, BlobTrackerStore, RedisTrackerStore, is_related, make_related_predicate, matches
+
+# lookup -> (value of the condition, expected result of each value of the row)
+CASES = {
+    'exact': (5, {None: False, 3: False, 5: True, 7: False}),
+    'ne': (5, {None: False, 3: True, 5: False, 7: True}),
+    'lt': (5, {None: False, 3: True, 5: False, 7: False}),
+    'lte': (5, {None: False, 3: True, 5: True, 7: False}),
+    'gt': (5, {None: False, 3: False, 5: False, 7: True}),
+    'gte': (5, {None: False, 3: False, 5: True, 7: True}),
+    'in': ([3, 5], {None: False, 3: True, 5: True, 7: False}),
+    'not_in': ([3, 5], {None: False, 3: False, 5: False, 7: True}),
+    'range': ((4, 6), {None: False, 3: False, 5: True, 7: False}),
+    'between': ((4, 6), {None: False, 3: False, 5: True, 7: False}),
+    'isnull': (True, {None: True, 3: False, 5: False, 7: False}),
+    'contains': ('fol', {None: False, 'Folder': True, 'folder': True, 'file': False}),
+    'icontains': ('FOL', {None: False, 'Folder': True, 'folder': True, 'file': False}),
+    'startswith': ('fo', {None: False, 'Folder': True, 'folder': True, 'file': False}),
+    'istartswith': ('FO', {None: False, 'Folder': True, 'folder': True, 'file': False}),
+    'endswith': ('DER', {None: False, 'Folder': True, 'folder': True, 'file': False}),
+    'iendswith': ('DER', {None: False, 'Folder': True, 'folder': True, 'file': False}),
+}
+
+
+class StandInCache(object):
+    def __init__(self):
+        self.data = dict()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.delete(key)
+        return True
+
+
+def test_every_lookup_is_covered():
+    assert set(CASES) == set(LOOKUPS)
+
+
+@pytest.mark.parametrize('lookup', sorted(CASES))
+def test_matches(lookup):
+    expected, results = CASES[lookup]
+    for value, result in results.items():
+        assert matches({'field__' + lookup: expected}, {'field': value}) is result, (lookup, value)
+
+
+def test_unknown_lookups_and_fields_match():
+    assert matches({'field__regex': '^a'}, {'field': 'b'})
+    assert matches({'other__lt': 1}, {'field': 5})
+    assert matches({'field__lt': 'a'}, {'field': 5})
+
+
+def test_strings_match_with_either_collation():
+    # `_ci`: 'foo' = 'Foo', binary: 'foo' != 'Foo', either may be the collation of the column
+    assert matches({'name': 'Foo', 'folder_id__lt': 10}, {'name': 'foo', 'folder_id': 5})
+    assert matches({'name__in': ['Foo', 'Bar']}, {'name': 'foo'})
+    assert matches({'name__ne': 'Foo'}, {'name': 'foo'}) and matches({'name__not_in': ['Foo']}, {'name': 'foo'})
+    assert matches({'name__lt': 'b'}, {'name': 'A'}) and matches({'name__lt': 'B'}, {'name': 'a'})
+    assert not matches({'name__ne': 'foo'}, {'name': 'foo'}) and not matches({'name__in': ['bar']}, {'name': 'foo'})
+
+
+def test_composite_conditions():
+    where = {'folder_id__gt': 10, 'name__contains': 'abc'}
+    assert matches(where, {'folder_id': 11, 'name': 'xabcx'})
+    assert not matches(where, {'folder_id': 9, 'name': 'xabcx'})
+    assert not matches(where, {'folder_id': 11, 'name': 'xyz'})
+
+
+def _track_all(store):
+    """
+    :return: dict, cache key -> tracked condition, one for each lookup and value
+    """
+    tracked = dict()
+    for i, lookup in enumerate(sorted(CASES)):
+        for j, value in enumerate(CASES[lookup][1]):
+            # Row values become the values of the conditions, so that each lookup
+            # has tracked conditions both satisfied and not by each row
+            where = {'field__' + lookup: CASES[lookup][0] if value is None else value}
+            key = 'key_{}_{}'.format(i, j)
+            store.track(key, where, 'value', 300)
+            tracked[key] = where
+
+    store.flush()
+    return tracked
+
+
+def _check_discard(make_store):
+    values = [None, 3, 5, 7, 'Folder', 'folder', 'file']
+
+    for old, new in itertools.product(values, repeat=2):
+        tracked = _track_all(make_store())
+        rows = [{'field': new}, {'field': old}]
+        wheres = [{'field__' + lookup: None} for lookup in CASES]
+
+        store = make_store()
+        discarded = set(store.discard_many(wheres, (), rows))
+        store.flush()
+
+        expected = {k for k, where in tracked.items() if any(matches(where, row) for row in rows)}
+        assert discarded == expected, (old, new)
+
+        # Without rows everything with lookups is discarded
+        store = make_store()
+        assert set(store.discard_many(wheres)) == set(tracked) - discarded
+        store.flush()
+
+
+def test_blob_store_discard():
+    cache_db = StandInCache()
+    _check_discard(lambda: BlobTrackerStore(cache_db, 'query_tracker_for_folder'))
+
+
+def test_redis_store_discard():
+    fakeredis = pytest.importorskip('fakeredis')
+    from werkzeug.contrib.cache import RedisCache
+
+    cache_db = RedisCache()
+    cache_db._client = fakeredis.FakeStrictRedis()
+    _check_discard(lambda: RedisTrackerStore(cache_db, 'query_tracker_for_folder'))
+
+
+def test_related_predicate():
+    wheres = [{'folder_id': 1, 'name': 'a'}, {'name': 'b', 'folder_id__lt': None}, {}, {'folder_id__gt': None}]
+    rows = [{'folder_id': 1, 'name': 'a'}]
+    tracked = [{'folder_id': 1, 'name': 'a'}, {'folder_id': 2, 'name': 'a'}, {'name': 'b'}, {'name': 'c'}, {},
+               {'folder_id__lt': 2}, {'folder_id__lt': 1}, {'folder_id__gt': 0, 'name': 'c'}, {'folder_id__gt': 5}]
+
+    for where_rows in (rows, None):
+        is_related_to_any = make_related_predicate(wheres, where_rows)
+        for value in tracked:
+            expected = any(is_related(where, value, where_rows) for where in wheres)
+            assert is_related_to_any(value) is expected, (value, where_rows)
@@ -0,0 +1,52 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_many.py
+# Date   : 2017-10-23 14-30
+# Version: 0.0.1
+# Description: resolve many calls with one multi-get and one multi-set.
+
+import time
+
+from mycache.output import _create_cache, output_cache
+
+
+class _CountingCache(object):
+    """
+    Counts the accesses of the shared memory cache
+    """
+
+    def __init__(self, cache_db):
+        self._cache_db = cache_db
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self._cache_db, name)
+
+
+def test_many_order_and_hits(monkeypatch):
+    calls = []
+
+    @output_cache(timeout=1, cache_type='memory')
+    def power(x, y=2):
+        calls.append((x, y))
+        return x ** y
+
+    assert power(2) == 4 and power(3, 3) == 27
+
+    cache_db = _CountingCache(_create_cache(cache_type='memory'))
+    monkeypatch.setattr('mycache.output._get_cache_instance', lambda *args: cache_db)
+
+    # Outputs in the input order, duplicates computed once, hits not computed at all
+    outputs = power.many([(5,), 2, (3, 3), 5, {'x': 4, 'y': 1}, (2,)], max_workers=4)
+    assert outputs == [25, 4, 27, 25, 4, 4] and sorted(calls[2:]) == [(4, 1), (5, 2)]
+    assert cache_db.calls == ['get_many', 'set_many']
+
+    # All hits
+    calls.clear()
+    assert power.many([2, 5]) == [4, 25] and calls == []
+
+    # Expired
+    time.sleep(1.1)
+    assert power.many([2, 5]) == [4, 25] and sorted(calls) == [(2, 2), (5, 2)]
@@ -0,0 +1,110 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_memory.py
+# Date   : 2017-10-24 14-00
+# Version: 0.0.1
+# Description: the in-process cache db, expiry, eviction and locking.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+from mycache.memory import MemoryCache
+
+THREADS = 8
+ROUNDS = 500
+
+
+def test_basic_operations():
+    cache_db = MemoryCache()
+    assert cache_db.set('a', [1]) and cache_db.get('a') == [1]
+    assert cache_db.add('a', 2) is False and cache_db.add('b', 2) and cache_db.get_many('a', 'b', 'c') == [[1], 2, None]
+
+    # Values are copies, never shared with the callers
+    cache_db.get('a').append(2)
+    assert cache_db.get('a') == [1]
+
+    assert cache_db.inc('n') == 1 and cache_db.inc('n', 5) == 6
+    assert cache_db.delete_many('a', 'n') and len(cache_db) == 1
+    assert cache_db.clear() and len(cache_db) == 0 and cache_db.size_in_bytes == 0
+
+
+def test_expiry():
+    cache_db = MemoryCache(default_timeout=1)
+    cache_db.set('a', 1)
+    cache_db.set('b', 2, timeout=0)
+    cache_db.set('c', 3, timeout=10)
+    assert cache_db.has('a') and len(cache_db) == 3
+
+    time.sleep(1.1)
+    assert not cache_db.has('a') and cache_db.get('b') == 2
+
+    # Purged from the top of the heap by the next write, never read again
+    cache_db.set('d', 4)
+    assert len(cache_db) == 3 and cache_db.get_many('a', 'b', 'c') == [None, 2, 3]
+
+    # An outdated expiry time doesn't remove the key set again
+    cache_db.set('e', 5, timeout=1)
+    cache_db.set('e', 6, timeout=10)
+    time.sleep(1.1)
+    cache_db.set('f', 7)
+    assert cache_db.get('e') == 6 and cache_db.get('d') is None
+
+
+def test_eviction():
+    cache_db = MemoryCache(max_entries=10, stripes=2)
+    for i in range(100):
+        cache_db.set(i, i)
+    assert len(cache_db) == 10 and cache_db.get(99) == 99 and cache_db.get(0) is None
+
+    cache_db = MemoryCache(max_bytes=10 * 1024)
+    for i in range(100):
+        cache_db.set(i, 'x' * 1024)
+    assert cache_db.size_in_bytes <= 10 * 1024 and 0 < len(cache_db) < 10
+    assert cache_db.get(99) is not None and cache_db.get(0) is None
+
+
+def test_concurrent_writers():
+    cache_db = MemoryCache(stripes=4)
+    barrier = Barrier(THREADS)
+
+    def work(worker_id):
+        barrier.wait()
+        for i in range(ROUNDS):
+            cache_db.inc('counter')
+            cache_db.set('w{}_{}'.format(worker_id, i), i)
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        list(executor.map(work, range(THREADS)))
+
+    # No lost increments, no lost or miscounted entries
+    assert cache_db.get('counter') == THREADS * ROUNDS
+    assert len(cache_db) == THREADS * ROUNDS + 1
+    assert all(cache_db.get('w{}_{}'.format(w, i)) == i for w in range(THREADS) for i in range(ROUNDS))
+
+
+def test_lock():
+    cache_db = MemoryCache()
+    holders = []
+
+    def work(worker_id):
+        lock = cache_db.lock('name', blocking_timeout=5)
+        assert lock.acquire()
+        try:
+            holders.append(worker_id)
+            time.sleep(0.01)
+            assert holders[-1] == worker_id
+        finally:
+            lock.release()
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        list(executor.map(work, range(THREADS)))
+
+    assert sorted(holders) == list(range(THREADS))
+
+    lock = cache_db.lock('name', blocking_timeout=0.1)
+    assert lock.acquire()
+    assert cache_db.lock('name', blocking_timeout=0.1).acquire() is False
+    assert cache_db.lock('other', blocking_timeout=0.1).acquire()
+    lock.release()
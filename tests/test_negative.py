@@ -0,0 +1,52 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_negative.py
+# Date   : 2017-10-24 15-00
+# Version: 0.0.1
+# Description: empty outputs are cached for `negative_timeout` seconds.
+
+import time
+
+from mycache.output import _create_cache, output_cache
+from mycache.stats import METRICS, output_scope
+
+
+def test_empty_outputs_not_cached():
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory', ignore_outputs=[[]])
+    def find(x):
+        calls.append(x)
+        return None if x == 'none' else []
+
+    assert find('none') is None and find('none') is None
+    assert find('empty') == [] and find('empty') == []
+    assert calls == ['none', 'none', 'empty', 'empty']
+
+
+def test_negative_entries():
+    _create_cache(cache_type='memory').clear()
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory', ignore_outputs=[[]], negative_timeout=1, local_cache_size=10)
+    def find(x):
+        calls.append(x)
+        return {'none': None, 'empty': []}.get(x, x)
+
+    METRICS.reset()
+    METRICS.enable()
+    try:
+        assert [find(x) for x in ('none', 'empty', 'x')] == [None, [], 'x']
+        assert [find(x) for x in ('none', 'empty', 'x')] == [None, [], 'x'] and calls == ['none', 'empty', 'x']
+        assert find.many(['none', 'empty', 'x', 'y']) == [None, [], 'x', 'y'] and calls[3:] == ['y']
+
+        counters = METRICS.snapshot()[output_scope(find.__wrapped__)]
+        assert counters['negative_hits'] == 4 and counters['negative_misses'] == 2
+    finally:
+        METRICS.disable()
+
+    # Negative entries expire after `negative_timeout`, in both tiers
+    time.sleep(1.1)
+    assert [find(x) for x in ('none', 'empty', 'x')] == [None, [], 'x']
+    assert calls[4:] == ['none', 'empty']
@@ -0,0 +1,75 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_normalized.py
+# Date   : 2017-10-23 16-00
+# Version: 0.0.1
+# Description: queries cached as primary keys, rows cached once under their primary keys.
+
+from benchmarks.standins import make_model
+from mycache.query import CacheManager, PrimaryKeyList
+
+
+def _names(results):
+    return sorted((x.folder_id, x.name) for x in results)
+
+
+def test_primary_key_lists():
+    folder = make_model('NormalizedListFolder', rows=5, normalized=True)
+    cache_db, table = folder.objects.cache_db, folder.Meta.table
+
+    assert _names(folder.objects.filter(name='name_1')) == [(1, 'name_1')]
+    assert _names(folder.objects.filter(name='name_1')) == [(1, 'name_1')] and table.queries == 1
+
+    stored = [cache_db.get(x) for x in list(cache_db._data)]
+    assert PrimaryKeyList([1]) in stored and isinstance(stored[stored.index([1])], PrimaryKeyList)
+
+    entity = cache_db.get(CacheManager(folder, cache_db).get_entity_key(1))
+    assert (entity.folder_id, entity.name) == (1, 'name_1')
+
+    # A missing row is a miss of the whole query
+    cache_db.delete(CacheManager(folder, cache_db).get_entity_key(1))
+    assert _names(folder.objects.filter(name='name_1')) == [(1, 'name_1')] and table.queries == 2
+    assert _names(folder.objects.filter(name='name_1')) == [(1, 'name_1')] and table.queries == 2
+
+
+def test_update_fast_path():
+    folder = make_model('NormalizedUpdateFolder', rows=5, normalized=True)
+    cache_db, table = folder.objects.cache_db, folder.Meta.table
+
+    assert len(list(folder.objects.filter(name='name_2'))) == 1
+    keys = set(cache_db._data)
+
+    # `icon_url` is not a condition field, only the row is rewritten
+    instance = folder.objects.get(folder_id=2)
+    queries = table.queries
+    instance.icon_url = 'https://example.com/new.png'
+    folder.objects.update(instance)
+
+    # The old row is cached, the database is not queried at all
+    assert set(cache_db._data) >= keys
+    assert [x.icon_url for x in folder.objects.filter(name='name_2')] == ['https://example.com/new.png']
+    assert table.queries == queries
+
+    # `name` is, the queries of the old and the new names are invalidated
+    instance.name = 'name_3'
+    folder.objects.update(instance)
+    assert _names(folder.objects.filter(name='name_2')) == []
+    assert _names(folder.objects.filter(name='name_3')) == [(2, 'name_3'), (3, 'name_3')]
+
+
+def test_dump_replaces_the_row():
+    folder = make_model('NormalizedDumpFolder', rows=5, normalized=True)
+    cache_db = folder.objects.cache_db
+    entity_key = CacheManager(folder, cache_db).get_entity_key(4)
+
+    assert _names(folder.objects.filter(folder_id=4)) == [(4, 'name_4')]
+    assert cache_db.get(entity_key) is not None
+
+    folder.objects.dump(folder(folder_id=4, name='name_4', icon_url='https://example.com/dumped.png'))
+    assert cache_db.get(entity_key) is None
+    assert [x.icon_url for x in folder.objects.filter(folder_id=4)] == ['https://example.com/dumped.png']
+
+    folder.objects.bulk_dump([folder(folder_id=4, name='name_4', icon_url='https://example.com/bulk.png')])
+    assert cache_db.get(entity_key) is None
+    assert [x.icon_url for x in folder.objects.filter(name='name_4')] == ['https://example.com/bulk.png']
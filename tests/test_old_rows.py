@@ -0,0 +1,82 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_old_rows.py
+# Date   : 2017-10-25 14-00
+# Version: 0.0.1
+# Description: the old rows are read before the writes only when needed, all the lookups are invalidated without them.
+
+from benchmarks.standins import make_model
+
+LOOKUP_CONDITIONS = {'*': 3600, 'name__lt': 3600}
+
+
+def _update_name(folder, folder_id, name, conn=None):
+    instance = folder.objects.get(folder_id=folder_id)
+    queries = folder.Meta.table.queries
+    instance.name = name
+    folder.objects.update(instance, conn)
+    return folder.Meta.table.queries - queries
+
+
+def _fail_selects(monkeypatch, table):
+    def select(query):
+        raise RuntimeError('The database is gone')
+
+    monkeypatch.setattr(table, 'select', select)
+
+
+def test_not_read_for_primary_key_conditions():
+    folder = make_model('OldRowsPrimaryKeyFolder', rows=5, cache_conditions={'*': 3600, 'folder_id': 3600})
+
+    assert _update_name(folder, 1, 'new') == 0
+    assert [x.name for x in folder.objects.filter(folder_id=1)] == ['new']
+    assert sorted(x.name for x in folder.objects.all())[-1] == 'new'
+
+
+def test_read_from_entities():
+    folder = make_model('OldRowsEntityFolder', rows=5, normalized=True)
+    assert len(folder.objects.filter(name='name_1')) == 1
+
+    assert _update_name(folder, 1, 'name_2') == 0
+    assert len(folder.objects.filter(name='name_1')) == 0 and len(folder.objects.filter(name='name_2')) == 2
+
+
+def test_read_through_manager():
+    folder = make_model('OldRowsManagerFolder', rows=5)
+    assert len(folder.objects.filter(name='name_1')) == 1
+
+    assert _update_name(folder, 1, 'name_2') == 1
+    assert len(folder.objects.filter(name='name_1')) == 0 and len(folder.objects.filter(name='name_2')) == 2
+
+
+def test_failed_read(monkeypatch):
+    folder = make_model('OldRowsFailedFolder', rows=5, cache_conditions=LOOKUP_CONDITIONS)
+    table = folder.Meta.table
+    assert [x.folder_id for x in folder.objects.filter(name__lt='name_2')] == [1]
+
+    instance = folder.objects.get(folder_id=1)
+    instance.name = 'name_9'
+
+    # Only the old row satisfies `name__lt`, every condition with lookups is invalidated
+    with monkeypatch.context() as patch:
+        _fail_selects(patch, table)
+        folder.objects.update(instance)
+
+    assert [x.folder_id for x in folder.objects.filter(name__lt='name_2')] == []
+
+
+def test_failed_bulk_read(monkeypatch):
+    folder = make_model('OldRowsFailedBulkFolder', rows=5, cache_conditions=LOOKUP_CONDITIONS)
+    table = folder.Meta.table
+    assert [x.folder_id for x in folder.objects.filter(name__lt='name_3')] == [1, 2]
+
+    instances = [folder.objects.get(folder_id=x) for x in (1, 2)]
+    for instance in instances:
+        instance.name = 'name_9'
+
+    with monkeypatch.context() as patch:
+        _fail_selects(patch, table)
+        folder.objects.bulk_update(instances)
+
+    assert [x.folder_id for x in folder.objects.filter(name__lt='name_3')] == []
@@ -0,0 +1,53 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_pages.py
+# Date   : 2017-10-25 10-00
+# Version: 0.0.1
+# Description: the first pages of the ordered queries are cached and invalidated with their conditions.
+
+import pytest
+
+from benchmarks.standins import make_model
+
+CONDITIONS = {'*': 3600, 'folder_id': 3600}
+
+
+def _first_page(folder):
+    return [(x.folder_id, x.name) for x in folder.objects.all().order_by('name').limit(2)]
+
+
+@pytest.mark.parametrize('normalized', [False, True])
+def test_ordering_field_changed(normalized):
+    folder = make_model('PagedFolder{}'.format(int(normalized)), normalized=normalized, cache_pages=2,
+                        cache_conditions=CONDITIONS)
+    for folder_id, name in enumerate('abcd', 1):
+        folder.Meta.table.insert(folder(folder_id=folder_id, name=name, icon_url=''))
+
+    table = folder.Meta.table
+    assert _first_page(folder) == [(1, 'a'), (2, 'b')]
+    assert _first_page(folder) == [(1, 'a'), (2, 'b')] and table.queries == 1
+
+    # `name` is not a condition field, but it orders the cached page
+    instance = folder.objects.get(folder_id=4)
+    instance.name = '0'
+    folder.objects.update(instance)
+    assert _first_page(folder) == [(4, '0'), (1, 'a')]
+
+    # `icon_url` orders nothing, the page is still valid in normalized mode
+    instance.icon_url = 'https://example.com/new.png'
+    folder.objects.update(instance)
+    queries = table.queries
+    assert _first_page(folder) == [(4, '0'), (1, 'a')]
+    assert table.queries == queries + (0 if normalized else 1)
+
+
+def test_later_pages_not_cached():
+    folder = make_model('PagedLaterFolder', rows=10, cache_pages=2, cache_conditions=CONDITIONS)
+    table = folder.Meta.table
+
+    for _ in range(2):
+        list(folder.objects.all().order_by('folder_id').limit(3, 3))
+        list(folder.objects.all().order_by('folder_id').limit(3, 6))
+
+    assert table.queries == 3
@@ -0,0 +1,103 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_registry.py
+# Date   : 2017-10-25 18-00
+# Version: 0.0.1
+# Description: cache dbs of the same class and configuration share one instance per process.
+
+import os
+
+import pytest
+from werkzeug.contrib.cache import FileSystemCache, RedisCache
+
+from benchmarks.standins import StandInCache, make_model
+from mycache.filecache import ShardedFileCache
+from mycache.output import _create_cache
+from mycache.registry import REGISTRY, BackendRegistry, get_instance_id
+
+
+class OtherRedisCache(RedisCache):
+    pass
+
+
+def test_redis_instance_ids():
+    instance_id = get_instance_id(RedisCache(db=1, password='a'))
+    assert instance_id == get_instance_id(RedisCache(db=1, password='a'))
+
+    # Credentials, classes and other options never share a client
+    for cache_db in [RedisCache(db=1, password='b'), RedisCache(db=2, password='a'),
+                     OtherRedisCache(db=1, password='a'), RedisCache(db=1, password='a', key_prefix='x'),
+                     RedisCache(db=1, password='a', socket_timeout=1)]:
+        assert get_instance_id(cache_db) != instance_id
+
+    assert 'password' not in instance_id and "'a'" not in instance_id
+
+
+def test_file_instance_ids(tmp_path):
+    cache_dir = str(tmp_path)
+    assert get_instance_id(FileSystemCache(cache_dir)) == get_instance_id(FileSystemCache(cache_dir))
+    assert get_instance_id(FileSystemCache(cache_dir)) != get_instance_id(ShardedFileCache(cache_dir))
+    assert get_instance_id(FileSystemCache(cache_dir)) != get_instance_id(FileSystemCache(cache_dir, threshold=1))
+
+
+def test_add_and_get():
+    registry = BackendRegistry()
+    first, second = RedisCache(db=1, password='a'), RedisCache(db=1, password='a')
+    assert registry.add(first) is first and registry.add(second) is first
+    assert registry.add(RedisCache(db=1, password='b')) is not first and len(registry) == 2
+
+    calls = []
+
+    def factory(name):
+        calls.append(name)
+        return object()
+
+    assert registry.get('id', factory, 'first') is registry.get('id', factory, 'second') and calls == ['first']
+    registry.reset()
+    assert len(registry) == 0 and 'id' not in registry
+
+
+def test_max_connections(monkeypatch):
+    assert BackendRegistry(max_connections=5).redis_options(db=1) == {'db': 1, 'max_connections': 5}
+    assert BackendRegistry(max_connections=5).redis_options(max_connections=2) == {'max_connections': 2}
+    assert BackendRegistry().redis_options(db=1) == {'db': 1}
+
+    monkeypatch.setattr(REGISTRY, 'max_connections', 7)
+    cache_db = _create_cache(cache_type='redis', db=3, key_prefix='test_max_connections.')
+    assert cache_db._client.connection_pool.max_connections == 7
+    assert _create_cache(cache_type='redis', db=3, key_prefix='test_max_connections.') is cache_db
+
+
+def test_model_cache_dbs():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return StandInCache()
+
+    # Not reused, the factory is called for each access
+    folder = make_model('RegistryNotReusedFolder', cache_db_factory=factory, reuse_cache_db=False)
+    assert folder.objects.cache_db is not folder.objects.cache_db and len(calls) == 2
+
+    folder = make_model('RegistryReusedFolder', cache_db_factory=factory, reuse_cache_db=True)
+    assert folder.objects.cache_db is folder.objects.cache_db and len(calls) == 3
+
+    # Factories of other models returning the same configuration share the first instance
+    redis_factory = lambda: RedisCache(db=4, key_prefix='test_model_cache_dbs.')
+    folders = [make_model('RegistrySharedFolder{}'.format(i), cache_db_factory=redis_factory, reuse_cache_db=True)
+               for i in range(2)]
+    assert folders[0].objects.cache_db is folders[1].objects.cache_db
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='no at-fork hooks')
+def test_reset_after_fork():
+    REGISTRY.get('test_reset_after_fork', object)
+    assert 'test_reset_after_fork' in REGISTRY
+
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if len(REGISTRY) == 0 else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0 and 'test_reset_after_fork' in REGISTRY
@@ -0,0 +1,92 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_serializer.py
+# Date   : 2017-10-24 11-00
+# Version: 0.0.1
+# Description: encoded values are decoded, anything else is returned as it is.
+
+import pickle
+
+import pytest
+
+from benchmarks.standins import make_model
+from mycache.output import _create_cache, output_cache
+from mycache.serializer import MAGIC, SERIALIZERS, loads
+
+RAW_OUTPUTS = [bytes([0xB0]) + b'\x00payload', bytes([0xB8]) + b'payload', bytes([0xBC]), b'', b'plain',
+               MAGIC, MAGIC + b'\xff', MAGIC + b'\x00not a pickle']
+
+
+@pytest.mark.parametrize('name', sorted(SERIALIZERS))
+def test_round_trip(name):
+    serializer = SERIALIZERS[name]
+    for value in [None, 1, 'text', b'\xb0bytes', list(range(1000)), {'x': ['y' * 2000]}]:
+        data = serializer.dumps(value)
+        assert data.startswith(MAGIC) and loads(data) == value
+
+
+def test_unknown_and_broken_encodings():
+    payload = pickle.dumps('value')
+    assert loads(MAGIC + b'\x00' + payload) == 'value'
+
+    # Unknown codec, unknown compression, broken payload, read as misses
+    for data in [MAGIC + b'\x30' + payload, MAGIC + b'\x0f' + payload, MAGIC + b'\x01' + payload,
+                 MAGIC + b'\xff', MAGIC + b'\x00not a pickle']:
+        assert loads(data) is None
+
+    # Not encoded, e.g. stored by the old versions
+    for data in RAW_OUTPUTS[:-2]:
+        assert loads(data) == data
+
+
+@pytest.mark.parametrize('serializer', [None, 'pickle_zlib'])
+def test_raw_bytes_outputs(serializer):
+    _create_cache(cache_type='memory').clear()
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory', serializer=serializer)
+    def raw(i):
+        calls.append(i)
+        return RAW_OUTPUTS[i]
+
+    for _ in range(2):
+        assert [raw(i) for i in range(len(RAW_OUTPUTS))] == RAW_OUTPUTS
+        assert raw.many(range(len(RAW_OUTPUTS))) == RAW_OUTPUTS
+
+    assert calls == list(range(len(RAW_OUTPUTS)))
+
+
+def test_broken_values_are_misses():
+    cache_db = _create_cache(cache_type='memory')
+    cache_db.clear()
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory', serializer='pickle', custom_cache_key='broken_{i}')
+    def value(i):
+        calls.append(i)
+        return 'value_{}'.format(i)
+
+    assert value(1) == 'value_1' and value.many([1, 2]) == ['value_1', 'value_2'] and calls == [1, 2]
+
+    # e.g. the pickled class was moved, the values are computed and overwritten again
+    cache_db.set('broken_1', MAGIC + b'\x00not a pickle')
+    cache_db.set('broken_2', MAGIC + b'\x30' + pickle.dumps('value_2'))
+    assert value(1) == 'value_1' and value.many([1, 2]) == ['value_1', 'value_2'] and calls == [1, 2, 1, 2]
+    assert loads(cache_db.get('broken_1')) == 'value_1' and loads(cache_db.get('broken_2')) == 'value_2'
+
+
+@pytest.mark.parametrize('normalized', [False, True])
+def test_broken_query_results_are_misses(normalized):
+    folder = make_model('BrokenFolder{}'.format(int(normalized)), rows=5, normalized=normalized,
+                        cache_serializer='pickle')
+    cache_db, table = folder.objects.cache_db, folder.Meta.table
+
+    assert [x.folder_id for x in folder.objects.filter(name='name_1')] == [1] and table.queries == 1
+    # The results (and the rows in normalized mode), the tracker is left as it is
+    for key in list(cache_db._data):
+        if isinstance(loads(cache_db.get(key)), (list, folder)):
+            cache_db.set(key, MAGIC + b'\x00not a pickle')
+
+    assert [x.folder_id for x in folder.objects.filter(name='name_1')] == [1] and table.queries == 2
+    assert [x.folder_id for x in folder.objects.filter(name='name_1')] == [1] and table.queries == 2
@@ -0,0 +1,67 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_stale.py
+# Date   : 2017-10-23 11-30
+# Version: 0.0.1
+# Description: stale outputs are returned and refreshed in background, expired ones are recomputed.
+
+import random
+import time
+from threading import Event
+
+from mycache.output import output_cache
+from mycache.stale import RefreshPool, is_stale, make_entry
+
+
+def test_early_expiration(monkeypatch):
+    entry = make_entry('value', 10, delta=100)
+    assert not is_stale(entry) and is_stale(make_entry('value', -1))
+
+    # XFetch: 100 * 1.0 * -log(1 - 0.99) is far beyond the 10 seconds left
+    monkeypatch.setattr(random, 'random', lambda: 0.99)
+    assert is_stale(entry, beta=1.0) and not is_stale(entry, beta=0)
+
+    monkeypatch.setattr(random, 'random', lambda: 0.0)
+    assert not is_stale(entry, beta=1.0)
+
+
+def test_refresh_pool():
+    pool = RefreshPool(max_workers=2, max_pending=2)
+    started, finished = Event(), Event()
+
+    def refresh():
+        started.set()
+        finished.wait(5)
+
+    assert pool.submit('a', refresh) and started.wait(5)
+
+    # One task per key, and no more than `max_pending` waiting
+    assert pool.submit('a', refresh) is False
+    assert pool.submit('b', finished.wait, 5) and pool.submit('c', refresh) is False
+
+    finished.set()
+    pool.shutdown()
+    assert len(pool) == 0
+
+
+def test_stale_while_revalidate():
+    pool = RefreshPool()
+    calls = []
+
+    @output_cache(timeout=3, stale_timeout=1, cache_type='memory', refresh_pool=pool)
+    def version(x):
+        calls.append(x)
+        return len(calls)
+
+    assert version('a') == 1 and version('a') == 1
+
+    # Stale, the old output is returned and refreshed in background
+    time.sleep(1.1)
+    assert version('a') == 1
+    pool.shutdown()
+    assert calls == ['a', 'a'] and version('a') == 2
+
+    # Expired, computed synchronously
+    time.sleep(3.5)
+    assert version('a') == 3 and calls == ['a', 'a', 'a']
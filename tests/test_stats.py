@@ -0,0 +1,114 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_stats.py
+# Date   : 2017-10-25 20-00
+# Version: 0.0.1
+# Description: counters and latencies of the outputs and the queries, exported only when enabled.
+
+import time
+import types
+
+import pytest
+
+from benchmarks.standins import make_model
+from mycache.output import _create_cache, output_cache
+from mycache.stats import COUNTERS, LATENCY_BUCKETS, METRICS, Metrics, output_scope, query_scope
+
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    METRICS.enable()
+    try:
+        yield METRICS
+    finally:
+        METRICS.disable()
+        METRICS.reset()
+
+
+def test_snapshot_and_export():
+    metrics = Metrics(enabled=True)
+    metrics.lookup('scope', True, 0.0002)
+    metrics.lookup('scope', False, 2, negative=False)
+    metrics.lookup('scope', True, 0.0002, negative=True)
+    metrics.incr('scope', 'sets', 3)
+
+    snapshot = metrics.snapshot()
+    assert set(snapshot['scope']) == set(COUNTERS) | {'latency'}
+    assert (snapshot['scope']['hits'], snapshot['scope']['misses'], snapshot['scope']['negative_hits']) == (2, 1, 1)
+
+    latency = snapshot['scope']['latency']['get']
+    assert latency['count'] == 3 and latency['max'] == 2 and len(latency['buckets']) == len(LATENCY_BUCKETS)
+    assert latency['buckets']['0.0005'] == 2 and latency['buckets']['5'] == 1 and latency['buckets']['+Inf'] == 0
+
+    exported = []
+
+    def broken(snapshot):
+        raise RuntimeError('The collector is gone')
+
+    # A failing exporter never stops the others
+    metrics.add_exporter(broken)
+    metrics.add_exporter(exported.append)
+    assert metrics.export(reset=True) == snapshot and exported == [snapshot]
+    assert metrics.snapshot() == {}
+
+    metrics.remove_exporter(broken)
+    metrics.export()
+    assert exported[-1] == {}
+
+
+def test_output_counters(metrics):
+    _create_cache(cache_type='memory').clear()
+    calls = []
+
+    @output_cache(timeout=60, cache_type='memory')
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(2), square(2)] == [4, 4] and square.many([2, 3]) == [4, 9] and calls == [2, 3]
+
+    counters = metrics.snapshot()[output_scope(square.__wrapped__)]
+    assert (counters['hits'], counters['misses'], counters['sets']) == (2, 2, 2)
+    assert counters['latency']['get']['count'] == 3 and counters['latency']['load']['count'] == 2
+
+
+def test_output_lookups_not_measured_when_disabled(monkeypatch):
+    _create_cache(cache_type='memory').clear()
+
+    @output_cache(timeout=60, cache_type='memory')
+    def square(x):
+        return x * x
+
+    square(2)
+    square.many([2, 3])
+
+    calls = []
+
+    def now():
+        calls.append(1)
+        return time.time()
+
+    monkeypatch.setattr('mycache.output.time', types.SimpleNamespace(time=now))
+    assert square(2) == 4 and square.many([2, 3]) == [4, 9]
+    assert calls == [] and METRICS.snapshot() == {}
+
+
+def test_query_counters(metrics):
+    folder = make_model('StatsFolder', rows=5)
+
+    for _ in range(2):
+        list(folder.objects.filter(name='name_1'))
+
+    counters = metrics.snapshot()[query_scope(folder, {'name': 'name_1'})]
+    assert (counters['hits'], counters['misses'], counters['sets']) == (1, 1, 1)
+    assert counters['latency']['get']['count'] == 2 and counters['latency']['load']['count'] == 1
+    assert counters['key_bytes'] > 0
+
+    instance = folder.objects.get(folder_id=1)
+    instance.name = 'name_2'
+    folder.objects.update(instance)
+
+    # `name_1` and the `folder_id` of the row are discarded
+    assert metrics.snapshot()[query_scope(folder)]['invalidations'] >= 2
@@ -0,0 +1,275 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_tracker.py
+# Date   : 2017-08-16 15-20
+# Version: 0.0.1
+# Description: concurrent writers must not lose each other's tracker changes.
+
+import os
+import pickle
+import threading
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+
+import pytest
+
+from mycache.memory import MemoryCache
+from mycache.query import QueryTracker
+from mycache.tracker import BlobTrackerStore, RedisTrackerStore, index_names
+
+WORKERS = 8
+ROUNDS = 50
+
+
+class StandInCache(object):
+    """
+    An in-memory CacheDB-like server shared by the worker processes
+    """
+
+    def __init__(self):
+        self._data = dict()
+        self._locks = dict()
+        self._guard = threading.Lock()
+
+    def get(self, key):
+        with self._guard:
+            return self._data.get(key)
+
+    def set(self, key, value, timeout=None):
+        with self._guard:
+            self._data[key] = value
+            return True
+
+    def has(self, key):
+        with self._guard:
+            return key in self._data
+
+    def delete(self, key):
+        with self._guard:
+            return self._data.pop(key, None) is not None
+
+    def delete_many(self, *keys):
+        with self._guard:
+            for key in keys:
+                self._data.pop(key, None)
+            return True
+
+    def acquire(self, name, timeout=None):
+        with self._guard:
+            lock = self._locks.setdefault(name, threading.Lock())
+
+        return lock.acquire(timeout=-1 if timeout is None else timeout)
+
+    def release(self, name):
+        self._locks[name].release()
+
+
+class StandInLock(object):
+    def __init__(self, server, name, blocking_timeout=None):
+        self._server = server
+        self._name = name
+        self._blocking_timeout = blocking_timeout
+
+    def acquire(self):
+        return self._server.acquire(self._name, self._blocking_timeout)
+
+    def release(self):
+        self._server.release(self._name)
+
+
+class StandInClient(object):
+    """
+    CacheDB-like client of the stand-in server, with the `lock` method
+    """
+
+    def __init__(self, server):
+        self._server = server
+
+    def __getattr__(self, item):
+        return getattr(self._server, item)
+
+    def lock(self, name, timeout=None, blocking_timeout=None):
+        return StandInLock(self._server, name, blocking_timeout)
+
+
+_STAND_IN = StandInCache()
+
+
+def _get_stand_in():
+    return _STAND_IN
+
+
+class StandInManager(BaseManager):
+    pass
+
+
+StandInManager.register('get_cache', callable=_get_stand_in)
+
+
+class StressModel(object):
+    pass
+
+
+def _connect(address, authkey):
+    manager = StandInManager(address=address, authkey=authkey)
+    manager.connect()
+    return StandInClient(manager.get_cache())
+
+
+def _work(address, authkey, worker_id):
+    _track_and_discard(_connect(address, authkey), worker_id)
+
+
+def _track_and_discard(cache_db, worker_id):
+    for i in range(ROUNDS):
+        with QueryTracker(StressModel, cache_db) as tracker:
+            tracker.track('w{}_{}'.format(worker_id, i), {'worker': worker_id, 'n': i}, [i], 0)
+
+        # Discard half of them by the exact condition, values must be non-zero for an exact match
+        if i % 2 == 1:
+            with QueryTracker(StressModel, cache_db) as tracker:
+                tracker.discard({'worker': worker_id, 'n': i})
+
+
+def test_concurrent_track_and_discard():
+    authkey = os.urandom(16)
+    manager = StandInManager(address=('127.0.0.1', 0), authkey=authkey)
+    manager.start()
+
+    try:
+        workers = [Process(target=_work, args=(manager.address, authkey, i)) for i in range(1, WORKERS + 1)]
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+        cache_db = _connect(manager.address, authkey)
+        tracked = cache_db.get(QueryTracker(StressModel, cache_db).tracker_key)
+        expected = {'w{}_{}'.format(w, i): {'worker': w, 'n': i} for w in range(1, WORKERS + 1)
+                    for i in range(0, ROUNDS, 2)}
+
+        # No lost additions, no resurrected discards
+        assert tracked == expected
+
+        for w in range(1, WORKERS + 1):
+            for i in range(ROUNDS):
+                assert cache_db.has('w{}_{}'.format(w, i)) is (i % 2 == 0)
+    finally:
+        manager.shutdown()
+
+
+class _BusyLock(object):
+    def acquire(self):
+        return False
+
+
+def test_tracker_not_locked():
+    cache_db = MemoryCache()
+    cache_db.lock = lambda name, **kwargs: _BusyLock()
+    cache_db.set('tracker', {'a': {'worker': 1}})
+    cache_db.set('a', 1)
+
+    store = BlobTrackerStore(cache_db, 'tracker', lock_timeout=0.01)
+    store.track('b', {'worker': 2}, 2)
+    assert store.discard_many([{'worker': 1}]) == ['a']
+    store.flush()
+
+    # The discarded key is deleted, the tracked one is not cached, the dict is never written
+    assert cache_db.get('a') is None and cache_db.get('b') is None
+    assert cache_db.get('tracker') == {'a': {'worker': 1}} and store.round_trips == 5
+
+
+def _redis_work(port, worker_id):
+    from werkzeug.contrib.cache import RedisCache
+
+    _track_and_discard(RedisCache(host='127.0.0.1', port=port, key_prefix='stress.'), worker_id)
+
+
+def test_concurrent_track_and_discard_with_redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    from werkzeug.contrib.cache import RedisCache
+
+    server = fakeredis.TcpFakeServer(('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        port = server.server_address[1]
+        workers = [Process(target=_redis_work, args=(port, i)) for i in range(1, WORKERS + 1)]
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+        cache_db = RedisCache(host='127.0.0.1', port=port, key_prefix='stress.')
+        store = QueryTracker(StressModel, cache_db).store
+        assert isinstance(store, RedisTrackerStore)
+
+        client = cache_db._client
+        tracked = {k.decode('utf-8'): pickle.loads(v) for k, v in client.hgetall(store._name('where')).items()}
+        expected = {'w{}_{}'.format(w, i): {'worker': w, 'n': i} for w in range(1, WORKERS + 1)
+                    for i in range(0, ROUNDS, 2)}
+        assert tracked == expected
+
+        # The indexes hold the tracked keys only
+        for key, where in expected.items():
+            for name in index_names(where):
+                assert client.sismember(store._name(name), key)
+
+        indexed = set()
+        for name in client.smembers(store._name('indexes')):
+            indexed.update(x.decode('utf-8') for x in client.smembers(store._name(name.decode('utf-8'))))
+        assert indexed == set(expected)
+
+        for w in range(1, WORKERS + 1):
+            for i in range(ROUNDS):
+                assert bool(cache_db.has('w{}_{}'.format(w, i))) is (i % 2 == 0)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_migrate_old_tracker(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    from werkzeug.contrib.cache import RedisCache
+
+    cache_db = RedisCache(key_prefix='migrate.')
+    cache_db._client = fakeredis.FakeStrictRedis()
+    client = cache_db._client
+    monkeypatch.setattr(RedisTrackerStore, 'migrated', set())
+
+    # Tracked by the old versions, one pickled dict
+    old = {'folder_1': {'folder_id': 1}, 'name_a': {'name': 'a'}, 'lt_5': {'folder_id__lt': 5}}
+    client.set('migrate.query_tracker_for_folder', cache_db.dump_object(old))
+    for key in old:
+        client.set('migrate.' + key, cache_db.dump_object([key]))
+
+    store = RedisTrackerStore(cache_db, 'query_tracker_for_folder')
+    tracked = {k.decode('utf-8'): pickle.loads(v) for k, v in client.hgetall(store._name('where')).items()}
+    assert tracked == old and len(store) == 3
+    for key, where in old.items():
+        for name in index_names(where):
+            assert client.sismember(store._name(name), key)
+
+    assert not client.exists('migrate.query_tracker_for_folder')
+
+    # The migrated keys are discarded like the ones tracked by the new versions
+    assert store.discard({'folder_id': 1}) == ['folder_1'] and cache_db.get('folder_1') is None
+    assert store.discard_many([{'folder_id__lt': None}], rows=[{'folder_id': 7}]) == []
+    assert store.discard_many([{'folder_id__lt': None}], rows=[{'folder_id': 3}]) == ['lt_5']
+    assert cache_db.get('lt_5') is None and cache_db.get('name_a') == ['name_a'] and len(store) == 1
+
+    # Once per process
+    client.set('migrate.query_tracker_for_folder', cache_db.dump_object({'other': {'name': 'b'}}))
+    assert len(RedisTrackerStore(cache_db, 'query_tracker_for_folder')) == 1
+
+
+if __name__ == '__main__':
+    test_concurrent_track_and_discard()
@@ -0,0 +1,130 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_transaction.py
+# Date   : 2017-10-16 15-30
+# Version: 0.0.1
+# Description: invalidations of a transaction are deduplicated and run after it, and once more after the delay.
+
+import time
+
+import pytest
+
+from benchmarks.standins import make_model
+from mycache.query import CacheManager, DataObjectsManagerWithCache
+from mycache.transaction import DeferredInvalidation, DelayedCalls, get_transaction
+
+
+class Folder(object):
+    pass
+
+
+class StandInManager(object):
+    def __init__(self):
+        self._model = Folder
+        self.removed = []
+
+    def _remove_related(self, queries, rows, entity_keys=()):
+        self.removed.append(([q['where'] for q in queries], rows, entity_keys))
+
+
+def test_deferred_invalidation():
+    conn = object()
+    manager = StandInManager()
+    scheduler = DelayedCalls()
+
+    with DeferredInvalidation(conn, delay=0.05, scheduler=scheduler) as transaction:
+        transaction.add(manager, [{'where': {'folder_id': 1}}, {'where': {}}], [{'folder_id': 1}], ['folder_pk_1'])
+
+        with DeferredInvalidation(conn) as inner:
+            assert inner is transaction
+            get_transaction(conn).add(manager, [{'where': {'folder_id': 1}}], [{'folder_id': 1}], ['folder_pk_1'])
+
+        assert get_transaction(conn) is transaction
+        assert len(transaction) == 3 and manager.removed == []
+
+    assert get_transaction(conn) is None
+    assert manager.removed == [([{'folder_id': 1}, {}], [{'folder_id': 1}], ['folder_pk_1'])]
+
+    deadline = time.time() + 2
+    while len(manager.removed) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert manager.removed[1] == manager.removed[0] and len(scheduler) == 0
+
+
+def test_unknown_rows():
+    conn = object()
+    manager = StandInManager()
+
+    # A write whose old row is unknown invalidates every condition with lookups of the model
+    with DeferredInvalidation(conn) as transaction:
+        transaction.add(manager, [{'where': {'folder_id': 1}}], [{'folder_id': 1}])
+        transaction.add(manager, [{'where': {'folder_id': 2}}], None)
+        transaction.add(manager, [{'where': {'folder_id': 3}}], [{'folder_id': 3}])
+
+    assert manager.removed == [([{'folder_id': 1}, {'folder_id': 2}, {'folder_id': 3}], None, [])]
+
+
+@pytest.mark.parametrize('normalized', [False, True])
+def test_writes_in_transaction(monkeypatch, normalized):
+    folder = make_model('TransactionFolder{}'.format(int(normalized)), rows=5, normalized=normalized)
+    cache_db, table = folder.objects.cache_db, folder.Meta.table
+    assert len(folder.objects.filter(name='name_1')) == 1 and len(folder.objects.filter(name='name_2')) == 1
+
+    removes = []
+    remove_related = DataObjectsManagerWithCache._remove_related
+
+    def record(self, queries, rows, entity_keys=()):
+        removes.append((len(queries), rows, list(entity_keys)))
+        return remove_related(self, queries, rows, entity_keys)
+
+    monkeypatch.setattr(DataObjectsManagerWithCache, '_remove_related', record)
+
+    # Nothing is invalidated before the SQL of the writes runs
+    removed_before_writes = []
+    write = table.write
+
+    def record_write(row):
+        removed_before_writes.append(len(removes))
+        return write(row)
+
+    monkeypatch.setattr(table, 'write', record_write)
+
+    conn = object()
+    entity_key = CacheManager(folder, cache_db).get_entity_key(1) if normalized else None
+    with DeferredInvalidation(conn):
+        instance = folder.objects.get(folder_id=1)
+        for icon_url in ('https://example.com/1.png', 'https://example.com/2.png'):
+            instance.icon_url = icon_url
+            folder.objects.update(instance, conn)
+
+        folder.objects.delete(folder(folder_id=2, name='name_2'), conn)
+        folder.objects.dump(folder(name='name_1', icon_url=''), conn)
+
+        assert removes == [] and removed_before_writes == [0, 0, 0]
+        if normalized:
+            # The row is not rewritten before the commit
+            assert cache_db.get(entity_key).icon_url == 'https://example.com/icons/1.png'
+
+    # One pass after the block, the versions of row 1 (old, first and second update) are checked once each
+    assert len(removes) == 1
+    _, rows, entity_keys = removes[0]
+    assert len(rows) == 5 and [x['icon_url'] for x in rows if x.get('folder_id') == 1] == [
+        'https://example.com/1.png', 'https://example.com/icons/1.png', 'https://example.com/2.png']
+    if normalized:
+        assert entity_key in entity_keys and cache_db.get(entity_key) is None
+
+    assert sorted(x.folder_id for x in folder.objects.filter(name='name_1')) == [1, 6]
+    assert [x.icon_url for x in folder.objects.filter(folder_id=1)] == ['https://example.com/2.png']
+    assert len(folder.objects.filter(name='name_2')) == 0
+
+
+def test_delayed_calls_order():
+    calls = []
+    scheduler = DelayedCalls()
+    scheduler.schedule(60, calls.append, 2)
+    scheduler.schedule(30, calls.append, 1)
+
+    assert len(scheduler) == 2
+    assert scheduler.run_pending() == 2 and calls == [1, 2]
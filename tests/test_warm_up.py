@@ -0,0 +1,55 @@
+# -*-coding: utf-8-*-
+# Author : Christopher Lee
+# License: Apache License
+# File   : test_warm_up.py
+# Date   : 2017-10-24 10-00
+# Version: 0.0.1
+# Description: `all_cache` reads the groups in keyset chunks, writes meanwhile never break a group.
+
+from benchmarks.standins import make_model
+
+ROWS = 300
+CHUNK_SIZE = 7
+
+
+def _check_groups(folder, names):
+    """
+    Every group is cached with all its rows
+    """
+    table = folder.Meta.table
+    queries = table.queries
+
+    for name in names:
+        expected = sorted(x.folder_id for x in table.rows.values() if x.name == name)
+        assert sorted(x.folder_id for x in folder.objects.filter(name=name)) == expected, name
+
+    assert table.queries == queries
+
+
+def test_warm_up():
+    folder = make_model('WarmUpFolder', rows=ROWS, cache_conditions={'*': 3600, 'name': 3600, 'folder_id': 3600})
+
+    stats = {x.condition: x for x in folder.objects.all_cache(chunk_size=CHUNK_SIZE)}
+    assert stats['name'].groups == 100 and stats['name'].rows == ROWS
+    assert stats['folder_id'].groups == ROWS and stats['folder_id'].chunks == ROWS // CHUNK_SIZE + 1
+
+    _check_groups(folder, ['name_{}'.format(i) for i in range(100)])
+    assert [x.name for x in folder.objects.filter(folder_id=ROWS)] == ['name_0']
+
+
+def test_warm_up_with_writes():
+    folder = make_model('WarmUpWrittenFolder', rows=ROWS, cache_conditions={'*': 3600, 'name': 3600})
+    table = folder.Meta.table
+    deleted = []
+
+    def delete_read_rows(stats):
+        # Rows of the first group, read already, are deleted while warming up
+        if stats.chunks > 1 and len(deleted) < 3:
+            row = min((x for x in table.rows.values() if x.name == 'name_0'), key=lambda x: x.folder_id)
+            deleted.append(table.delete(row))
+
+    folder.objects.all_cache(chunk_size=CHUNK_SIZE, progress=delete_read_rows)
+    assert deleted == [1, 1, 1]
+
+    # Chunks by offsets would have skipped as many rows as deleted
+    _check_groups(folder, ['name_{}'.format(i) for i in range(1, 100)])